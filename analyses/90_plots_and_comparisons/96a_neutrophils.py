@@ -949,16 +949,12 @@ sc.pp.normalize_total(pb_n, target_sum=1e6)
 sc.pp.log1p(pb_n, base=2)
 
 # %%
-for ct in tqdm(pb_n.obs["cell_type"].unique()):
-    sh.signatures.fold_change(
-        pb_n, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_fc"
-    )
-    sh.signatures.specific_fold_change(
-        pb_n, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_sfc"
-    )
-    sh.signatures.roc_auc(
-        pb_n, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_auroc"
-    )
+sh.signatures.marker_statistics(
+    pb_n,
+    obs_col="cell_type",
+    inplace=True,
+    keys_added={"fold_change": "fc", "specific_fold_change": "sfc", "roc_auc": "auroc"},
+)
 
 # %%
 markers = {
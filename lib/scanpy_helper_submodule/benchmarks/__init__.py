@@ -0,0 +1 @@
+"""Benchmark suite for scanpy_helpers on synthetic atlas-shaped data. See `benchmarks.run`."""
@@ -0,0 +1,277 @@
+"""Benchmark the hot paths of scanpy_helpers on synthetic atlas-shaped data.
+
+Each benchmark records the wall time (best of `--repeat` runs) and the peak memory
+allocated during a separate run (traced with `tracemalloc`, which includes numpy buffers).
+Results can be stored as baseline and later runs compared against it. A benchmark is
+flagged as regression if time or peak memory exceed the baseline by more than `--threshold`.
+
+Usage::
+
+    # record a baseline
+    python -m benchmarks.run --scale small --baseline benchmarks/baseline_small.json --save-baseline
+    # compare against the baseline. Exits with status 1 if there are regressions.
+    python -m benchmarks.run --scale small --baseline benchmarks/baseline_small.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from multiprocessing import cpu_count
+from typing import Callable, Dict, List, Mapping, Optional
+import warnings
+import numpy as np
+import pandas as pd
+import scanpy as sc
+from anndata import AnnData
+
+import scanpy_helpers as sh
+from scanpy_helpers.pseudobulk import pseudobulk
+from .synthetic import SCALES, make_atlas, split_datasets
+
+#: benchmark name -> setup function. The setup function receives the synthetic atlas
+#: and returns a function without arguments that runs the benchmarked code.
+BENCHMARKS: Dict[str, Callable[[AnnData], Callable[[], object]]] = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark setup function"""
+
+    def _decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return _decorator
+
+
+def _most_common(adata, col):
+    return adata.obs[col].value_counts().index[0]
+
+
+def _log_norm_pseudobulk(adata, **kwargs):
+    pb = pseudobulk(adata, **kwargs)
+    sc.pp.normalize_total(pb, target_sum=1e6)
+    sc.pp.log1p(pb)
+    return pb
+
+
+@benchmark("pseudobulk")
+def _setup_pseudobulk(adata):
+    return lambda: pseudobulk(adata, groupby=["dataset", "patient", "cell_type"])
+
+
+@benchmark("test_lm")
+def _setup_test_lm(adata):
+    ct = _most_common(adata, "cell_type")
+    pb = _log_norm_pseudobulk(
+        adata[adata.obs["cell_type"] == ct, :],
+        groupby=["dataset", "patient", "condition"],
+        min_obs=1,
+    )
+    return lambda: sh.compare_groups.lm.test_lm(
+        pb,
+        "~ C(condition, Sum) + dataset",
+        "condition",
+        contrasts="Sum",
+        progress=False,
+        n_jobs=1,
+    )
+
+
+@benchmark("roc_auc")
+def _setup_roc_auc(adata):
+    pb = _log_norm_pseudobulk(adata, groupby=["patient", "cell_type"], min_obs=1)
+    ct = _most_common(adata, "cell_type")
+    return lambda: sh.signatures.roc_auc(
+        pb, obs_col="cell_type", positive_class=ct, inplace=False
+    )
+
+
+@benchmark("score_network")
+def _setup_score_network(adata):
+    rng = np.random.default_rng(0)
+    # a cytosig-sized network: ~40 sources with a few hundred targets each
+    network = pd.DataFrame(
+        rng.normal(size=(min(adata.n_vars, 4000), 40))
+        * (rng.uniform(size=(min(adata.n_vars, 4000), 40)) < 0.1),
+        index=adata.var_names[: min(adata.n_vars, 4000)],
+    )
+    network.columns = network.columns.astype(str)
+    return lambda: sh.compare_groups.compute_scores.score_network(
+        adata, network, use_raw=False
+    )
+
+
+@benchmark("aggregate_duplicate_gene_symbols")
+def _setup_aggregate_duplicate_gene_symbols(adata):
+    rng = np.random.default_rng(0)
+    var_names = adata.var_names.values.copy()
+    dup_idx = rng.choice(adata.n_vars, adata.n_vars // 20, replace=False)
+    var_names[dup_idx] = rng.choice(var_names, dup_idx.shape[0])
+    adata_dup = AnnData(X=adata.X, obs=adata.obs, var=pd.DataFrame(index=var_names))
+    return lambda: sh.integration.aggregate_duplicate_gene_symbols(adata_dup)
+
+
+@benchmark("merge_datasets")
+def _setup_merge_datasets(adata):
+    datasets = split_datasets(adata)
+    return lambda: sh.integration.merge_datasets(datasets, symbol_in_n_datasets=1)
+
+
+@benchmark("CpdbAnalysis")
+def _setup_cpdb_analysis(adata):
+    cpdb = pd.DataFrame(columns=["source_genesymbol", "target_genesymbol"])
+    adata_primary = adata[adata.obs["origin"] == "tumor_primary", :]
+    return lambda: sh.cell2cell.CpdbAnalysis(
+        cpdb,
+        adata_primary,
+        pseudobulk_group_by=["patient"],
+        cell_type_column="cell_type",
+    )
+
+
+def run_benchmarks(
+    adata: AnnData, names: Optional[List[str]] = None, repeat: int = 3
+) -> Dict[str, Dict[str, float]]:
+    """
+    Run benchmarks and measure wall time and peak memory
+
+    Parameters
+    ----------
+    adata
+        synthetic atlas, see :func:`benchmarks.synthetic.make_atlas`
+    names
+        benchmarks to run. Defaults to all registered benchmarks.
+    repeat
+        Number of timed runs. The fastest one is reported.
+
+    Returns
+    -------
+    Dictionary benchmark name -> {"time": seconds, "peak_memory": bytes}
+    """
+    results = {}
+    for name in BENCHMARKS if names is None else names:
+        print(f"Running {name}...", file=sys.stderr)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            func = BENCHMARKS[name](adata)
+            # warm-up run, which also triggers compilation of numba kernels.
+            func()
+
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            try:
+                func()
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        results[name] = {"time": min(times), "peak_memory": peak_memory}
+    return results
+
+
+def compare(
+    results: Mapping[str, Mapping[str, float]],
+    baseline: Mapping[str, Mapping[str, float]],
+    threshold: float = 0.2,
+) -> List[str]:
+    """
+    Compare benchmark results against a baseline.
+
+    Returns
+    -------
+    A list of human-readable descriptions of all metrics that are more than
+    `threshold` (relative) worse than the baseline.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in metrics.items():
+            ref = baseline[name].get(metric)
+            if ref and value > ref * (1 + threshold):
+                regressions.append(
+                    f"{name}: {metric} {value:.4g} vs. baseline {ref:.4g} (+{value / ref - 1:.0%})"
+                )
+    return regressions
+
+
+def _metadata(scale: str, params: dict) -> dict:
+    from importlib.metadata import version
+
+    return {
+        "scale": scale,
+        "params": params,
+        "cpu_count": cpu_count(),
+        "python": platform.python_version(),
+        **{
+            pkg: version(pkg)
+            for pkg in ["numpy", "scipy", "pandas", "anndata", "scanpy", "numba"]
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Baseline JSON file to compare against")
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as new baseline instead of comparing against it",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative increase of time or memory that is considered a regression",
+    )
+    args = parser.parse_args(argv)
+
+    params = {**SCALES[args.scale], "density": args.density, "seed": args.seed}
+    print(f"Generating synthetic atlas ({params})...", file=sys.stderr)
+    adata = make_atlas(**params)
+
+    results = {
+        "meta": _metadata(args.scale, params),
+        "results": run_benchmarks(adata, args.only, repeat=args.repeat),
+    }
+
+    print(pd.DataFrame(results["results"]).T.to_string())
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        if args.save_baseline:
+            with open(args.baseline, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline["meta"]["params"] != params:
+                warnings.warn("Baseline was recorded with different parameters!")
+            regressions = compare(
+                results["results"], baseline["results"], threshold=args.threshold
+            )
+            for r in regressions:
+                print(f"REGRESSION {r}")
+            if regressions:
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""Generate synthetic single-cell data sets with the shape of the lung cancer atlas.
+
+The data is not meant to be biologically meaningful, but to reproduce the properties
+that matter for the runtime and memory usage of the helper functions:
+the size and sparsity of the count matrix and the cardinalities of, and the
+hierarchy between, the annotation columns (dataset > patient > sample, cell-type).
+"""
+
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from anndata import AnnData
+
+#: Presets for the size of the synthetic data. `atlas` resembles the full (extended) atlas.
+SCALES: Dict[str, dict] = {
+    "tiny": dict(n_obs=2_000, n_vars=500, n_datasets=4, n_patients=20, n_cell_types=8),
+    "small": dict(
+        n_obs=50_000, n_vars=2_000, n_datasets=10, n_patients=100, n_cell_types=20
+    ),
+    "medium": dict(
+        n_obs=300_000, n_vars=8_000, n_datasets=20, n_patients=300, n_cell_types=35
+    ),
+    "atlas": dict(
+        n_obs=1_200_000,
+        n_vars=18_000,
+        n_datasets=29,
+        n_patients=550,
+        n_cell_types=44,
+    ),
+}
+
+CONDITIONS = ["LUAD", "LSCC", "NSCLC"]
+ORIGINS = ["tumor_primary", "normal_adjacent", "tumor_metastasis"]
+
+
+def make_atlas(
+    *,
+    n_obs: int,
+    n_vars: int,
+    n_datasets: int,
+    n_patients: int,
+    n_cell_types: int,
+    density: float = 0.05,
+    specific_fraction: float = 0.2,
+    duplicate_fraction: float = 0.0,
+    seed: int = 0,
+) -> AnnData:
+    """
+    Generate an atlas-shaped anndata object with raw counts in `X` (CSR, float32).
+
+    Parameters
+    ----------
+    n_obs
+        number of cells
+    n_vars
+        number of genes
+    n_datasets
+        number of datasets. Each patient belongs to exactely one dataset.
+    n_patients
+        number of patients. Each patient has one to three samples of different origin.
+    n_cell_types
+        number of cell-types. Cell-type fractions vary between patients.
+    density
+        expected fraction of non-zero values in `X`
+    specific_fraction
+        fraction of the non-zero values of a cell that are drawn from a block of
+        genes that is specific for its cell-type.
+    duplicate_fraction
+        fraction of gene symbols that are duplicated (to benchmark deduplication).
+    seed
+        random seed
+
+    Returns
+    -------
+    Anndata object with the columns `dataset`, `patient`, `sample`, `origin`,
+    `condition`, `tumor_stage`, `sex`, `tissue` and `cell_type` in `obs`.
+    """
+    rng = np.random.default_rng(seed)
+
+    # patient-level annotations
+    patients = pd.DataFrame(
+        {
+            "patient": [f"P{i}" for i in range(n_patients)],
+            "dataset": [f"D{i}" for i in rng.integers(0, n_datasets, n_patients)],
+            "condition": rng.choice(CONDITIONS, n_patients),
+            "tumor_stage": rng.choice(["early", "advanced"], n_patients),
+            "sex": rng.choice(["male", "female"], n_patients),
+        }
+    )
+    # patients contribute different numbers of cells
+    patient_weights = rng.lognormal(sigma=0.7, size=n_patients)
+    cell_patient = rng.choice(
+        n_patients, n_obs, p=patient_weights / patient_weights.sum()
+    )
+    cell_origin = rng.choice(len(ORIGINS), n_obs, p=[0.6, 0.3, 0.1])
+
+    # patient-specific cell-type composition
+    ct_weights = rng.dirichlet(np.ones(n_cell_types) * 0.5, size=n_patients)
+    cell_ct = (
+        ct_weights.cumsum(axis=1)[cell_patient] > rng.random(n_obs)[:, np.newaxis]
+    ).argmax(axis=1)
+
+    obs = patients.iloc[cell_patient].reset_index(drop=True)
+    obs["origin"] = np.array(ORIGINS)[cell_origin]
+    obs["sample"] = [
+        f"{d}_{p}_{o}" for d, p, o in zip(obs["dataset"], obs["patient"], cell_origin)
+    ]
+    obs["tissue"] = "lung"
+    obs["cell_type"] = [f"ct{i}" for i in cell_ct]
+    for col in obs.columns:
+        obs[col] = pd.Categorical(obs[col])
+    obs.index = [f"cell{i}" for i in range(n_obs)]
+
+    X = _make_counts(
+        rng,
+        n_obs=n_obs,
+        n_vars=n_vars,
+        density=density,
+        groups=cell_ct,
+        n_groups=n_cell_types,
+        specific_fraction=specific_fraction,
+    )
+
+    var_names = np.array([f"GENE{i}" for i in range(n_vars)], dtype=object)
+    n_duplicated = int(n_vars * duplicate_fraction)
+    if n_duplicated:
+        dup_idx = rng.choice(n_vars, n_duplicated, replace=False)
+        var_names[dup_idx] = rng.choice(var_names, n_duplicated)
+
+    return AnnData(X=X, obs=obs, var=pd.DataFrame(index=var_names))
+
+
+def _make_counts(
+    rng, *, n_obs, n_vars, density, groups, n_groups, specific_fraction
+) -> scipy.sparse.csr_matrix:
+    """
+    Generate a sparse count matrix.
+
+    Genes are drawn from a skewed (log-normal) expression profile. A fraction
+    of the entries of each cell is drawn from a group-specific block of genes.
+    """
+    nnz_per_row = rng.poisson(n_vars * density, n_obs)
+    rows = np.repeat(np.arange(n_obs), nnz_per_row)
+    n_total = rows.shape[0]
+
+    gene_profile = rng.lognormal(sigma=1.5, size=n_vars)
+    cols = rng.choice(n_vars, n_total, p=gene_profile / gene_profile.sum())
+
+    block_size = max(n_vars // (2 * n_groups), 1)
+    specific = rng.random(n_total) < specific_fraction
+    cols[specific] = (groups[rows[specific]] * block_size) % n_vars + rng.integers(
+        0, block_size, np.sum(specific)
+    )
+
+    data = rng.geometric(0.4, n_total).astype(np.float32)
+    # duplicated entries are summed up
+    X = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n_obs, n_vars))
+    X.sum_duplicates()
+    return X
+
+
+def split_datasets(adata: AnnData) -> List[AnnData]:
+    """Split an atlas into one anndata object per dataset, as input for `merge_datasets`.
+
+    Each dataset is subset to a random 90% of the genes, such that the gene sets differ between datasets.
+    """
+    rng = np.random.default_rng(0)
+    datasets = []
+    for dataset in adata.obs["dataset"].cat.categories:
+        tmp_adata = adata[adata.obs["dataset"] == dataset, :]
+        var_mask = rng.random(adata.n_vars) < 0.9
+        tmp_adata = tmp_adata[:, var_mask].copy()
+        tmp_adata.X = tmp_adata.X.tocsr()
+        datasets.append(tmp_adata)
+    return datasets
@@ -3,6 +3,7 @@
 __version__ = "0.1.dev"
 
 from . import util
+from . import parallel
 from . import integration
 from . import compare_groups
 from . import pseudobulk
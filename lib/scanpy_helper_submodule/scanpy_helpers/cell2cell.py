@@ -43,20 +43,19 @@ class CpdbAnalysis:
         """Compute the mean expression and fraction of expressed cells per cell-type.
         This is performed on the pseudobulk level, i..e. the mean of means per patient is calculated.
         """
-        pb_fracs = pseudobulk(
+        pb = pseudobulk(
             adata,
             groupby=pseudobulk_group_by + [self.cell_type_column],
-            aggr_fun=lambda x, axis: np.sum(x > 0, axis) / x.shape[axis],  # type: ignore
+            stats=["frac_expressed"],
         )
         fractions_expressed = pseudobulk(
-            pb_fracs, groupby=self.cell_type_column, aggr_fun=np.mean
+            pb,
+            groupby=self.cell_type_column,
+            aggr_fun=np.mean,
+            layer="frac_expressed",
         )
         fractions_expressed.obs.set_index(self.cell_type_column, inplace=True)
 
-        pb = pseudobulk(
-            adata,
-            groupby=pseudobulk_group_by + [self.cell_type_column],
-        )
         sc.pp.normalize_total(pb, target_sum=1e6)
         sc.pp.log1p(pb)
         pb_mean_cell_type = pseudobulk(
@@ -4,15 +4,15 @@ This module contains high-level abstractions to linear models
 and functions to compare scores with different methods
 """
 
-from typing import List, Mapping, Optional, Sequence
+from typing import List, Mapping, Optional, Sequence, Union
 from . import lm
 from . import pl
 from . import compute_scores
 import numpy as np
 import pandas as pd
-from tqdm.contrib.concurrent import process_map
-import itertools
-from ..util import split_anndata, fdr_correction, log2_fc
+from functools import partial
+from ..util import fdr_correction, log2_fc
+from ..parallel import parallel_map
 from anndata import AnnData
 
 TOOLS = {
@@ -22,17 +22,26 @@ TOOLS = {
 }
 
 
-def _run_tool(adata, tools):
+def _run_tool(adata, tools, network_store=None):
     """Run a certain tool on an anndata object.
 
     Helper function executed in parallel on a chunked anndata object.
     """
+    kwargs = {} if network_store is None else {"network_store": network_store}
     res = {}
     for tool in tools:
-        res[tool] = TOOLS[tool](adata)
+        res[tool] = TOOLS[tool](adata, **kwargs)
     return res
 
 
+def _run_tool_obs_idx(adata, obs_idx, tools, network_store=None):
+    """Run a certain tool on a subset of observations of an anndata object.
+
+    Helper function executed in parallel with :func:`scanpy_helpers.parallel.parallel_map`.
+    """
+    return _run_tool(adata[obs_idx, :], tools, network_store)
+
+
 def prepare_dataset(
     id_: str,
     *,
@@ -41,6 +50,8 @@ def prepare_dataset(
     tools: Sequence[str] = ("progeny", "cytosig"),
     column_to_test: str,
     n_jobs: int = 1,
+    single_pass: bool = False,
+    network_store: Union[None, str, compute_scores.NetworkStore] = None,
     **kwargs,
 ) -> Mapping[str, Mapping[str, AnnData]]:
     """Split anndata by cell-type and run the different signature enrichment methods
@@ -58,7 +69,20 @@ def prepare_dataset(
     column_to_test
         Column containing the dependent variable
     n_jobs
-        Number of worker threads to use. Parallelizes by cell-type.
+        Number of worker processes to use. Parallelizes by cell-type.
+        Not used in `single_pass` mode.
+    single_pass
+        If True, compute the activities of all tools for all cells with a single sparse
+        matrix product and scale them per cell-type afterwards
+        (see :func:`~scanpy_helpers.compare_groups.compute_scores.score_networks_by_group`).
+        This gives the same results as running each tool on each cell-type, without
+        creating subsets of the dataset. Only applies if all `tools` are
+        network-based (`progeny`, `dorothea`, `cytosig`). Opt-in, such that the
+        tools are run with their default engine unless requested otherwise.
+    network_store
+        A :class:`~scanpy_helpers.compare_groups.compute_scores.NetworkStore` or the path
+        to a saved store with the networks aligned to `dataset.raw.var_names`.
+        Workers memory-map the store instead of loading and aligning the networks.
     **kwargs
         Not used, but allows to pass parameters via a config dictionary that contains additional parameters
 
@@ -82,19 +106,35 @@ def prepare_dataset(
         dataset.obs[column_to_test].astype(str)
     )
 
+    if single_pass and all(tool in compute_scores.NETWORKS for tool in tools):
+        print(f"\tScoring all cells and scaling by {cell_type_column}:")
+        return compute_scores.score_networks_by_group(
+            dataset,
+            {
+                tool: compute_scores._resolve_network(tool, dataset, network_store)
+                for tool in tools
+            },
+            groupby=cell_type_column,
+        )
+
+    # The dataset is shared with the workers once, tasks only contain the row indices
+    # of a cell-type. The rows of each cell-type are contiguous in `order`.
     print(f"\tSplitting anndata by {cell_type_column}:")
-    adata_by_cell_type = split_anndata(dataset, cell_type_column)
-    res_by_cell_type = process_map(
-        _run_tool,
-        adata_by_cell_type.values(),
-        itertools.repeat(tools),
-        max_workers=n_jobs,
+    cell_types = dataset.obs[cell_type_column].unique()
+    codes = pd.Categorical(dataset.obs[cell_type_column], categories=cell_types).codes
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(1, len(cell_types)))
+    res_by_cell_type = parallel_map(
+        partial(_run_tool_obs_idx, tools=tools, network_store=network_store),
+        np.split(order, bounds),
+        shared=dataset,
+        n_jobs=n_jobs,
     )
 
     all_adatas = {}
     for tool in tools:
         all_adatas[tool] = {}
-        for ct, tmp_res in zip(adata_by_cell_type, res_by_cell_type):
+        for ct, tmp_res in zip(cell_types, res_by_cell_type):
             all_adatas[tool][ct] = tmp_res[tool]
 
     return all_adatas
@@ -137,6 +177,8 @@ def compare_signatures(
     """
     print(f"Performing comparison for {id_}:")
     all_results = {}
+    # the pseudobulk samples are the same for all tools, therefore the design matrices can be reused.
+    design_cache = lm.DesignCache()
     for tool in all_adatas:
         print(f"\tRunning tests for {tool}:")
         tmp_res = lm.lm_test_all(
@@ -146,6 +188,7 @@ def compare_signatures(
             lm_covariate_str=lm_covariate_str,
             contrasts=contrasts,
             n_jobs=n_jobs,
+            design_cache=design_cache,
         )
         all_results[tool] = tmp_res
 
@@ -1,11 +1,24 @@
 """Run dorothea, progeny and cytosig with parameters suitable for between-sample comparisons.
 
 In particular, permutation tests are not necessary, as we perform statistics on the sample-level.
+
+:func:`score_network` follows the scoring steps of `progeny.run`/`dorothea.run` (without
+permutations), but works directly on the sparse expression matrix. The `run_*` functions use it with
+`engine="sparse"` or when a precompiled network store is passed; by default, they run the
+original implementations (`engine="external"`).
 """
 
 from functools import lru_cache
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
 from ..util import suppress_stdout
+import hashlib
+import os
+import struct
+import zipfile
+import numpy as np
 import pandas as pd
+import scipy.sparse
+from anndata import AnnData
 from .. import assets
 import importlib.resources as pkg_resources
 
@@ -42,8 +55,511 @@ def _cytosig_model():
     )
 
 
+class AlignedNetwork(NamedTuple):
+    """A network aligned to the genes of a dataset, see :func:`_align_network`"""
+
+    weights: scipy.sparse.csr_matrix
+    in_network: np.ndarray
+    sources: pd.Index
+
+
+def _align_network(
+    network: pd.DataFrame, var_names: pd.Index, *, min_size: int = 5
+) -> AlignedNetwork:
+    """
+    Align a network (genes x sources data frame of weights) to the genes of a dataset.
+
+    Returns
+    -------
+    weights
+        sparse `len(var_names) x n_sources` weight matrix. Rows of genes that are not
+        part of the network are empty.
+    in_network
+        boolean mask of `var_names` that are part of the network
+    sources
+        names of the sources with at least `min_size` targets in the dataset
+    """
+    network = network[network.index.isin(var_names)]
+    n_targets = np.sum(network.values != 0, axis=0)
+    network = network.loc[:, n_targets >= min_size]
+    gene_idx = var_names.get_indexer(network.index)
+    rows, cols = np.nonzero(network.values)
+    weights = scipy.sparse.csr_matrix(
+        (network.values[rows, cols], (gene_idx[rows], cols)),
+        shape=(len(var_names), network.shape[1]),
+    )
+    in_network = np.zeros(len(var_names), dtype=bool)
+    in_network[gene_idx] = True
+    return AlignedNetwork(weights, in_network, network.columns)
+
+
+def _get_aligned(
+    network: Union[pd.DataFrame, AlignedNetwork], var_names: pd.Index, min_size: int
+) -> AlignedNetwork:
+    if isinstance(network, AlignedNetwork):
+        if network.weights.shape[0] != len(var_names):
+            raise ValueError("The network is not aligned to the genes of the dataset.")
+        return network
+    return _align_network(network, var_names, min_size=min_size)
+
+
+def _activities(
+    X,
+    networks: Sequence[Tuple[scipy.sparse.csr_matrix, np.ndarray]],
+    *,
+    center: bool,
+    norm: bool,
+) -> List[np.ndarray]:
+    """
+    Compute unscaled activities for multiple networks aligned with :func:`_align_network`.
+
+    The weights of all networks are concatenated, such that the expression matrix
+    is only multiplied once.
+    """
+    estimate = X @ scipy.sparse.hstack([w for w, _ in networks], format="csr")
+    estimate = np.asarray(
+        estimate.toarray() if scipy.sparse.issparse(estimate) else estimate,
+        dtype=np.float64,
+    )
+    if center:
+        # mean expression of each cell over the genes of each network
+        in_network = np.column_stack([m for _, m in networks]).astype(np.float64)
+        cell_means = np.asarray(X @ in_network) / np.sum(in_network, axis=0)
+    bounds = np.cumsum([0] + [w.shape[1] for w, _ in networks])
+    results = []
+    for i, (weights, _) in enumerate(networks):
+        tmp_estimate = estimate[:, bounds[i] : bounds[i + 1]]
+        if center:
+            tmp_estimate -= np.outer(
+                cell_means[:, i], np.asarray(weights.sum(axis=0)).ravel()
+            )
+        if norm:
+            abs_sum = np.asarray(abs(weights).sum(axis=0)).ravel()
+            abs_sum[abs_sum == 0] = 1
+            tmp_estimate /= abs_sum
+        results.append(tmp_estimate)
+    return results
+
+
+def _scale(estimate: np.ndarray) -> np.ndarray:
+    """Scale activities per source"""
+    std = np.std(estimate, axis=0, ddof=1)
+    std[~(std > 0)] = 1
+    return (estimate - np.mean(estimate, axis=0)) / std
+
+
+def score_network(
+    adata: AnnData,
+    network: Union[pd.DataFrame, AlignedNetwork],
+    *,
+    center: bool = True,
+    norm: bool = True,
+    scale: bool = True,
+    use_raw: bool = True,
+    min_size: int = 5,
+    obsm_key: str = "estimate",
+) -> AnnData:
+    """
+    Compute activities of the sources of a network (e.g. pathways, TFs or cytokines)
+    as weighted sum of the expression of their targets.
+
+    Follows the steps of `progeny.run` and `dorothea.run` followed by `extract`
+    (with `num_perm=0`), but works directly on the sparse expression matrix. Centering
+    of the expression by the mean per cell is applied to the product instead of the
+    expression matrix, i.e. `(X - m) @ W = X @ W - m @ colsum(W)`, such that the
+    expression matrix is neither copied nor densified.
+
+    Parameters
+    ----------
+    adata
+        AnnData object with log-normalized expression
+    network
+        genes x sources data frame with weights, or a network that is already aligned
+        to the genes of `adata` (see :class:`NetworkStore`)
+    center
+        Center gene expression by mean per cell (computed over the genes in the network)
+    norm
+        Normalize by the sum of absolute weights to correct for large regulons
+    scale
+        Scale values per source so that values can be compared across cells
+    use_raw
+        Use `adata.raw`
+    min_size
+        Sources with less than `min_size` targets in the dataset are ignored
+    obsm_key
+        The activities are additionally stored as data frame in `.obsm[obsm_key]`
+        of the result
+
+    Returns
+    -------
+    AnnData object with cells x sources
+    """
+    X, var_names = (
+        (adata.raw.X, adata.raw.var_names) if use_raw else (adata.X, adata.var_names)
+    )
+    weights, in_network, sources = _get_aligned(network, var_names, min_size)
+    (estimate,) = _activities(X, [(weights, in_network)], center=center, norm=norm)
+    if scale:
+        estimate = _scale(estimate)
+
+    obsm = dict(adata.obsm)
+    obsm[obsm_key] = pd.DataFrame(estimate, index=adata.obs_names, columns=sources)
+    return AnnData(
+        X=estimate,
+        obs=adata.obs.copy(),
+        var=pd.DataFrame(index=sources),
+        uns=dict(adata.uns),
+        obsm=obsm,
+    )
+
+
+def score_networks_by_group(
+    adata: AnnData,
+    networks: Mapping[str, Union[pd.DataFrame, AlignedNetwork]],
+    groupby: str,
+    *,
+    center: bool = True,
+    norm: bool = True,
+    scale: bool = True,
+    use_raw: bool = True,
+    min_size: int = 5,
+) -> Dict[str, Dict[str, AnnData]]:
+    """
+    Score multiple networks and split the result by a column in `obs`.
+
+    Equivalent to running :func:`score_network` with each network on each subset of
+    `adata`, but the activities of all cells and all networks are computed with
+    a single sparse matrix product. Centering and normalization are per cell and
+    therefore independent of the split. Only the scaling depends on the subset;
+    it is applied afterwards using the mean and standard deviation of each group.
+
+    Parameters
+    ----------
+    adata
+        AnnData object with log-normalized expression
+    networks
+        Dictionary network name -> genes x sources data frame with weights (or
+        aligned network, see :class:`NetworkStore`). The network name is used as `obsm_key`.
+    groupby
+        Column in `adata.obs` to split by (e.g. cell-type)
+    center, norm, scale, use_raw, min_size
+        See :func:`score_network`
+
+    Returns
+    -------
+    Dictionary [network name : (Dictionary [group : anndata])]
+    """
+    X, var_names = (
+        (adata.raw.X, adata.raw.var_names) if use_raw else (adata.X, adata.var_names)
+    )
+    aligned = {
+        key: _get_aligned(network, var_names, min_size)
+        for key, network in networks.items()
+    }
+    estimates = _activities(
+        X, [(w, m) for w, m, _ in aligned.values()], center=center, norm=norm
+    )
+
+    groups = adata.obs[groupby].unique()
+    codes = pd.Categorical(adata.obs[groupby], categories=groups).codes
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+    n_obs = np.diff(bounds)[:, np.newaxis]
+
+    res = {}
+    for key, estimate, (_, _, sources) in zip(aligned, estimates, aligned.values()):
+        estimate = estimate[order]
+        if scale:
+            # moments of each group (two-pass for numerical stability)
+            mean = np.add.reduceat(estimate, bounds[:-1], axis=0) / n_obs
+            estimate -= np.repeat(mean, n_obs.ravel(), axis=0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                std = np.sqrt(
+                    np.add.reduceat(estimate**2, bounds[:-1], axis=0) / (n_obs - 1)
+                )
+            std[~(std > 0) | ~np.isfinite(std)] = 1
+            estimate /= np.repeat(std, n_obs.ravel(), axis=0)
+
+        res[key] = {}
+        for i, group in enumerate(groups):
+            idx = order[bounds[i] : bounds[i + 1]]
+            tmp_estimate = estimate[bounds[i] : bounds[i + 1]]
+            obs_names = adata.obs_names[idx]
+            obsm = {
+                k: v.iloc[idx] if isinstance(v, pd.DataFrame) else v[idx]
+                for k, v in adata.obsm.items()
+            }
+            obsm[key] = pd.DataFrame(tmp_estimate, index=obs_names, columns=sources)
+            res[key][group] = AnnData(
+                X=tmp_estimate,
+                obs=adata.obs.iloc[idx].copy(),
+                var=pd.DataFrame(index=sources),
+                uns=dict(adata.uns),
+                obsm=obsm,
+            )
+    return res
+
+
+#: Loaders of the networks used by :func:`run_progeny`, :func:`run_dorothea` and :func:`run_cytosig`
+NETWORKS = {
+    "progeny": _progeny_model,
+    "dorothea": _dorothea_model,
+    "cytosig": _cytosig_model,
+}
+
+
+def _fingerprint(var_names: Sequence[str]) -> str:
+    """Hash of the gene universe a network store has been compiled for"""
+    return hashlib.sha1("\0".join(var_names).encode()).hexdigest()
+
+
+class NetworkStore:
+    """
+    Networks compiled into sparse weight matrices that are aligned to a fixed set of genes.
+
+    Aligning the networks (e.g. ~20k genes x ~300 TFs for dorothea) to the genes of
+    a dataset only depends on the genes. The store is compiled once for the
+    `var_names` of an atlas and saved as uncompressed `.npz` file together with a
+    fingerprint of the genes. Loading memory-maps the arrays, such that all
+    worker processes share the same pages and loading takes milliseconds.
+    Stores loaded from a file are pickled by path.
+
+    Examples
+    --------
+    >>> store = NetworkStore.compile(adata.raw.var_names, ["progeny", "dorothea"])
+    >>> store.save("networks.npz")
+    >>> prepare_dataset(..., network_store="networks.npz")
+    """
+
+    def __init__(
+        self,
+        networks: Mapping[str, AlignedNetwork],
+        fingerprint: str,
+        *,
+        min_size: int,
+        path: Optional[str] = None,
+    ):
+        self.networks = dict(networks)
+        self.fingerprint = fingerprint
+        self.min_size = min_size
+        self.path = path
+
+    @classmethod
+    def compile(
+        cls,
+        var_names: Sequence[str],
+        networks: Union[Sequence[str], Mapping[str, pd.DataFrame]] = tuple(NETWORKS),
+        *,
+        min_size: int = 5,
+    ) -> "NetworkStore":
+        """
+        Align networks to genes.
+
+        Parameters
+        ----------
+        var_names
+            The genes of the dataset (`adata.raw.var_names`)
+        networks
+            Names of networks in :data:`NETWORKS` or dictionary name -> genes x sources data frame
+        min_size
+            Sources with less than `min_size` targets are ignored
+        """
+        var_names = pd.Index(var_names)
+        if not isinstance(networks, Mapping):
+            networks = {key: NETWORKS[key]() for key in networks}
+        return cls(
+            {
+                key: _align_network(network, var_names, min_size=min_size)
+                for key, network in networks.items()
+            },
+            _fingerprint(var_names),
+            min_size=min_size,
+        )
+
+    def save(self, path):
+        """Save the store to an (uncompressed) `.npz` file"""
+        arrays = {
+            "__fingerprint__": np.array(self.fingerprint),
+            "__min_size__": np.array(self.min_size),
+        }
+        for key, (weights, in_network, sources) in self.networks.items():
+            arrays[f"{key}.data"] = weights.data
+            arrays[f"{key}.indices"] = weights.indices
+            arrays[f"{key}.indptr"] = weights.indptr
+            arrays[f"{key}.in_network"] = in_network
+            arrays[f"{key}.sources"] = np.asarray(sources, dtype=str)
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+        self.path = str(path)
+
+    @classmethod
+    def load(cls, path, *, mmap: bool = True) -> "NetworkStore":
+        """Load a store from a `.npz` file. Arrays are memory-mapped if `mmap` is True."""
+        if mmap:
+            arrays = _load_npz_mmap(path)
+        else:
+            with np.load(path) as f:
+                arrays = dict(f)
+        keys = [k[: -len(".sources")] for k in arrays if k.endswith(".sources")]
+        networks = {}
+        for key in keys:
+            in_network = arrays[f"{key}.in_network"]
+            sources = pd.Index(arrays[f"{key}.sources"])
+            networks[key] = AlignedNetwork(
+                scipy.sparse.csr_matrix(
+                    (
+                        arrays[f"{key}.data"],
+                        arrays[f"{key}.indices"],
+                        arrays[f"{key}.indptr"],
+                    ),
+                    shape=(len(in_network), len(sources)),
+                    copy=False,
+                ),
+                in_network,
+                sources,
+            )
+        return cls(
+            networks,
+            str(arrays["__fingerprint__"]),
+            min_size=int(arrays["__min_size__"]),
+            path=str(path),
+        )
+
+    def get(self, key: str, var_names: Sequence[str]) -> AlignedNetwork:
+        """Get a network. Raises a `ValueError` if the store has been compiled for different genes."""
+        if _fingerprint(var_names) != self.fingerprint:
+            raise ValueError(
+                "The network store has been compiled for a different set of genes."
+            )
+        return self.networks[key]
+
+    def __contains__(self, key):
+        return key in self.networks
+
+    def __reduce__(self):
+        if self.path is not None:
+            return (load_network_store, (self.path,))
+        return super().__reduce__()
+
+
+def _load_npz_mmap(path) -> Dict[str, np.ndarray]:
+    """
+    Memory-map the arrays of an uncompressed `.npz` file.
+
+    `np.load` ignores `mmap_mode` for `.npz` files. Since members of uncompressed
+    zip files are stored contiguously, they can be mapped directly at their offset.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zf.open(info))
+                continue
+            # skip the local file header
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or not np.prod(shape):
+                f.seek(info.header_offset + 30 + name_len + extra_len)
+                arrays[name] = np.lib.format.read_array(f)
+            else:
+                arrays[name] = np.memmap(
+                    f,
+                    dtype=dtype,
+                    mode="r",
+                    offset=f.tell(),
+                    shape=shape,
+                    order="F" if fortran_order else "C",
+                )
+    return arrays
+
+
+@lru_cache(maxsize=4)
+def _load_network_store_cached(path: str, mtime: float) -> NetworkStore:
+    return NetworkStore.load(path)
+
+
+def load_network_store(path) -> NetworkStore:
+    """Load a :class:`NetworkStore`. Stores are cached per process and file version."""
+    path = os.path.abspath(path)
+    return _load_network_store_cached(path, os.path.getmtime(path))
+
+
+def _resolve_network(
+    key: str, adata: AnnData, network_store: Union[None, str, NetworkStore]
+) -> Union[pd.DataFrame, AlignedNetwork]:
+    if network_store is None:
+        return NETWORKS[key]()
+    if not isinstance(network_store, NetworkStore):
+        network_store = load_network_store(network_store)
+    return network_store.get(key, adata.raw.var_names)
+
+
+def run_progeny(adata, *, engine: Optional[str] = None, network_store=None):
+    """Run progeny. `engine` is either `sparse` (see :func:`score_network`) or `external`.
+
+    Pass a :class:`NetworkStore` (or the path to it) as `network_store` to use precompiled
+    weights. The engine defaults to `sparse` if a store is given and to `external` otherwise.
+    """
+    if _engine(engine, network_store) == "sparse":
+        return score_network(
+            adata,
+            _resolve_network("progeny", adata, network_store),
+            obsm_key="progeny",
+        )
+    return _run_progeny_external(adata)
+
+
+def run_dorothea(adata, *, engine: Optional[str] = None, network_store=None):
+    """Run dorothea. `engine` is either `sparse` (see :func:`score_network`) or `external`.
+
+    Pass a :class:`NetworkStore` (or the path to it) as `network_store` to use precompiled
+    weights. The engine defaults to `sparse` if a store is given and to `external` otherwise.
+    """
+    if _engine(engine, network_store) == "sparse":
+        return score_network(
+            adata,
+            _resolve_network("dorothea", adata, network_store),
+            obsm_key="dorothea",
+        )
+    return _run_dorothea_external(adata)
+
+
+def run_cytosig(adata, *, engine: Optional[str] = None, network_store=None):
+    """Run cytosig.
+
+    The algorithm in dorothea-py gives the same results as the original implementation (it's a simple matrix multiplication)
+    and is a lot faster. `engine` is either `sparse` (see :func:`score_network`) or `external`.
+    Pass a :class:`NetworkStore` (or the path to it) as `network_store` to use precompiled
+    weights. The engine defaults to `sparse` if a store is given and to `external` otherwise.
+    """
+    if _engine(engine, network_store) == "sparse":
+        return score_network(
+            adata,
+            _resolve_network("cytosig", adata, network_store),
+            obsm_key="cytosig",
+        )
+    return _run_cytosig_external(adata)
+
+
+def _engine(engine: Optional[str], network_store) -> str:
+    if engine is None:
+        return "external" if network_store is None else "sparse"
+    if engine not in ("sparse", "external"):
+        raise ValueError(f"Unknown engine: {engine}")
+    if engine == "external" and network_store is not None:
+        raise ValueError("A network store can only be used with `engine='sparse'`.")
+    return engine
+
+
 @suppress_stdout
-def run_progeny(adata):
+def _run_progeny_external(adata):
     import progeny
 
     tmp_adata = adata.copy()
@@ -62,7 +578,7 @@ def run_progeny(adata):
 
 
 @suppress_stdout
-def run_dorothea(adata):
+def _run_dorothea_external(adata):
     import dorothea
 
     tmp_adata = adata.copy()
@@ -80,12 +596,7 @@ def run_dorothea(adata):
 
 
 @suppress_stdout
-def run_cytosig(adata):
-    """Run cytosig.
-
-    The algorithm in dorothea-py gives the same results as the original implementation (it's a simple matrix multiplication)
-    and is a lot faster.
-    """
+def _run_cytosig_external(adata):
     import progeny
 
     tmp_adata = adata.copy()
@@ -1,24 +1,32 @@
 """High-level wrappers around linear models to find differences between groups. """
 
 
-from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
 from unittest.util import strclass
 import warnings
 import pandas as pd
 from patsy import PatsyError
 from tqdm.auto import tqdm
 import statsmodels.formula.api as smf
-from tqdm.contrib.concurrent import process_map
 import re
 from anndata import AnnData
 from ..pseudobulk import pseudobulk
 import numpy as np
 import pandas as pd
-from ..util import chunk_adatas, fdr_correction
+from ..parallel import parallel_map
+from ..results import ResultTable, concat_results
+from ..util import _factorize
+from functools import partial
 import itertools
 from multiprocessing import cpu_count
 from threadpoolctl import threadpool_limits
 from statsmodels.regression.linear_model import RegressionResultsWrapper
+import patsy
+import hashlib
+from collections import OrderedDict
+import scipy.linalg
+import scipy.stats
+import scipy.special
 
 
 def lm_test_all(
@@ -29,8 +37,9 @@ def lm_test_all(
     contrasts: str = "Sum",
     lm_covariate_str: str = "",
     min_categories: int = 2,
+    as_table: bool = False,
     **kwargs,
-) -> Optional[pd.DataFrame]:
+) -> Union[pd.DataFrame, ResultTable]:
     """High-level function to compare groups multiple single cell objects.
 
     Performs pseudobulk aggregation and a statistical test with linear model
@@ -52,33 +61,148 @@ def lm_test_all(
         E.g. `+ dataset`.
     min_categories
         Only perform test if there are at least `min_categories` unique entries in `column_to_test`.
+    as_table
+        If True, return a :class:`~scanpy_helpers.results.ResultTable` instead of a data frame,
+        e.g. to write the results to parquet.
+    **kwargs
+        Passed to :func:`test_lm`. `n_jobs` and `chunksize` are used to distribute
+        chunks of variables of all cell-types onto a single pool of workers.
+        Pass a :class:`DesignCache` as `design_cache` to reuse the design matrices across calls.
 
     Returns
     -------
-    Data frame with coefficients and pvalues.
+    Data frame with coefficients and pvalues, sorted by pvalue. `variable`, `group` and
+    `cell_type` are categorical columns.
     """
-    res_list = []
-    for ct, tmp_adata in tqdm(adatas.items()):
+    chunksize = kwargs.pop("chunksize", 200)
+    n_jobs = kwargs.pop("n_jobs", None)
+    design_cache = kwargs.pop("design_cache", None)
+    if design_cache is None:
+        design_cache = DesignCache()
+    formula = f"~ C({column_to_test}, {contrasts}) {lm_covariate_str}"
+
+    pseudobulks = {}
+    for ct, tmp_adata in adatas.items():
         tmp_bdata = pseudobulk(
             tmp_adata,
             groupby=groupby + [column_to_test],
             aggr_fun=np.mean,
         )
         if tmp_bdata.obs[column_to_test].nunique() >= min_categories:
+            pseudobulks[ct] = tmp_bdata
+
+    # Build the design matrices once. They are shared with the workers along with the
+    # pseudobulks and reused by all chunks of a cell-type (and across calls, if a
+    # `design_cache` is passed).
+    if kwargs.get("engine", "batched") == "batched":
+        for tmp_bdata in pseudobulks.values():
+            tmp_bdata.obs[column_to_test] = pd.Categorical(
+                tmp_bdata.obs[column_to_test]
+            )
             try:
-                tmp_res = test_lm(
-                    tmp_bdata,
-                    f"~ C({column_to_test}, {contrasts}) {lm_covariate_str}",
-                    column_to_test,
+                design_cache.get(
+                    tmp_bdata.obs,
+                    formula=formula,
+                    groupby=column_to_test,
                     contrasts=contrasts,
-                    progress=False,
-                    **kwargs,
                 )
-                res_list.append(tmp_res.assign(cell_type=ct))
-            except PatsyError as e:
-                warnings.warn(f"Iteration on {ct} failed with {e}. Ignoring error. ")
+            except PatsyError:
+                # will be reported by the worker
+                pass
+
+    # Split the tests into work items of (cell-type, range of variables) and submit the
+    # largest ones first. Like that, all workers are busy until the end, even if
+    # there are only few variables per cell-type.
+    work_items = [
+        (ct, i, i + chunksize)
+        for ct, tmp_bdata in pseudobulks.items()
+        for i in range(0, tmp_bdata.n_vars, chunksize)
+    ]
+    order = sorted(
+        range(len(work_items)),
+        key=lambda j: -_work_item_size(pseudobulks, work_items[j]),
+    )
+    results = parallel_map(
+        partial(
+            _lm_test_work_item,
+            formula=formula,
+            column_to_test=column_to_test,
+            contrasts=contrasts,
+            **kwargs,
+        ),
+        [work_items[j] for j in order],
+        shared=(pseudobulks, design_cache),
+        n_jobs=n_jobs,
+    )
+    # restore the order of cell-types and variables
+    results = [res for _, res in sorted(zip(order, results))]
+
+    # Collect the results of all cell-types in a columnar table to avoid building
+    # (and concatenating) large data frames with object columns.
+    table = ResultTable(sum(res.shape[0] for res, _ in results if res is not None))
+    failed = set()
+    for ct, ct_results in itertools.groupby(
+        zip(work_items, results), key=lambda x: x[0][0]
+    ):
+        ct_res_list = []
+        for _, (tmp_res, error) in ct_results:
+            if error is not None:
+                if ct not in failed:
+                    warnings.warn(
+                        f"Iteration on {ct} failed with {error}. Ignoring error. "
+                    )
+                failed.add(ct)
+            else:
+                ct_res_list.append(tmp_res)
+        if kwargs.get("ebayes", False) and len(ct_res_list):
+            # the prior needs to be estimated from all variables of a cell-type, not per chunk
+            ct_res_list = [ebayes(concat_results(ct_res_list))]
+        table.extend(ct_res_list, cell_type=ct)
 
-    return pd.concat(res_list).pipe(fdr_correction).sort_values("pvalue")
+    if not len(table):
+        raise ValueError("No results. All tests failed.")
+    table.fdr_correction()
+    if kwargs.get("ebayes", False):
+        table.fdr_correction("pvalue_moderated", key_added="fdr_moderated")
+    if as_table:
+        return table
+    return table.to_df().sort_values("pvalue")
+
+
+def _work_item_size(pseudobulks: Mapping[str, AnnData], item) -> int:
+    """Estimate the cost of a work item of :func:`lm_test_all`"""
+    ct, start, stop = item
+    return pseudobulks[ct].n_obs * (min(stop, pseudobulks[ct].n_vars) - start)
+
+
+def _lm_test_work_item(
+    shared: Tuple[Mapping[str, AnnData], "DesignCache"],
+    item: Tuple[str, int, int],
+    *,
+    formula: str,
+    column_to_test: str,
+    **kwargs,
+) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """Test a range of variables of a single cell-type. Executed in parallel by :func:`lm_test_all`.
+
+    Returns the result data frame, or an error message if the model could not be built.
+    """
+    pseudobulks, design_cache = shared
+    ct, start, stop = item
+    try:
+        with threadpool_limits(1):
+            tmp_res = test_lm(
+                pseudobulks[ct][:, start:stop].copy(),
+                formula,
+                column_to_test,
+                progress=False,
+                n_jobs=1,
+                design_cache=design_cache,
+                **kwargs,
+            )
+        return tmp_res, None
+    except PatsyError as e:
+        return None, str(e)
 
 
 def test_lm(
@@ -90,7 +214,14 @@ def test_lm(
     robust: bool = False,
     progress: bool = True,
     n_jobs: int = None,
-    chunksize=200,
+    chunksize: Optional[int] = None,
+    engine: str = "batched",
+    design_cache: Optional["DesignCache"] = None,
+    n_permutations: int = 0,
+    permutation_strata: Optional[str] = None,
+    random_state: int = 0,
+    random_effect: Optional[str] = None,
+    ebayes: bool = False,
 ):
     """
     Use a linear model to find differences between groups
@@ -112,19 +243,81 @@ def test_lm(
         HC3 has been shown to be superior over the default HC1 in http://datacolada.org/99.
         See also: https://www.statsmodels.org/devel/generated/statsmodels.regression.linear_model.OLSResults.get_robustcov_results.html
     progress
-        Show the tqdm progress bar
+        Show the tqdm progress bar. The `batched` engine shows it for the permutations
+        and for variables that are fitted separately because of non-finite values.
     n_jobs
-        Run test in parallel. Set to 1 to disable parallelism.
+        Run test in parallel. Set to 1 to disable parallelism. The `statsmodels` engine
+        uses `n_jobs` processes, the `batched` engine limits the number of BLAS threads
+        to `n_jobs`.
     chunksize
         Splits up anndata in chunks of var and processes chunks in parallel.
+        Defaults to 200. Only used by the `statsmodels` engine.
+    engine
+        `batched` builds the design matrix once and fits all variables at once with
+        a single QR decomposition. `statsmodels` fits a separate statsmodels model
+        for each variable (slow, kept as reference implementation).
+    design_cache
+        A :class:`DesignCache` to reuse design matrices between calls with the same
+        `obs`, formula and contrasts. Only used by the `batched` engine.
+    n_permutations
+        If > 0, additionally compute empirical pvalues (column `pvalue_perm`) from
+        `n_permutations` permutations of the groups. See :func:`_permutation_test`.
+        Only supported by the `batched` engine.
+    permutation_strata
+        Column in obs. If specified, groups are only permuted within the strata
+        defined by this column (e.g. `dataset`).
+    random_state
+        Seed for generating the permutations
+    random_effect
+        Column in obs. If specified, fit a linear mixed model with a random intercept
+        for each level of this column (e.g. `dataset`) instead of an ordinary linear model.
+        Variance components are estimated with REML for each variable. Pvalues are computed
+        with Wald z-tests using the covariance (X'V^-1X)^-1 of the fixed effects.
+        See :func:`_mixed_model_batched`.
+        Only supported by the `batched` engine, and not in combination with `robust`
+        or `n_permutations`.
+    ebayes
+        If true, additionally compute limma-style moderated t-statistics and pvalues
+        (columns `t_moderated`, `pvalue_moderated`), see :func:`ebayes`.
+        Only supported by the `batched` engine with an ordinary linear model.
 
     Returns
     -------
     Pandas data frame with coefficients and pvalues
 
     """
+    if engine == "batched":
+        if chunksize is not None:
+            warnings.warn(
+                "`chunksize` is only used by the statsmodels engine. The batched engine "
+                "fits all variables at once."
+            )
+        with threadpool_limits(n_jobs):
+            return _test_lm_batched(
+                pseudobulk,
+                formula,
+                groupby,
+                contrasts=contrasts,
+                robust=robust,
+                design_cache=design_cache,
+                n_permutations=n_permutations,
+                permutation_strata=permutation_strata,
+                random_state=random_state,
+                random_effect=random_effect,
+                moderated=ebayes,
+                progress=progress,
+            )
+    elif engine not in ["batched", "statsmodels"]:
+        raise ValueError(f"Unsupported engine: {engine}!")
+    elif n_permutations or random_effect is not None or ebayes:
+        raise ValueError(
+            "Permutation tests, mixed models and ebayes are only supported by the batched engine!"
+        )
+
     if n_jobs is None:
         n_jobs = cpu_count()
+    if chunksize is None:
+        chunksize = 200
 
     # likely overhead is larger until several times chunksize. Exact optimum not tested.
     if pseudobulk.shape[1] < chunksize * 2 or n_jobs == 1:
@@ -137,20 +330,76 @@ def test_lm(
             progress=progress,
         )
     else:
-        return pd.concat(
-            process_map(
-                _test_lm,
-                list(chunk_adatas(pseudobulk, chunksize=chunksize)),
-                itertools.repeat(formula),
-                itertools.repeat(groupby),
-                itertools.repeat(contrasts),
-                itertools.repeat(False),
-                itertools.repeat(robust),
-                max_workers=n_jobs,
+        # the pseudobulk is shared with the workers once, tasks only contain ranges of variables
+        return concat_results(
+            parallel_map(
+                partial(
+                    _test_lm_var_range,
+                    formula=formula,
+                    groupby=groupby,
+                    contrasts=contrasts,
+                    robust=robust,
+                ),
+                [(i, i + chunksize) for i in range(0, pseudobulk.shape[1], chunksize)],
+                shared=pseudobulk,
+                n_jobs=n_jobs,
             )
         )
 
 
+def _test_lm_var_range(
+    pseudobulk: AnnData,
+    var_range: Tuple[int, int],
+    *,
+    formula: str,
+    groupby: str,
+    contrasts: str,
+    robust: bool,
+) -> pd.DataFrame:
+    """Run :func:`_test_lm` on a range of variables. Executed in parallel with :func:`parallel_map`."""
+    return _test_lm(
+        pseudobulk[:, slice(*var_range)].copy(),
+        formula,
+        groupby,
+        contrasts,
+        robust=robust,
+    )
+
+
+def _contrast_keys(
+    *, groupby: str, all_groups: Sequence[str], contrasts: str
+) -> Tuple[str, List[str]]:
+    """
+    Get the contrast mode and the names of the model parameters of the groups to test.
+
+    Returns
+    -------
+    contrasts_mode
+        Either `sum-to-zero` or `treatment-coding`
+    keys
+        Parameter names as they are used in the linear model results data frame.
+        In sum-to-zero mode, the last key refers to the omitted level.
+    """
+    if contrasts.startswith("Sum"):
+        contrasts_mode = "sum-to-zero"
+    elif contrasts.startswith("Treatment"):
+        contrasts_mode = "treatment-coding"
+    else:
+        raise ValueError(f"Unsupported contrast type: {contrasts}!")
+
+    # in case of treatment coding, we do not want to include the baseline level.
+    groups_to_test = (
+        all_groups
+        if contrasts_mode == "sum-to-zero"
+        # the contrast should look like `Treatment("something")`
+        else [g for g in all_groups if f"{g}" not in contrasts.replace("Treatment", "")]
+    )
+    assert "nan" not in groups_to_test
+
+    keys = [f"C({groupby}, {contrasts})[{contrasts[0]}.{g}]" for g in groups_to_test]
+    return contrasts_mode, keys
+
+
 def _test_all_params(
     res, *, groupby: str, all_groups: Sequence[str], contrasts: str
 ) -> Tuple[Dict, Dict, Dict]:
@@ -182,24 +431,9 @@ def _test_all_params(
     intercept
         Dictionary mapping keys from the linear model summary data frame onto linear model intercepts
     """
-    if contrasts.startswith("Sum"):
-        contrasts_mode = "sum-to-zero"
-    elif contrasts.startswith("Treatment"):
-        contrasts_mode = "treatment-coding"
-    else:
-        raise ValueError(f"Unsupported contrast type: {contrasts}!")
-
-    # in case of treatment coding, we do not want to include the baseline level.
-    groups_to_test = (
-        all_groups
-        if contrasts_mode == "sum-to-zero"
-        # the contrast should look like `Treatment("something")`
-        else [g for g in all_groups if f"{g}" not in contrasts.replace("Treatment", "")]
+    contrasts_mode, keys = _contrast_keys(
+        groupby=groupby, all_groups=all_groups, contrasts=contrasts
     )
-    assert "nan" not in groups_to_test
-
-    # Generate keys as they are used in the linear model results data frame
-    keys = [f"C({groupby}, {contrasts})[{contrasts[0]}.{g}]" for g in groups_to_test]
 
     intercept = res.params["Intercept"]
 
@@ -243,9 +477,10 @@ def _test_lm(
     # only using the categories (rather than just .unique() gets rid of nans)
     all_groups = pseudobulk.obs[groupby].cat.categories.tolist()
 
-    results: List[pd.DataFrame] = []
+    # results are accumulated in flat lists and converted to a data frame once
+    index, coef_list, intercept_list, pvalue_list, var_codes = [], [], [], [], []
     var_iter = tqdm(var_names) if progress else var_names
-    for col in var_iter:
+    for i, col in enumerate(var_iter):
         try:
             with threadpool_limits(1):
                 mod = smf.ols(formula=formula.format(col=col), data=df)
@@ -257,28 +492,761 @@ def _test_lm(
                 coefs, pvals, intercept = _test_all_params(
                     res, groupby=groupby, all_groups=all_groups, contrasts=contrasts
                 )
-                res_df = (
-                    pd.DataFrame.from_dict(coefs, orient="index", columns=["coef"])
-                    .assign(intercept=intercept)
-                    .join(
-                        pd.DataFrame.from_dict(
-                            pvals, orient="index", columns=["pvalue"]
-                        )
-                    )
-                    .assign(
-                        variable=col,
-                        # extract plain group variable from model summary data frame:
-                        group=lambda x: [
-                            re.search(f"\[{contrasts[0]}\.(.*)\]", k).groups()[0]
-                            for k in x.index
-                        ],
-                    )
-                )
-            results.append(res_df)
         except ValueError:
+            continue
+        index.extend(coefs)
+        coef_list.extend(coefs.values())
+        pvalue_list.extend(pvals[k] for k in coefs)
+        intercept_list.extend([intercept] * len(coefs))
+        var_codes.extend([i] * len(coefs))
+
+    if not len(index):
+        return pd.DataFrame()
+
+    # extract plain group variable from model summary data frame:
+    key_group = {
+        k: re.search(f"\\[{contrasts[0]}\\.(.*)\\]", k).groups()[0]  # type: ignore
+        for k in pd.unique(np.array(index))
+    }
+    return pd.DataFrame(
+        {
+            "coef": coef_list,
+            "intercept": intercept_list,
+            "pvalue": pvalue_list,
+            "variable": _categorical(np.array(var_codes), var_names),
+            "group": pd.Categorical(
+                [key_group[k] for k in index],
+                categories=pd.unique(np.array(list(key_group.values()))),
+            ),
+        },
+        index=index,
+    )
+
+
+def _categorical(codes: np.ndarray, categories: pd.Index) -> pd.Categorical:
+    """Build a categorical from codes into `categories`, which may contain duplicates"""
+    if categories.is_unique:
+        return pd.Categorical.from_codes(codes, categories=categories)
+    return pd.Categorical(categories.values[codes])
+
+
+class DesignCache:
+    """
+    Cache design matrices, their decomposition and the contrasts of the groups to test.
+
+    The design matrix only depends on the `obs` of the pseudobulk, the formula and
+    the contrasts. When testing multiple sets of variables on the same samples
+    (e.g. progeny, dorothea and cytosig scores of the same cell-types), only the
+    response variables change, and the design can be reused.
+
+    Parameters
+    ----------
+    max_size
+        maximum number of designs to keep. The least recently used ones are discarded.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._designs: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+
+    def get(
+        self, obs: pd.DataFrame, *, formula: str, groupby: str, contrasts: str
+    ) -> Optional[dict]:
+        """
+        Get the design for a pseudobulk obs data frame, computing it if necessary.
+
+        Returns
+        -------
+        See :func:`_make_design`. None, if the groups to test are not in the design.
+        """
+        key = self._key(obs, formula=formula, groupby=groupby, contrasts=contrasts)
+        try:
+            self._designs.move_to_end(key)
+            return self._designs[key]
+        except KeyError:
             pass
+        design = _make_design(
+            obs, formula=formula, groupby=groupby, contrasts=contrasts
+        )
+        self._designs[key] = design
+        while len(self._designs) > self.max_size:
+            self._designs.popitem(last=False)
+        return design
+
+    @staticmethod
+    def _key(obs: pd.DataFrame, **params) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr(sorted(params.items())).encode())
+        h.update(repr(obs.columns.tolist()).encode())
+        for col, values in obs.items():
+            h.update(repr(values.dtype).encode())
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # the order of categories affects the design, the hash only covers values
+                h.update(repr(values.cat.categories.tolist()).encode())
+        h.update(pd.util.hash_pandas_object(obs, index=True).values.tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self._designs)
 
+
+def _make_design(
+    obs: pd.DataFrame, *, formula: str, groupby: str, contrasts: str
+) -> Optional[dict]:
+    """
+    Build and decompose the design matrix, and set-up the contrasts of the groups to test.
+
+    Returns
+    -------
+    None, if the groups to test are not in the design, otherwise a dictionary with
+
+     * `obs_mask`: boolean mask of the observations used in the model
+       (patsy drops rows with missing values in the covariates)
+     * `X`: design matrix (n_obs x n_params)
+     * `pinv`: pseudo inverse of the design matrix (n_params x n_obs)
+     * `cov_unscaled`: (X'X)^-1 (n_params x n_params)
+     * `hat_diag`: diagonal of the hat matrix (n_obs)
+     * `df_resid`: residual degrees of freedom
+     * `intercept_idx`: index of the intercept parameter
+     * `test_idx`: indices of the parameters of the groups to test
+     * `keys`: names of the groups to test, as in the statsmodels results
+     * `groups`: plain group names corresponding to `keys`
+     * `contrast_mat`: linear combinations of parameters corresponding to `keys`
+       (n_keys x n_params)
+    """
+    # only using the categories (rather than just .unique() gets rid of nans)
+    all_groups = pd.Categorical(obs[groupby]).categories.tolist()
+    contrasts_mode, keys = _contrast_keys(
+        groupby=groupby, all_groups=all_groups, contrasts=contrasts
+    )
+
+    # rows with missing values in the covariates are dropped by patsy
+    design = patsy.dmatrix(formula, obs, eval_env=0, return_type="dataframe")
+
+    # in sum-to-zero coding, the last level is omitted from the model
+    estimated_keys = keys[:-1] if contrasts_mode == "sum-to-zero" else keys
     try:
-        return pd.concat(results)
-    except ValueError:
+        intercept_idx = design.columns.get_loc("Intercept")
+        param_idx = [design.columns.get_loc(k) for k in estimated_keys]
+    except KeyError:
+        return None
+
+    contrast_mat = np.eye(design.shape[1])[param_idx]
+    if contrasts_mode == "sum-to-zero":
+        # the coefficient of the omitted level is the negative sum of all other levels
+        contrast_mat = np.vstack([contrast_mat, -np.sum(contrast_mat, axis=0)])
+
+    X = design.values
+    rank = np.linalg.matrix_rank(X)
+    if rank == X.shape[1]:
+        Q, R = np.linalg.qr(X)
+        pinv = scipy.linalg.solve_triangular(R, Q.T)
+        R_inv = scipy.linalg.solve_triangular(R, np.eye(R.shape[0]))
+        cov_unscaled = R_inv @ R_inv.T
+    else:
+        # same as statsmodels, which uses the Moore-Penrose pseudo inverse.
+        pinv = np.linalg.pinv(X)
+        cov_unscaled = pinv @ pinv.T
+
+    return {
+        "obs_mask": obs.index.isin(design.index),
+        "X": X,
+        "pinv": pinv,
+        "cov_unscaled": cov_unscaled,
+        "hat_diag": np.sum(X * pinv.T, axis=1),
+        "df_resid": X.shape[0] - rank,
+        "intercept_idx": intercept_idx,
+        "test_idx": param_idx,
+        "keys": keys,
+        # extract plain group variable from model summary data frame:
+        "groups": [
+            re.search(f"\\[{contrasts[0]}\\.(.*)\\]", k).groups()[0] for k in keys
+        ],
+        "contrast_mat": contrast_mat,
+    }
+
+
+def _test_lm_batched(
+    pseudobulk: AnnData,
+    formula: str,
+    groupby: str,
+    contrasts: str,
+    robust: bool = False,
+    design_cache: Optional[DesignCache] = None,
+    n_permutations: int = 0,
+    permutation_strata: Optional[str] = None,
+    random_state: int = 0,
+    random_effect: Optional[str] = None,
+    moderated: bool = False,
+    progress: bool = False,
+) -> pd.DataFrame:
+    """
+    Fit the linear model for all variables at once.
+
+    The design matrix only depends on `obs` and is therefore shared between all variables.
+    It is decomposed once, and coefficients, standard errors and pvalues (including the
+    f-test for the omitted level in sum-to-zero coding) are computed as array operations.
+    The same holds for HC3 robust standard errors: the hat matrix diagonal only depends
+    on the design.
+    Results are equivalent to :func:`_test_lm`.
+    """
+    if random_effect is not None and (robust or n_permutations):
+        raise ValueError(
+            "Mixed models can't be combined with robust standard errors or permutation tests."
+        )
+    if moderated and (robust or random_effect is not None):
+        raise ValueError(
+            "Moderated statistics are only available for ordinary linear models."
+        )
+
+    # convert to categorical to make sure the levels have an inherent order
+    pseudobulk.obs[groupby] = pd.Categorical(pseudobulk.obs[groupby])  # type: ignore
+    if design_cache is None:
+        design_cache = DesignCache(max_size=1)
+    design = design_cache.get(
+        pseudobulk.obs, formula=formula, groupby=groupby, contrasts=contrasts
+    )
+    if design is None:
         return pd.DataFrame()
+
+    Y = pseudobulk.X[design["obs_mask"], :]
+    Y = np.asarray(Y.toarray() if hasattr(Y, "toarray") else Y, dtype=np.float64)
+
+    # statsmodels drops missing values of the dependent variable for each model separately.
+    # This can't be done in a batch, therefore fall back to the per-variable implementation.
+    var_finite = np.all(np.isfinite(Y), axis=0)
+    if not np.all(var_finite):
+
+        def _subset(mask):
+            # positional names, such that the results can be ordered by variable
+            # even if the var_names are not unique
+            tmp_pseudobulk = pseudobulk[:, mask].copy()
+            tmp_pseudobulk.var_names = np.flatnonzero(mask).astype(str)
+            return tmp_pseudobulk
+
+        tmp_res = _test_lm_batched(
+            _subset(var_finite),
+            formula,
+            groupby,
+            contrasts,
+            robust,
+            design_cache,
+            n_permutations,
+            permutation_strata,
+            random_state,
+            random_effect,
+            moderated,
+            progress=progress,
+        )
+        if random_effect is None:
+            nonfinite_res = _test_lm(
+                _subset(~var_finite),
+                formula,
+                groupby,
+                contrasts,
+                progress=progress,
+                robust=robust,
+            )
+        else:
+            # there is no per-variable reference implementation of the mixed model
+            warnings.warn(
+                f"{np.sum(~var_finite)} variables with non-finite values can't be tested "
+                "with a mixed model. Their results are NaN."
+            )
+            nonfinite_idx = np.flatnonzero(~var_finite)
+            n_keys = len(design["keys"])
+            nonfinite_res = pd.DataFrame(
+                {
+                    "coef": np.nan,
+                    "intercept": np.nan,
+                    "pvalue": np.nan,
+                    "variable": np.repeat(nonfinite_idx, n_keys).astype(str),
+                    "group": pd.Categorical.from_codes(
+                        np.tile(np.arange(n_keys), len(nonfinite_idx)),
+                        categories=design["groups"],
+                    ),
+                },
+                index=np.tile(design["keys"], len(nonfinite_idx)),
+            )
+        res = concat_results([tmp_res, nonfinite_res])
+        # e.g. the eBayes prior, which is estimated from the finite variables only
+        res.attrs = tmp_res.attrs
+        if not len(res):
+            return res
+        var_idx = np.asarray(res["variable"]).astype(int)
+        order = np.argsort(var_idx, kind="stable")
+        return res.iloc[order].assign(
+            variable=_categorical(var_idx[order], pseudobulk.var_names)
+        )
+
+    if random_effect is None:
+        fit = _ols_batched(design, Y, robust=robust)
+        coefs, pvals = _contrast_test(fit, design["contrast_mat"])
+        intercept = fit["params"][design["intercept_idx"]]
+    else:
+        coefs, pvals, intercept = _mixed_model_batched(
+            design, Y, pseudobulk.obs[random_effect].values[design["obs_mask"]]
+        )
+
+    n_keys, n_vars = coefs.shape
+    res = pd.DataFrame(
+        {
+            "coef": coefs.T.ravel(),
+            "intercept": np.repeat(intercept, n_keys),
+            "pvalue": pvals.T.ravel(),
+            "variable": _categorical(
+                np.repeat(np.arange(n_vars), n_keys), pseudobulk.var_names
+            ),
+            "group": pd.Categorical.from_codes(
+                np.tile(np.arange(n_keys), n_vars), categories=design["groups"]
+            ),
+        },
+        index=np.tile(design["keys"], n_vars),
+    )
+    if n_permutations:
+        strata = (
+            None
+            if permutation_strata is None
+            else pseudobulk.obs[permutation_strata].values[design["obs_mask"]]
+        )
+        res["pvalue_perm"] = _permutation_test(
+            design,
+            Y,
+            n_permutations=n_permutations,
+            strata=strata,
+            random_state=random_state,
+            progress=progress,
+        ).T.ravel()
+    if moderated:
+        C = design["contrast_mat"]
+        res["sigma2"] = np.repeat(fit["scale"], n_keys)
+        # float, such that rows of the non-finite fallback can be NaN
+        res["df_resid"] = float(fit["df_resid"])
+        res["stdev_unscaled"] = np.tile(
+            np.sqrt(np.sum((C @ fit["cov_unscaled"]) * C, axis=1)), n_vars
+        )
+        res = ebayes(res)
+    return res
+
+
+def _ols_batched(design: dict, Y: np.ndarray, *, robust: bool = False) -> dict:
+    """
+    Ordinary least squares for multiple dependent variables that share the same design.
+
+    Parameters
+    ----------
+    design
+        decomposed design matrix, see :func:`_make_design`
+    Y
+        dependent variables (n_obs x n_vars)
+    robust
+        Additionally compute the weights for HC3 heteroskedasticity-robust standard errors.
+
+    Returns
+    -------
+    Dictionary with
+
+     * `params`: coefficients (n_params x n_vars)
+     * `pinv`: pseudo inverse of the design matrix (n_params x n_obs)
+     * `cov_unscaled`: (X'X)^-1 (n_params x n_params)
+     * `scale`: residual variance for each variable (n_vars)
+     * `df_resid`: residual degrees of freedom
+     * `het_scale`: only if `robust=True`. HC3 weights resid^2 / (1 - h)^2,
+       where h is the diagonal of the hat matrix (n_obs x n_vars).
+    """
+    params = design["pinv"] @ Y
+    resid = Y - design["X"] @ params
+    df_resid = design["df_resid"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.sum(resid**2, axis=0) / df_resid
+
+    fit = {
+        "params": params,
+        "pinv": design["pinv"],
+        "cov_unscaled": design["cov_unscaled"],
+        "scale": scale,
+        "df_resid": df_resid,
+    }
+    if robust:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fit["het_scale"] = resid**2 / (1 - design["hat_diag"][:, None]) ** 2
+    return fit
+
+
+def _permutations(
+    n_obs: int, n_permutations: int, strata=None, random_state: int = 0
+) -> np.ndarray:
+    """
+    Generate random permutations of `n_obs` observations, optionally only within strata.
+
+    Returns
+    -------
+    Array of dimension (n_permutations x n_obs), each row is a permutation of `range(n_obs)`.
+    """
+    rng = np.random.default_rng(random_state)
+    codes = (
+        np.zeros(n_obs, dtype=int)
+        if strata is None
+        else _factorize(strata, dropna=False)[0]
+    )
+    # positions ordered by stratum. Within each stratum, they are assigned a random order.
+    by_stratum = np.argsort(codes, kind="stable")
+    shuffled = np.lexsort(
+        (
+            rng.random((n_permutations, n_obs)),
+            np.broadcast_to(codes, (n_permutations, n_obs)),
+        )
+    )
+    perms = np.empty((n_permutations, n_obs), dtype=int)
+    perms[:, by_stratum] = shuffled
+    return perms
+
+
+def _permutation_test(
+    design: dict,
+    Y: np.ndarray,
+    *,
+    n_permutations: int,
+    strata=None,
+    random_state: int = 0,
+    max_memory: int = 256 * 1024**2,
+    progress: bool = False,
+) -> np.ndarray:
+    """
+    Empirical pvalues of the contrasts from permutations of the groups to test.
+
+    Uses the Freedman-Lane procedure: the residuals of the reduced model (without
+    the groups to test) are permuted, and the t-statistics of the full model are
+    computed for the permuted data. If the covariates are constant within strata
+    (e.g. `+ dataset` with `dataset` as strata) this is equivalent to permuting the
+    group labels within strata. As the reduced fitted values are in the span of the design, the
+    estimates and residuals of the permuted data only depend on the permuted reduced
+    residuals, which is a single (batched) matrix product with the precomputed
+    pseudo inverse of the design for all variables and permutations.
+
+    Permutations are processed in batches, such that the temporary arrays of a batch
+    (each permutations x n_obs x n_vars) use at most about `max_memory` bytes.
+
+    Returns
+    -------
+    Empirical two-sided pvalues (n_contrasts x n_vars), computed as
+    `(1 + #(|t_perm| >= |t_obs|)) / (1 + n_permutations)`.
+    """
+    X, pinv, C = design["X"], design["pinv"], design["contrast_mat"]
+    df_resid = design["df_resid"]
+    # reduced model without the groups to test
+    Z = np.delete(X, design["test_idx"], axis=1)
+    resid_reduced = Y - Z @ (np.linalg.pinv(Z) @ Y)
+
+    contrast_pinv = C @ pinv
+    contrast_var = np.sum((C @ design["cov_unscaled"]) * C, axis=1)[:, None]
+
+    def _abs_t(E):
+        """t-statistics of the contrasts for a batch of permuted responses (b x n_obs x n_vars)"""
+        resid = E - X @ (pinv @ E)
+        scale = np.sum(resid**2, axis=1, keepdims=True) / df_resid
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.abs((contrast_pinv @ E) / np.sqrt(contrast_var * scale))
+
+    t_obs = _abs_t(Y[np.newaxis])[0]
+    perms = _permutations(Y.shape[0], n_permutations, strata, random_state)
+    n_extreme = np.zeros(t_obs.shape, dtype=np.int64)
+    # the permuted responses, their residuals and the squared residuals
+    bytes_per_perm = 3 * Y.shape[0] * Y.shape[1] * np.dtype(np.float64).itemsize
+    batch_size = int(np.clip(max_memory // max(bytes_per_perm, 1), 1, n_permutations))
+    for i in tqdm(range(0, n_permutations, batch_size), disable=not progress):
+        t_perm = _abs_t(resid_reduced[perms[i : i + batch_size]])
+        # small tolerance for ties that are only different due to floating point errors
+        n_extreme += np.sum(t_perm >= t_obs * (1 - 1e-10), axis=0)
+
+    pvals = (1 + n_extreme) / (1 + n_permutations)
+    pvals[np.isnan(t_obs)] = np.nan
+    return pvals
+
+
+def _reml_objective(
+    lam: np.ndarray, stats: dict
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Profiled REML criterion of a random intercept model for each variable.
+
+    The data is rotated by the eigenvectors of ZZ', such that the covariance matrix
+    of the observations is diagonal: V = sigma^2 * diag(1 + lam * d), where
+    `lam = sigma_u^2 / sigma^2` is the ratio of variance components and `d` are the
+    eigenvalues of ZZ'. As there are only few distinct eigenvalues (at most the number
+    of levels of the random effect + 1), the weighted cross-products are computed from
+    sums over the observations that share the same eigenvalue.
+
+    Parameters
+    ----------
+    lam
+        ratio of variance components for each variable (n_vars), or a single value for all
+        variables. In that case, X'WX is the same for all variables.
+    stats
+        Sufficient statistics for each distinct eigenvalue `u`, see :func:`_mixed_model_batched`
+
+    Returns
+    -------
+    -2 * REML log-likelihood (up to a constant), fixed effects (n_vars x n_params),
+    residual variances (n_vars) and X'WX (n_vars x n_params x n_params).
+    """
+    XX, XY, YY = stats["XX"], stats["XY"], stats["YY"]
+    n_eig, n_params, _ = XX.shape
+    df = np.sum(stats["n"]) - n_params
+    w = 1 / (1 + np.atleast_1d(lam)[:, np.newaxis] * stats["d"][np.newaxis, :])
+    XtWX = (w @ XX.reshape(n_eig, -1)).reshape(-1, n_params, n_params)
+    if np.isscalar(lam):
+        XtWy = np.einsum("u,upg->gp", w[0], XY)
+        beta = XtWy @ np.linalg.inv(XtWX[0]).T
+    else:
+        XtWy = np.einsum("gu,upg->gp", w, XY)
+        beta = np.linalg.solve(XtWX, XtWy[:, :, np.newaxis])[:, :, 0]
+    # r'Wr = y'Wy - beta' X'Wy at the GLS solution
+    rss = np.sum(w * YY.T, axis=1) - np.sum(beta * XtWy, axis=1)
+    scale = np.clip(rss, np.finfo(float).tiny, None) / df
+    objective = df * np.log(scale) - np.log(w) @ stats["n"] + np.linalg.slogdet(XtWX)[1]
+    return objective, beta, scale, XtWX
+
+
+def _mixed_model_batched(
+    design: dict,
+    Y: np.ndarray,
+    groups: np.ndarray,
+    *,
+    n_grid: int = 25,
+    n_iter: int = 15,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit a random intercept linear mixed model for all variables at once.
+
+    The ratio of the variance components is optimized by REML for each variable.
+    All variables are optimized simultaneously: The criterion is first evaluated
+    on a grid of (log-spaced) values, and then refined with a golden section
+    search within the bracket around the best grid value. Each step is a vectorized
+    operation over all variables on the shared (rotated) design.
+
+    Parameters
+    ----------
+    design
+        design without the random effect, see :func:`_make_design`
+    Y
+        dependent variables (n_obs x n_vars)
+    groups
+        levels of the random effect for each observation
+    n_grid
+        number of grid points
+    n_iter
+        number of golden section iterations
+
+    Returns
+    -------
+    estimates of the contrasts, their pvalues from Wald z-tests (each n_contrasts x n_vars) and the intercepts (n_vars).
+    """
+    X, C = design["X"], design["contrast_mat"]
+    if np.linalg.matrix_rank(X) < X.shape[1]:
+        raise ValueError("The mixed model requires a design matrix with full rank.")
+    codes, uniques = pd.factorize(groups)
+    if np.any(codes < 0):
+        raise ValueError("The random effect column must not contain missing values.")
+    Z = np.zeros((len(codes), len(uniques)))
+    Z[np.arange(len(codes)), codes] = 1
+    d, U = np.linalg.eigh(Z @ Z.T)
+    X_rot, Y_rot = U.T @ X, U.T @ Y
+    n_vars = Y.shape[1]
+
+    # sufficient statistics for each distinct eigenvalue (eigenvalues of ZZ' are integers)
+    d_codes, d_unique = pd.factorize(np.round(np.clip(d, 0, None)))
+    indicator = np.zeros((len(d_unique), len(d)))
+    indicator[d_codes, np.arange(len(d))] = 1
+    stats = {
+        "d": d_unique.astype(float),
+        "n": indicator.sum(axis=1),
+        "XX": np.einsum("un,np,nq->upq", indicator, X_rot, X_rot),
+        "XY": np.einsum("un,np,ng->upg", indicator, X_rot, Y_rot),
+        "YY": indicator @ Y_rot**2,
+    }
+
+    def _objective(lam):
+        return _reml_objective(lam, stats)[0]
+
+    # grid search on log scale, including lam = 0 (no random effect)
+    grid = np.concatenate([[0], np.logspace(-4, 4, n_grid - 1)])
+    grid_obj = np.vstack([_objective(lam) for lam in grid])
+    best = np.argmin(grid_obj, axis=0)
+    lower = grid[np.maximum(best - 1, 0)]
+    upper = grid[np.minimum(best + 1, len(grid) - 1)]
+
+    # golden section search within the bracket
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = lower, upper
+    c, e = b - ratio * (b - a), a + ratio * (b - a)
+    obj_c, obj_e = _objective(c), _objective(e)
+    for _ in range(n_iter):
+        left = obj_c < obj_e
+        b = np.where(left, e, b)
+        a = np.where(left, a, c)
+        c_new, e_new = b - ratio * (b - a), a + ratio * (b - a)
+        obj_new = _objective(np.where(left, c_new, e_new))
+        c, e = np.where(left, c_new, e), np.where(left, c, e_new)
+        obj_c, obj_e = np.where(left, obj_new, obj_e), np.where(left, obj_c, obj_new)
+    lam = (a + b) / 2
+    # the optimum may be on the boundary of the grid
+    grid_best = grid[best]
+    lam = np.where(_objective(lam) <= grid_obj[best, np.arange(n_vars)], lam, grid_best)
+
+    _, beta, scale, XtWX = _reml_objective(lam, stats)
+    XtWX_inv = np.linalg.inv(XtWX)
+    estimates = beta @ C.T
+    variances = np.einsum("kp,gpq,kq->gk", C, XtWX_inv, C) * scale[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = estimates / np.sqrt(variances)
+    pvals = 2 * scipy.stats.norm.sf(np.abs(z))
+    return estimates.T, pvals.T, beta[:, design["intercept_idx"]]
+
+
+def ebayes(res: pd.DataFrame) -> pd.DataFrame:
+    """
+    Empirical Bayes moderation of the residual variances, as in limma's `eBayes`.
+
+    A scaled inverse chi-square prior is fitted to the residual variances of all variables
+    (`limma::fitFDist`). The residual variances are shrunk towards the prior (`limma::squeezeVar`),
+    and moderated t-statistics are computed with the posterior variances and
+    `df_resid + df_prior` degrees of freedom.
+
+    Parameters
+    ----------
+    res
+        Result data frame of :func:`test_lm` with the columns `coef`, `variable`,
+        `sigma2` (residual variance), `df_resid` and `stdev_unscaled` (standard error
+        of the coefficient divided by the residual standard deviation).
+        All rows are used to estimate the prior, i.e. it should contain the results of
+        a single model. The rows of each variable must be consecutive, in the order
+        returned by :func:`test_lm`. Rows without a residual variance (e.g. from the
+        per-variable fallback for non-finite values) are not used and get NaN results.
+
+    Returns
+    -------
+    Copy of the data frame with the additional columns `s2_post`, `t_moderated`
+    and `pvalue_moderated`. The estimated prior is stored in `attrs`.
+    """
+    res = res.copy()
+    # Each variable has multiple rows (one per group) with the same variance. Variables
+    # are identified by position, as the names are not necessarily unique.
+    variable = np.asarray(res["variable"])
+    key = res.index.values
+    first_row = np.ones(res.shape[0], dtype=bool)
+    first_row[1:] = (variable[1:] != variable[:-1]) | (key[1:] == key[:1])
+    per_var = res.loc[first_row, ["sigma2", "df_resid"]].values.astype(float)
+    per_var = per_var[~np.isnan(per_var).any(axis=1)]
+    if per_var.shape[0]:
+        s2_prior, df_prior = _fit_f_dist(per_var[:, 0], per_var[:, 1])
+    else:
+        s2_prior, df_prior = np.nan, np.nan
+
+    df_resid = res["df_resid"].values.astype(float)
+    if np.isinf(df_prior):
+        s2_post = np.where(np.isnan(res["sigma2"].values), np.nan, s2_prior)
+    else:
+        s2_post = (df_prior * s2_prior + df_resid * res["sigma2"].values) / (
+            df_prior + df_resid
+        )
+    # as in limma, the total degrees of freedom are capped at the pooled degrees of freedom
+    df_total = np.minimum(df_resid + df_prior, np.nansum(per_var[:, 1]))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = res["coef"].values / (res["stdev_unscaled"].values * np.sqrt(s2_post))
+    res["s2_post"] = s2_post
+    res["t_moderated"] = t
+    res["pvalue_moderated"] = 2 * scipy.stats.t.sf(np.abs(t), df_total)
+    res.attrs = {**res.attrs, "s2_prior": s2_prior, "df_prior": df_prior}
+    return res
+
+
+def _fit_f_dist(s2: np.ndarray, df: np.ndarray) -> Tuple[float, float]:
+    """
+    Moment estimation of the parameters of a scaled F-distribution (`limma::fitFDist`).
+
+    Returns
+    -------
+    scale (prior variance) and prior degrees of freedom
+    """
+    ok = np.isfinite(s2) & np.isfinite(df) & (df > 0)
+    s2, df = s2[ok], df[ok]
+    # avoid log(0) for variables with zero variance, as in limma
+    median = np.median(s2)
+    if median == 0:
+        warnings.warn(
+            "More than half of residual variances are exactly zero: eBayes unreliable"
+        )
+        median = 1
+    elif np.any(s2 == 0):
+        warnings.warn("Zero sample variances detected, have been offset away from zero")
+    s2 = np.maximum(s2, 1e-5 * median)
+    z = np.log(s2)
+    e = z - scipy.special.digamma(df / 2) + np.log(df / 2)
+    e_mean = np.mean(e)
+    # the variability between variables can't be estimated from a single variable
+    e_var = (
+        np.var(e, ddof=1) - np.mean(scipy.special.polygamma(1, df / 2))
+        if len(e) > 1
+        else 0
+    )
+    if e_var > 0:
+        df_prior = 2 * _trigamma_inverse(e_var)
+        s2_prior = np.exp(
+            e_mean + scipy.special.digamma(df_prior / 2) - np.log(df_prior / 2)
+        )
+    else:
+        df_prior = np.inf
+        s2_prior = np.exp(e_mean)
+    return s2_prior, df_prior
+
+
+def _trigamma_inverse(x: float, tol: float = 1e-8, max_iter: int = 50) -> float:
+    """Solve trigamma(y) = x for y with Newton's method (`limma::trigammaInverse`)"""
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for _ in range(max_iter):
+        tri = scipy.special.polygamma(1, y)
+        dif = tri * (1 - tri / x) / scipy.special.polygamma(2, y)
+        y += dif
+        if -dif / y < tol:
+            break
+    return y
+
+
+def _contrast_test(
+    fit: dict, contrast_mat: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Test linear combinations of parameters against zero for all variables.
+
+    As each contrast is a single restriction, the two-sided t-test is equivalent to the f-test.
+
+    Parameters
+    ----------
+    fit
+        result of :func:`_ols_batched`
+    contrast_mat
+        matrix of linear combinations (n_contrasts x n_params)
+
+    Returns
+    -------
+    estimates and pvalues, each of dimension (n_contrasts x n_vars)
+    """
+    estimates = contrast_mat @ fit["params"]
+    if "het_scale" in fit:
+        # c' (X^+ diag(w) X^+') c for each variable, without materializing the covariance matrices
+        variances = (contrast_mat @ fit["pinv"]) ** 2 @ fit["het_scale"]
+    else:
+        variances = (
+            np.sum((contrast_mat @ fit["cov_unscaled"]) * contrast_mat, axis=1)[:, None]
+            * fit["scale"][None, :]
+        )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = estimates / np.sqrt(variances)
+    pvals = 2 * scipy.stats.t.sf(np.abs(t), fit["df_resid"])
+    return estimates, pvals
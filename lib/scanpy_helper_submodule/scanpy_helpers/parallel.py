@@ -0,0 +1,235 @@
+"""A persistent process pool that shares large objects with its workers via shared memory.
+
+Instead of pickling the full data (e.g. an AnnData object) for every task, the object
+is serialized once into `multiprocessing.shared_memory`. Numpy buffers (e.g. `X`, sparse
+matrix components, categorical codes) are stored out-of-band with pickle protocol 5 and
+mapped into the workers without copying. Tasks then only contain small items such as
+index ranges. The worker pool is created once and reused across calls.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import cpu_count, shared_memory
+from multiprocessing import resource_tracker
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+import atexit
+import pickle
+import uuid
+from tqdm.auto import tqdm
+
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+_EXECUTOR_N_JOBS: Optional[int] = None
+
+#: shared objects that have been attached in the current worker process: token -> (obj, segments)
+_WORKER_CACHE: dict = {}
+#: number of shared objects that are kept attached in each worker
+_WORKER_CACHE_SIZE = 2
+#: tokens of the shared objects created by the current process that have not been unlinked yet
+_LIVE_TOKENS: set = set()
+
+
+class SharedObject:
+    """
+    Store a picklable object in shared memory.
+
+    The instance itself is lightweight and cheap to pickle. Call :meth:`get` in the
+    worker process to obtain the object. Numpy arrays of the object are read-only views
+    into the shared memory.
+
+    Use as context manager (or call :meth:`unlink`) to free the shared memory once all
+    tasks are done. Each pickled instance carries the tokens of the objects that are
+    still alive in the parent, such that workers drop the mappings of unlinked objects
+    with their next task.
+    """
+
+    def __init__(self, obj: Any):
+        self.token = uuid.uuid4().hex
+        _LIVE_TOKENS.add(self.token)
+        self._segments: List[shared_memory.SharedMemory] = []
+        buffers = []
+        meta = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        self._meta = self._create_segment(meta)
+        self._buffers = [self._create_segment(b.raw()) for b in buffers]
+
+    def _create_segment(self, data) -> Tuple[str, int]:
+        nbytes = memoryview(data).nbytes
+        # zero-size segments are not allowed
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        shm.buf[:nbytes] = memoryview(data).cast("B")
+        self._segments.append(shm)
+        return shm.name, nbytes
+
+    def get(self) -> Any:
+        """Get the shared object. Attaches to the shared memory on first use in a process."""
+        # the memory of unlinked objects is only released once all processes detached
+        live = getattr(self, "_live", _LIVE_TOKENS)
+        for token in [t for t in _WORKER_CACHE if t not in live]:
+            _detach(token)
+
+        try:
+            return _WORKER_CACHE[self.token][0]
+        except KeyError:
+            pass
+
+        while len(_WORKER_CACHE) >= _WORKER_CACHE_SIZE:
+            _detach(next(iter(_WORKER_CACHE)))
+
+        segments = []
+
+        def _view(name, nbytes):
+            shm = _attach(name)
+            segments.append(shm)
+            return shm.buf[:nbytes].toreadonly()
+
+        meta = bytes(_view(*self._meta))
+        obj = pickle.loads(meta, buffers=[_view(*b) for b in self._buffers])
+        _WORKER_CACHE[self.token] = (obj, segments)
+        return obj
+
+    def unlink(self):
+        """Free the shared memory. The object can't be used anymore afterwards."""
+        _LIVE_TOKENS.discard(self.token)
+        _detach(self.token)
+        for shm in self._segments:
+            shm.close()
+            shm.unlink()
+        self._segments = []
+
+    def __getstate__(self):
+        return {
+            "token": self.token,
+            "_meta": self._meta,
+            "_buffers": self._buffers,
+            "_live": frozenset(_LIVE_TOKENS),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # The segment is owned (and unlinked) by the process that created it. Prevent the
+    # resource tracker of attaching processes from unlinking it, see https://bugs.python.org/issue39959
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+    return shm
+
+
+def _detach(token: str):
+    try:
+        obj, segments = _WORKER_CACHE.pop(token)
+    except KeyError:
+        return
+    # numpy arrays must be released before closing the memory they point to
+    del obj
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # there are still references to the object outside the cache.
+            # The memory will be released when they are garbage collected.
+            pass
+
+
+def get_executor(n_jobs: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Get the persistent process pool.
+
+    The pool is only recreated if the number of workers changes.
+    """
+    global _EXECUTOR, _EXECUTOR_N_JOBS
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    if _EXECUTOR is not None and (
+        _EXECUTOR_N_JOBS != n_jobs or getattr(_EXECUTOR, "_broken", False)
+    ):
+        shutdown_executor()
+    if _EXECUTOR is None:
+        _EXECUTOR = ProcessPoolExecutor(max_workers=n_jobs)
+        _EXECUTOR_N_JOBS = n_jobs
+    return _EXECUTOR
+
+
+@atexit.register
+def shutdown_executor():
+    """Shut down the persistent process pool"""
+    global _EXECUTOR, _EXECUTOR_N_JOBS
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown()
+    _EXECUTOR = None
+    _EXECUTOR_N_JOBS = None
+
+
+def _call_shared(func, shared, item):
+    return func(shared.get(), item)
+
+
+def parallel_map(
+    func: Callable,
+    items: Iterable,
+    *,
+    shared: Any = None,
+    n_jobs: Optional[int] = None,
+    progress: bool = True,
+) -> list:
+    """
+    Apply a function to items in parallel, sharing a large object with all workers.
+
+    Parameters
+    ----------
+    func
+        A picklable function. Called as `func(shared, item)` if `shared` is provided,
+        otherwise as `func(item)`. Use :func:`functools.partial` to pass additional
+        (small) arguments.
+    items
+        Items to process, e.g. index ranges into `shared`.
+    shared
+        Object that is put into shared memory once and made available to all tasks.
+        Numpy arrays within the object are read-only.
+    n_jobs
+        Number of worker processes. Defaults to the number of CPUs. With `n_jobs=1`,
+        all tasks are executed in the current process.
+    progress
+        Show a tqdm progress bar
+
+    Returns
+    -------
+    List of results in the order of `items`.
+    """
+    items = list(items)
+    if n_jobs == 1 or len(items) <= 1:
+        call = (lambda item: func(shared, item)) if shared is not None else func
+        return [call(item) for item in tqdm(items, disable=not progress)]
+
+    executor = get_executor(n_jobs)
+    with _share(shared) as shared_obj:
+        if shared_obj is None:
+            futures = {executor.submit(func, item): i for i, item in enumerate(items)}
+        else:
+            futures = {
+                executor.submit(_call_shared, func, shared_obj, item): i
+                for i, item in enumerate(items)
+            }
+        results = [None] * len(items)
+        try:
+            for future in tqdm(
+                as_completed(futures), total=len(items), disable=not progress
+            ):
+                results[futures[future]] = future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+@contextmanager
+def _share(obj):
+    if obj is None:
+        yield None
+    else:
+        with SharedObject(obj) as shared_obj:
+            yield shared_obj
@@ -1,10 +1,18 @@
-from typing import Sequence, Union
+from contextlib import contextmanager, nullcontext
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
 from anndata import AnnData, ImplicitModificationWarning
+import anndata
 import numpy as np
 import pandas as pd
-from operator import and_
-from functools import reduce
+import scipy.sparse
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from numba import njit
+from .util import _choose_mtx_rep, _factorize
 
 
 def pseudobulk(
@@ -13,14 +21,36 @@ def pseudobulk(
     groupby: Union[str, Sequence[str]],
     aggr_fun=np.sum,
     min_obs=10,
+    stats: Sequence[str] = (),
+    layer: Optional[str] = None,
+    use_raw: bool = False,
+    dtype=None,
+    acc_dtype=None,
+    sparse: bool = False,
+    chunksize: Optional[int] = None,
+    n_jobs: Optional[int] = 1,
+    cache: Optional[Union[str, Path, "PseudobulkCache"]] = None,
 ) -> AnnData:
     """
     Calculate Pseudobulk of groups
 
+    `np.sum` and `np.mean` are computed in a single pass over the count matrix
+    by multiplying it with a sparse (groups x cells) indicator matrix. Any other
+    callback falls back to calling `aggr_fun` once per group.
+
+    If `adata` is opened in backed mode (or a path to a h5ad file is passed), the
+    matrix is streamed from disk in blocks of `chunksize` rows, such that the peak
+    memory usage is bounded by the size of a block and the result.
+
+    Additional statistics can be requested with `stats`. They are stored as layers
+    and computed in the same pass over the matrix as `X`, operating only on the stored
+    non-zero values of sparse matrices.
+
     Parameters
     ----------
     adata
-        annotated data matrix
+        annotated data matrix, or path to a `.h5ad` file, which will be opened in
+        backed mode.
     groupby
         One or multiple columns to group by
     aggr_fun
@@ -28,6 +58,37 @@ def pseudobulk(
         the `axis` attribute.
     min_obs
         Exclude groups with less than `min_obs` observations
+    stats
+        Statistics to add as layers. Supported are `sum`, `mean`, `n_expressed`
+        (number of observations with a non-zero value), `frac_expressed` (fraction of
+        observations with a non-zero value) and `var` (variance with `ddof=0`, like `np.var`).
+    layer
+        Aggregate this layer instead of `X`.
+    use_raw
+        Aggregate `adata.raw.X` instead of `X`. The result will have the variables of `adata.raw`.
+    dtype
+        dtype of `X` and the layers in the result. Defaults to the dtype of the
+        computation (e.g. int64 for sums of integer counts, float64 for means).
+    acc_dtype
+        dtype used for accumulating sums. Values are converted to this dtype before
+        summing them up. Defaults to int64 for integer input and to the dtype of the input
+        for floating point input. Use e.g. `np.float64` for more precise sums of `float32`
+        values or `np.int64` to obtain exact integer counts from counts stored as floats.
+    sparse
+        If True, store `X` and the layers of the result as sparse CSR matrix.
+    chunksize
+        Number of rows that are processed at once. Defaults to processing the whole matrix
+        in one go for in-memory objects and to 10000 rows for backed objects and views.
+    n_jobs
+        Number of threads used for aggregating CSR matrices. Each thread processes a
+        partition of the rows and keeps its own copy of the (groups x vars) result.
+        Integer sums are identical to the single-threaded result. `None` or `-1` uses
+        all CPUs.
+    cache
+        A :class:`PseudobulkCache` or a path to a directory that is used as cache. If set,
+        the result is looked up by a fingerprint of the input matrix, the groups, the
+        aggregation and all other parameters that affect the result, and only computed
+        if it is not cached yet. Only `np.sum` and `np.mean` can be cached.
 
     Returns
     -------
@@ -35,42 +96,1027 @@ def pseudobulk(
     """
     if isinstance(groupby, str):
         groupby = [groupby]
+    _check_stats(stats)
+
+    with _open_backed(adata) as adata:
+        if chunksize is None and adata.isbacked:
+            chunksize = 10000
+
+        codes, groups = _factorize_groups(adata.obs, groupby)
+        codes, groups = _filter_groups(codes, groups, min_obs=min_obs)
+
+        x_stat = _AGGR_FUNS.get(aggr_fun, None)
+        cache_key = None
+        if cache is not None:
+            if not isinstance(cache, PseudobulkCache):
+                cache = PseudobulkCache(cache)
+            if x_stat is None:
+                warnings.warn(
+                    "Only `np.sum` and `np.mean` can be cached. Not using cache."
+                )
+            else:
+                cache_key = _fingerprint(
+                    adata,
+                    codes,
+                    groups,
+                    x_stat=x_stat,
+                    stats=list(stats),
+                    layer=layer,
+                    use_raw=use_raw,
+                    dtype=dtype,
+                    acc_dtype=acc_dtype,
+                    sparse=sparse,
+                )
+                adata_pb = cache.get(cache_key)
+                if adata_pb is not None:
+                    adata_pb.var = adata.raw.var if use_raw else adata.var
+                    return adata_pb
+
+        cube = PseudobulkCube._from_codes(
+            adata,
+            codes,
+            groups,
+            stats=list(stats) + ([x_stat] if x_stat is not None else []),
+            layer=layer,
+            use_raw=use_raw,
+            acc_dtype=acc_dtype,
+            chunksize=chunksize,
+            n_jobs=n_jobs,
+        )
+
+        if x_stat is not None:
+            X = cube.get_stat(x_stat)
+        else:
+            X = _group_apply(
+                _choose_mtx_rep(adata, use_raw=use_raw, layer=layer),
+                codes,
+                n_groups=groups.shape[0],
+                aggr_fun=aggr_fun,
+            )
+
+    adata_pb = cube._make_adata(X, stats=stats, dtype=dtype, sparse=sparse)
+    if cache_key is not None:
+        cache.put(cache_key, adata_pb)
+    return adata_pb
+
+
+def pseudobulk_bootstrap(
+    adata,
+    *,
+    groupby: Union[str, Sequence[str]],
+    n_replicates: int = 100,
+    sample_size: Optional[int] = None,
+    replace: bool = True,
+    aggr_fun=np.sum,
+    min_obs=10,
+    layer: Optional[str] = None,
+    use_raw: bool = False,
+    random_state=0,
+    chunksize: Optional[int] = None,
+) -> AnnData:
+    """
+    Generate bootstrapped (or subsampled) pseudobulk replicates for each group.
+
+    For each replicate and group, cells are drawn from the group and a multiplicity
+    weight is assigned to each cell (how often it has been drawn). All replicates are
+    then computed in a single product of a sparse (replicates * groups x cells) weight
+    matrix with the expression matrix.
+
+    Parameters
+    ----------
+    adata
+        annotated data matrix, or path to a `.h5ad` file, which will be opened in
+        backed mode.
+    groupby
+        One or multiple columns to group by
+    n_replicates
+        Number of replicates to generate for each group
+    sample_size
+        Number of cells to draw per group and replicate. Defaults to the number of cells
+        in the group (i.e. a classical bootstrap). Required if `replace` is False.
+    replace
+        If True, draw cells with replacement (bootstrap). Otherwise, draw a random subsample
+        of `sample_size` distinct cells. Groups with less than `sample_size` cells are excluded.
+    aggr_fun
+        Either `np.sum` or `np.mean`
+    min_obs
+        Exclude groups with less than `min_obs` observations
+    layer, use_raw, chunksize
+        See :func:`pseudobulk`.
+    random_state
+        Seed or numpy random generator
+
+    Returns
+    -------
+    Anndata object with one observation per replicate and group. `obs` contains
+    the `groupby` columns, a `replicate` column with the replicate number and `n_obs`
+    with the number of cells drawn.
+    """
+    if isinstance(groupby, str):
+        groupby = [groupby]
+    if aggr_fun not in _AGGR_FUNS:
+        raise ValueError("Bootstrapping only supports `np.sum` or `np.mean`.")
+    if not replace:
+        if sample_size is None:
+            raise ValueError(
+                "`sample_size` is required when sampling without replacement."
+            )
+        min_obs = max(min_obs, sample_size)
+    rng = np.random.default_rng(random_state)
+
+    with _open_backed(adata) as adata:
+        if chunksize is None and adata.isbacked:
+            chunksize = 10000
+
+        codes, groups = _factorize_groups(adata.obs, groupby)
+        codes, groups = _filter_groups(codes, groups, min_obs=min_obs)
+        # from here on, codes refer to `x_rows` of `X`, which may be the parent of a view
+        X, codes, x_rows, var_idx = _resolve_view(
+            adata, codes, use_raw=use_raw, layer=layer
+        )
+        n_groups = groups.shape[0]
+        n_obs = np.bincount(codes[codes >= 0], minlength=n_groups)
+        sizes = n_obs if sample_size is None else np.full(n_groups, sample_size)
+
+        # rows of each group are contiguous in `order`, starting at `starts`
+        order = np.argsort(codes, kind="stable")[np.sum(codes < 0) :]
+        starts = np.concatenate([[0], np.cumsum(n_obs)[:-1]]).astype(np.int64)
+        draw_group = np.repeat(np.arange(n_groups), sizes)
+
+        rows, cols = [], []
+        for i in range(n_replicates):
+            if replace:
+                pos = starts[draw_group] + np.floor(
+                    rng.random(draw_group.shape[0]) * n_obs[draw_group]
+                ).astype(np.int64)
+            else:
+                # a random permutation within each group, keep the first `sample_size`
+                perm = np.lexsort((rng.random(order.shape[0]), codes[order]))
+                rank = np.arange(order.shape[0]) - starts[codes[order][perm]]
+                pos = perm[rank < sample_size]
+            cols.append(order[pos])
+            rows.append(codes[order[pos]] + i * n_groups)
+
+        # duplicated entries are summed up, i.e. the values are the multiplicities
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        weights = scipy.sparse.csr_matrix(
+            (np.ones(rows.shape[0], dtype=np.int64), (rows, cols)),
+            shape=(n_replicates * n_groups, codes.shape[0]),
+        )
+        res = _weighted_sum(X, weights, codes, rows=x_rows, chunksize=chunksize)
+        if var_idx is not None:
+            res = res[:, var_idx]
+
+    if aggr_fun is np.mean:
+        res = res / np.tile(sizes, n_replicates)[:, np.newaxis]
+
+    obs = pd.concat([groups] * n_replicates, ignore_index=True).assign(
+        replicate=np.repeat(np.arange(n_replicates), n_groups),
+        n_obs=np.tile(sizes, n_replicates),
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ImplicitModificationWarning)
+        return AnnData(X=res, obs=obs, var=adata.raw.var if use_raw else adata.var)
+
+
+@contextmanager
+def _open_backed(adata):
+    """Open `adata` in backed mode if it is a path and close it again afterwards."""
+    if isinstance(adata, (str, Path)):
+        adata = anndata.read_h5ad(adata, backed="r")
+        try:
+            yield adata
+        finally:
+            adata.file.close()
+    else:
+        yield adata
+
+
+class PseudobulkCube:
+    """
+    Per-group moments (sums, sums of squares, number of non-zero values) of an
+    expression matrix together with the number of observations per group.
+
+    The cube is computed once at the finest grouping of interest with :meth:`from_adata`.
+    It can then be rolled up to any subset of its grouping columns with :meth:`rollup`
+    by summing up the moments, without touching the cell-level matrix again.
+
+    Groups with missing values in one of the grouping columns are kept in the
+    cube (they contribute to the rolled-up groups), but are excluded by :meth:`to_adata`.
+
+    Parameters
+    ----------
+    groups
+        Data frame with one row per group and one column per grouping variable
+    n_obs
+        Number of observations per group
+    moments
+        Dictionary with one (groups x vars) array for each moment
+    var
+        The `var` data frame of the original anndata object
+    """
+
+    def __init__(
+        self,
+        groups: pd.DataFrame,
+        n_obs: np.ndarray,
+        moments: Mapping[str, np.ndarray],
+        var: pd.DataFrame,
+    ):
+        self.groups = groups
+        self.n_obs = n_obs
+        self.moments = dict(moments)
+        self.var = var
+
+    @classmethod
+    def from_adata(
+        cls,
+        adata: AnnData,
+        *,
+        groupby: Union[str, Sequence[str]],
+        stats: Sequence[str] = ("sum", "mean"),
+        layer: Optional[str] = None,
+        use_raw: bool = False,
+        acc_dtype=None,
+        chunksize: Optional[int] = None,
+        n_jobs: Optional[int] = 1,
+    ) -> "PseudobulkCube":
+        """
+        Compute the cube from a single-cell anndata object.
+
+        Parameters
+        ----------
+        adata
+            annotated data matrix
+        groupby
+            One or multiple columns to group by. This should be the finest grouping that
+            is needed, as the cube can only be rolled up to subsets of these columns.
+        stats
+            Statistics that should be available from the cube. See :func:`pseudobulk`.
+        layer, use_raw, acc_dtype, chunksize, n_jobs
+            See :func:`pseudobulk`.
+        """
+        if isinstance(groupby, str):
+            groupby = [groupby]
+        _check_stats(stats)
+        if chunksize is None and adata.isbacked:
+            chunksize = 10000
+        codes, groups = _factorize_groups(adata.obs, groupby, dropna=False)
+        return cls._from_codes(
+            adata,
+            codes,
+            groups,
+            stats=stats,
+            layer=layer,
+            use_raw=use_raw,
+            acc_dtype=acc_dtype,
+            chunksize=chunksize,
+            n_jobs=n_jobs,
+        )
+
+    @classmethod
+    def _from_codes(
+        cls,
+        adata,
+        codes,
+        groups,
+        *,
+        stats,
+        layer,
+        use_raw,
+        acc_dtype,
+        chunksize,
+        n_jobs=1,
+    ):
+        """Compute the cube from pre-computed group codes (see `_factorize_groups`)"""
+        n_obs = np.bincount(codes[codes >= 0], minlength=groups.shape[0])
+        X, codes, rows, var_idx = _resolve_view(
+            adata, codes, use_raw=use_raw, layer=layer
+        )
+        moments = _group_moments(
+            X,
+            codes,
+            rows=rows,
+            n_groups=groups.shape[0],
+            moments={m for stat in stats for m in STATS[stat][0]},
+            acc_dtype=acc_dtype,
+            chunksize=chunksize,
+            n_jobs=n_jobs,
+        )
+        if var_idx is not None:
+            moments = {m: x[:, var_idx] for m, x in moments.items()}
+        return cls(groups, n_obs, moments, adata.raw.var if use_raw else adata.var)
+
+    @property
+    def groupby(self) -> List[str]:
+        """The columns the cube is grouped by"""
+        return self.groups.columns.tolist()
+
+    def rollup(self, groupby: Union[str, Sequence[str]]) -> "PseudobulkCube":
+        """
+        Aggregate the cube to a coarser grouping.
+
+        Parameters
+        ----------
+        groupby
+            One or multiple columns to group by. Must be a subset of :attr:`groupby`.
+
+        Returns
+        -------
+        A new cube with one group per unique combination of the `groupby` columns.
+        """
+        if isinstance(groupby, str):
+            groupby = [groupby]
+        missing = [col for col in groupby if col not in self.groupby]
+        if missing:
+            raise ValueError(
+                f"Can only roll up to a subset of {self.groupby}. Invalid columns: {missing}"
+            )
+        codes, groups = _factorize_groups(self.groups, groupby, dropna=False)
+        indicator = _indicator_matrix(codes, groups.shape[0], dtype=np.int64)
+        moments = {m: indicator @ x for m, x in self.moments.items()}
+        return PseudobulkCube(groups, indicator @ self.n_obs, moments, self.var)
+
+    def get_stat(self, stat: str) -> np.ndarray:
+        """Compute a statistic (see :func:`pseudobulk`) for all groups in the cube"""
+        _check_stats([stat])
+        missing = [m for m in STATS[stat][0] if m not in self.moments]
+        if missing:
+            raise ValueError(
+                f"Statistic {stat} requires the moments {missing}, "
+                "which have not been computed for this cube."
+            )
+        return STATS[stat][1](self.moments, self.n_obs[:, np.newaxis])
+
+    def to_adata(
+        self,
+        aggr_fun=np.sum,
+        *,
+        min_obs=10,
+        stats: Sequence[str] = (),
+        dtype=None,
+        sparse: bool = False,
+    ) -> AnnData:
+        """
+        Generate a pseudobulk anndata object from the cube.
+
+        Parameters
+        ----------
+        aggr_fun
+            Either `np.sum` or `np.mean`.
+        min_obs
+            Exclude groups with less than `min_obs` observations
+        stats
+            Statistics to add as layers. See :func:`pseudobulk`.
+        dtype, sparse
+            See :func:`pseudobulk`.
+
+        Returns
+        -------
+        The same anndata object :func:`pseudobulk` would generate from the cell-level data.
+        """
+        if aggr_fun not in _AGGR_FUNS:
+            raise ValueError("A pseudobulk cube only supports `np.sum` or `np.mean`.")
+        keep = (self.n_obs >= min_obs) & self.groups.notnull().all(axis=1).values
+        cube = PseudobulkCube(
+            self.groups.loc[keep, :].reset_index(drop=True),
+            self.n_obs[keep],
+            {m: x[keep, :] for m, x in self.moments.items()},
+            self.var,
+        )
+        return cube._make_adata(
+            cube.get_stat(_AGGR_FUNS[aggr_fun]), stats=stats, dtype=dtype, sparse=sparse
+        )
+
+    def _make_adata(
+        self, X, *, stats: Sequence[str], dtype=None, sparse: bool = False
+    ) -> AnnData:
+        def _format(x):
+            if dtype is not None:
+                x = x.astype(dtype)
+            return scipy.sparse.csr_matrix(x) if sparse else x
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ImplicitModificationWarning)
+            return AnnData(
+                X=_format(X),
+                var=self.var,
+                obs=self.groups.assign(n_obs=self.n_obs),
+                layers={stat: _format(self.get_stat(stat)) for stat in stats},
+            )
+
+
+class PseudobulkCache:
+    """
+    Persistent on-disk cache for :func:`pseudobulk` results.
+
+    Each result is stored as compressed `.npz` file named after the fingerprint of the
+    computation. Only numeric and string arrays are stored, such that files are loaded
+    without unpickling. When the total size of the cache exceeds `max_size`, the least
+    recently used results are evicted.
+
+    Parameters
+    ----------
+    path
+        Directory in which the results are stored. Will be created if it doesn't exist.
+    max_size
+        Maximum size of the cache directory in bytes.
+    """
+
+    def __init__(self, path: Union[str, Path], max_size: int = 10 * 1024**3):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{key}.npz"
+
+    def get(self, key: str) -> Optional[AnnData]:
+        """Load a result from the cache. Returns None if the key is not cached.
+
+        The returned object does not have `var` annotations, they need to be added by the caller.
+        """
+        file = self._file(key)
+        try:
+            with np.load(file, allow_pickle=False) as npz:
+                arrays = dict(npz)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(file)
+
+        def _load_matrix(prefix):
+            if f"{prefix}_indptr" in arrays:
+                return scipy.sparse.csr_matrix(
+                    (
+                        arrays[f"{prefix}_data"],
+                        arrays[f"{prefix}_indices"],
+                        arrays[f"{prefix}_indptr"],
+                    ),
+                    shape=tuple(arrays[f"{prefix}_shape"]),
+                )
+            return arrays[prefix]
+
+        def _load_column(prefix):
+            values = arrays[prefix]
+            if f"{prefix}_na" in arrays:
+                # strings, see `put`
+                values = values.astype(object)
+                values[arrays[f"{prefix}_na"]] = np.nan
+            return values
+
+        obs = pd.DataFrame(
+            {
+                col: _load_column(f"obs_{i}")
+                for i, col in enumerate(arrays["obs_columns"].tolist())
+            }
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ImplicitModificationWarning)
+            return AnnData(
+                X=_load_matrix("X"),
+                obs=obs,
+                layers={
+                    layer: _load_matrix(f"layer_{i}")
+                    for i, layer in enumerate(arrays["layers"].tolist())
+                },
+            )
+
+    def put(self, key: str, adata: AnnData):
+        """Store a pseudobulk result in the cache and evict old entries if necessary"""
+        arrays = {}
+
+        def _store_matrix(prefix, x):
+            if scipy.sparse.issparse(x):
+                x = scipy.sparse.csr_matrix(x)
+                arrays[f"{prefix}_data"] = x.data
+                arrays[f"{prefix}_indices"] = x.indices
+                arrays[f"{prefix}_indptr"] = x.indptr
+                arrays[f"{prefix}_shape"] = np.array(x.shape)
+            else:
+                arrays[prefix] = np.asarray(x)
+
+        def _store_column(prefix, values) -> bool:
+            values = np.asarray(values)
+            if values.dtype.kind in "biuf":
+                arrays[prefix] = values
+                return True
+            # other columns are stored as strings with a mask of missing values
+            isna = pd.isnull(values)
+            if not all(isinstance(v, str) for v in values[~isna]):
+                return False
+            arrays[prefix] = np.where(isna, "", values).astype(str)
+            arrays[f"{prefix}_na"] = isna
+            return True
+
+        names = [*adata.obs.columns, *adata.layers.keys()]
+        if not all(isinstance(name, str) for name in names) or not all(
+            _store_column(f"obs_{i}", adata.obs[col].values)
+            for i, col in enumerate(adata.obs.columns)
+        ):
+            warnings.warn(
+                "Only numeric and string columns can be cached. Not caching the result."
+            )
+            return
 
-    combinations = adata.obs.loc[:, groupby].drop_duplicates()
+        _store_matrix("X", adata.X)
+        arrays["layers"] = np.array(list(adata.layers.keys()), dtype=str)
+        for i, layer in enumerate(adata.layers.keys()):
+            _store_matrix(f"layer_{i}", adata.layers[layer])
+        arrays["obs_columns"] = np.array(adata.obs.columns.tolist(), dtype=str)
 
-    if adata.is_view:
-        # for whatever reason, the pseudobulk function is terribly slow when operating on a view.
-        adata = adata.copy()
+        # Write to a temporary file first, such that concurrent readers never see incomplete
+        # files. The suffix must not be `.npz`, otherwise it would be evicted by other processes.
+        tmp_file = self.path / f".{key}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_file, self._file(key))
+        self._evict()
 
-    # precompute masks
-    masks = {}
+    def _evict(self):
+        """Remove least recently used entries until the cache fits into `max_size`"""
+        files = []
+        for file in self.path.glob("*.npz"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files, key=lambda x: x[0]):
+            if total_size <= self.max_size:
+                break
+            file.unlink(missing_ok=True)
+            total_size -= size
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        for file in self.path.glob("*.npz"):
+            file.unlink(missing_ok=True)
+
+
+def _fingerprint(
+    adata: AnnData, codes: np.ndarray, groups: pd.DataFrame, **params
+) -> str:
+    """
+    Compute a key that identifies a pseudobulk computation.
+
+    The key is a hash of the aggregated matrix, the group assignment of each row,
+    the groups, the variables and additional parameters.
+    For backed objects, the file name, size and modification time are used instead of
+    the matrix contents.
+    """
+    h = hashlib.blake2b(digest_size=20)
+
+    def _update(x):
+        h.update(np.ascontiguousarray(x).view(np.uint8).ravel())
+
+    X, codes, rows, var_idx = _resolve_view(
+        adata, codes, use_raw=params["use_raw"], layer=params["layer"]
+    )
+    h.update(repr((X.shape, str(X.dtype), params)).encode())
+    if adata.isbacked:
+        filename = Path(adata.filename).resolve()
+        stat = filename.stat()
+        h.update(repr((str(filename), stat.st_size, stat.st_mtime_ns)).encode())
+    elif scipy.sparse.issparse(X):
+        h.update(X.format.encode())
+        for arr in [X.data, X.indices, X.indptr]:
+            _update(arr)
+    else:
+        _update(np.asarray(X))
+    _update(codes)
+    if rows is not None:
+        _update(rows)
+    if var_idx is not None:
+        _update(var_idx)
+    var_names = adata.raw.var_names if params["use_raw"] else adata.var_names
+    _update(pd.util.hash_pandas_object(pd.Series(var_names), index=False).values)
+    h.update(repr(groups.columns.tolist()).encode())
+    _update(pd.util.hash_pandas_object(groups, index=False).values)
+    return h.hexdigest()
+
+
+def _check_stats(stats: Sequence[str]):
+    for stat in stats:
+        if stat not in STATS:
+            raise ValueError(f"Unsupported statistic: {stat}!")
+
+
+#: Aggregation functions that are computed from the moments
+_AGGR_FUNS = {np.sum: "sum", np.mean: "mean"}
+
+
+#: Statistics supported by :func:`pseudobulk`. Maps the name of the statistic
+#: onto the per-group moments it requires and a function that computes the statistic
+#: from the moments and the number of observations per group.
+STATS = {
+    "sum": (("sum",), lambda m, n: m["sum"]),
+    "mean": (("sum",), lambda m, n: _mean(m["sum"], n)),
+    "n_expressed": (("n_expressed",), lambda m, n: m["n_expressed"]),
+    "frac_expressed": (("n_expressed",), lambda m, n: m["n_expressed"] / n),
+    "var": (
+        ("sum", "sum_sq"),
+        # clip small negative values caused by floating point errors
+        lambda m, n: np.maximum(m["sum_sq"] / n - (m["sum"] / n) ** 2, 0),
+    ),
+}
+
+
+def _mean(sums: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """Divide sums by the group sizes. Floating point sums keep their dtype, like `np.mean`."""
+    mean = sums / n
+    if np.issubdtype(sums.dtype, np.floating):
+        return mean.astype(sums.dtype, copy=False)
+    return mean
+
+
+#: Transformations applied to (the non-zero values of) a block of rows before
+#: summing them up by group to obtain the respective moment. `None` means the values
+#: are summed up as they are.
+_MOMENTS = {
+    "sum": None,
+    "sum_sq": lambda x: x.astype(np.float64) ** 2,
+    "n_expressed": lambda x: (x != 0).astype(np.int64),
+}
+
+
+def _factorize_groups(
+    obs: pd.DataFrame, groupby: Sequence[str], *, dropna: bool = True
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """
+    Map each row of `obs` to an integer code identifying its combination of `groupby` values.
+
+    Combinations are numbered in order of their first appearance. If `dropna` is True,
+    rows with a missing value in any of the columns get the code -1, otherwise
+    missing values are treated like any other value.
+
+    Returns
+    -------
+    codes
+        integer array with one entry per row in `obs`
+    groups
+        data frame with one row per group (in the order of the codes) and the
+        `groupby` columns.
+    """
+    col_codes = []
+    col_uniques = []
     for col in groupby:
-        masks[col] = {}
-        for val in combinations[col].unique():
-            masks[col][val] = adata.obs[col] == val
+        # plain values, such that the result does not depend on categorical dtypes
+        tmp_codes, tmp_uniques = _factorize(obs[col], dropna=dropna)
+        col_codes.append(tmp_codes)
+        col_uniques.append(tmp_uniques)
 
-    expr_agg = []
-    obs = []
+    valid = np.all(np.vstack(col_codes) >= 0, axis=0)
+
+    # combine the per-column codes into a single key. Re-factorizing after each column
+    # keeps the key smaller than n_obs and avoids overflows with many columns.
+    key = np.zeros(np.sum(valid), dtype=np.int64)
+    for tmp_codes, tmp_uniques in zip(col_codes, col_uniques):
+        key = pd.factorize(key * len(tmp_uniques) + tmp_codes[valid], sort=False)[0]
+
+    codes = np.full(obs.shape[0], -1, dtype=np.int64)
+    codes[valid] = key
+    first_row = np.flatnonzero(valid)[np.unique(key, return_index=True)[1]]
+
+    groups = pd.DataFrame(
+        {
+            col: tmp_uniques[tmp_codes[first_row]]
+            for col, tmp_codes, tmp_uniques in zip(groupby, col_codes, col_uniques)
+        }
+    )
+    return codes, groups
+
+
+def _filter_groups(
+    codes: np.ndarray, groups: pd.DataFrame, *, min_obs: int
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Remove groups with less than `min_obs` observations and renumber the codes consecutively"""
+    n_obs = np.bincount(codes[codes >= 0], minlength=groups.shape[0])
+    keep = n_obs >= min_obs
+    new_codes = np.full(groups.shape[0], -1)
+    new_codes[keep] = np.arange(np.sum(keep))
+    codes = np.where(codes >= 0, new_codes[codes], -1)
+    return codes, groups.loc[keep, :].reset_index(drop=True)
+
+
+def _resolve_view(
+    adata: AnnData, codes: np.ndarray, *, use_raw: bool = False, layer=None
+):
+    """
+    Resolve the rows of an anndata view against the matrix of its parent object.
+
+    Accessing `.X` of a view materializes the subset of the matrix. Instead, we read the
+    rows of the view from the parent matrix block by block (see `_iter_row_blocks`). The
+    result only needs to be subset to the variables of the view afterwards.
+
+    `use_raw` and `layer` select the matrix as in :func:`scanpy_helpers.util._choose_mtx_rep`.
+
+    Returns
+    -------
+    X
+        The matrix to aggregate
+    codes
+        The group codes, one for each row in `rows`
+    rows
+        Sorted indices of the rows of `X` to aggregate, or None if all rows are used.
+    var_idx
+        Indices of the variables to keep after aggregation, or None if all variables
+        are used.
+    """
+    if not adata.is_view:
+        return _choose_mtx_rep(adata, use_raw=use_raw, layer=layer), codes, None, None
+
+    parent = adata._adata_ref
+    obs_idx = np.arange(parent.n_obs)[adata._oidx]
+    order = np.argsort(obs_idx, kind="stable")
+    rows = obs_idx[order]
+    if np.any(rows[1:] == rows[:-1]):
+        # a row that is contained several times in the view cannot be read only once
+        return _choose_mtx_rep(adata, use_raw=use_raw, layer=layer), codes, None, None
+
+    # sums don't depend on the order of the rows, sorted indices can be read from backed
+    # matrices in a single pass
+    codes = codes[order]
+    if np.array_equal(rows, np.arange(parent.n_obs)):
+        rows = None
+    # the raw matrix is never subset by variables
+    var_idx = None if use_raw else np.arange(parent.n_vars)[adata._vidx]
+    if var_idx is not None and np.array_equal(var_idx, np.arange(parent.n_vars)):
+        var_idx = None
+    return _choose_mtx_rep(parent, use_raw=use_raw, layer=layer), codes, rows, var_idx
+
+
+def _indicator_matrix(
+    codes: np.ndarray, n_groups: int, dtype=np.float64
+) -> scipy.sparse.csr_matrix:
+    """Sparse (groups x cells) matrix with a one where a cell belongs to a group."""
+    mask = codes >= 0
+    return scipy.sparse.csr_matrix(
+        (np.ones(np.sum(mask), dtype=dtype), (codes[mask], np.flatnonzero(mask))),
+        shape=(n_groups, codes.shape[0]),
+    )
+
+
+def _iter_row_blocks(
+    X, codes: np.ndarray, chunksize: Optional[int], rows: Optional[np.ndarray] = None
+):
+    """
+    Yield `(start, stop, block)` for consecutive blocks of `chunksize` rows of `X`.
+
+    `start` and `stop` refer to positions in `codes`. If `rows` is given, only these
+    (sorted) rows of `X` are read, by default 10000 at a time.
 
-    for comb in combinations.itertuples(index=False):
-        mask = reduce(and_, (masks[col][val] for col, val in zip(groupby, comb)))
-        if np.sum(mask) < min_obs:
+    Works for in-memory matrices as well as for h5py datasets and backed sparse
+    matrices, which are only read block by block. Blocks without any row
+    that belongs to a group are skipped without reading them. Without `chunksize`,
+    an in-memory `X` is the only block.
+    """
+    n_rows = codes.shape[0]
+    if rows is not None:
+        chunksize = 10000 if chunksize is None else chunksize
+        for start in range(0, n_rows, chunksize):
+            stop = min(start + chunksize, n_rows)
+            if np.any(codes[start:stop] >= 0):
+                yield start, stop, X[rows[start:stop]]
+        return
+
+    in_memory = isinstance(X, np.ndarray) or scipy.sparse.issparse(X)
+    if in_memory and (chunksize is None or chunksize >= n_rows):
+        # a single block: don't slice, which would copy the whole matrix
+        if np.any(codes >= 0):
+            yield 0, n_rows, X
+        return
+    for start in range(0, n_rows, chunksize):
+        stop = min(start + chunksize, n_rows)
+        if np.any(codes[start:stop] >= 0):
+            yield start, stop, X[start:stop]
+
+
+def _transform_values(x, fun, dtype):
+    """
+    Apply an elementwise function to a dense matrix or to the stored values of a sparse
+    matrix and convert the result to `dtype`.
+
+    `x` is returned unchanged if `fun` is None and it already has the right dtype. A
+    transformed sparse matrix shares its index arrays with `x`.
+    """
+    if fun is None and x.dtype == dtype:
+        return x
+    if scipy.sparse.issparse(x):
+        data = x.data if fun is None else fun(x.data)
+        return type(x)(
+            (data.astype(dtype, copy=False), x.indices, x.indptr), shape=x.shape
+        )
+    else:
+        x = np.asarray(x)
+        return (x if fun is None else fun(x)).astype(dtype, copy=False)
+
+
+def _weighted_sum(
+    X,
+    weights,
+    codes: np.ndarray,
+    *,
+    rows: Optional[np.ndarray] = None,
+    chunksize: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Compute `weights @ X[rows]` block by block.
+
+    Rows with a negative code are not read.
+    """
+    weights = weights.tocsc()
+    dtype = np.result_type(X.dtype, weights.dtype)
+    res = np.zeros((weights.shape[0], X.shape[1]), dtype=dtype)
+    for start, stop, block in _iter_row_blocks(X, codes, chunksize, rows):
+        tmp_res = weights[:, start:stop] @ block
+        if scipy.sparse.issparse(tmp_res):
+            tmp_res = tmp_res.toarray()
+        res += np.asarray(tmp_res)
+    return res
+
+
+def _group_moments(
+    X,
+    codes: np.ndarray,
+    *,
+    n_groups: int,
+    rows: Optional[np.ndarray] = None,
+    moments=("sum",),
+    acc_dtype=None,
+    chunksize: Optional[int] = None,
+    n_jobs: Optional[int] = 1,
+) -> Dict[str, np.ndarray]:
+    """
+    Sum the rows of `X` (and transformations thereof, see `_MOMENTS`) by group.
+
+    `codes` assigns each row of `X` (or each of the `rows` of `X`, see `_resolve_view`)
+    to a group.
+
+    Each block of rows is multiplied with the corresponding columns of a sparse
+    indicator matrix and added to the result. All moments are computed from
+    the same block, i.e. the matrix is only read once.
+
+    With `n_jobs > 1`, CSR blocks are instead split into `n_jobs` row partitions
+    with a similar number of non-zero values. Each partition is processed by a numba
+    kernel that releases the GIL and adds into its own partial result. The partial
+    results are summed up in a fixed order in the end. This requires `n_jobs` copies
+    of the result in memory.
+    """
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = cpu_count()
+    elif n_jobs < 1:
+        raise ValueError(f"n_jobs must be a positive integer, -1 or None, got {n_jobs}")
+    dtypes = {
+        "sum": _sum_dtype(X.dtype, acc_dtype),
+        "sum_sq": np.float64,
+        "n_expressed": np.int64,
+    }
+    # One indicator matrix per accumulation dtype, such that the blocks don't need to be
+    # converted for the product. CSC, because we slice by column (=cell) below.
+    indicators = {
+        dtype: _indicator_matrix(codes, n_groups, dtype=dtype).tocsc()
+        for dtype in {np.dtype(dtypes[m]) for m in moments}
+    }
+    res = {m: np.zeros((n_groups, X.shape[1]), dtype=dtypes[m]) for m in moments}
+    partials = None
+
+    # no thread pool is needed if the blocks are processed inline
+    with (
+        ThreadPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else nullcontext()
+    ) as executor:
+        for start, stop, block in _iter_row_blocks(X, codes, chunksize, rows):
+            if n_jobs > 1 and scipy.sparse.issparse(block) and block.format == "csr":
+                if partials is None:
+                    partials = [
+                        {m: np.zeros_like(x) for m, x in res.items()}
+                        for _ in range(n_jobs)
+                    ]
+                _group_moments_csr_parallel(
+                    block, codes[start:stop], partials, dtypes, executor
+                )
+                continue
+
+            for m in moments:
+                tmp_indicator = indicators[np.dtype(dtypes[m])]
+                if stop - start != tmp_indicator.shape[1]:
+                    tmp_indicator = tmp_indicator[:, start:stop]
+                tmp_res = tmp_indicator @ _transform_values(
+                    block, _MOMENTS[m], dtypes[m]
+                )
+                if scipy.sparse.issparse(tmp_res):
+                    tmp_res = tmp_res.toarray()
+                res[m] += np.asarray(tmp_res)
+
+    if partials is not None:
+        for tmp_partial in partials:
+            for m in moments:
+                res[m] += tmp_partial[m]
+    return res
+
+
+def _sum_dtype(dtype, acc_dtype=None) -> np.dtype:
+    """
+    dtype used for accumulating sums. Floating point values are summed in their own dtype,
+    integers as int64 to avoid overflows on large groups.
+    """
+    if acc_dtype is not None:
+        return np.dtype(acc_dtype)
+    if np.issubdtype(dtype, np.floating):
+        return np.dtype(dtype)
+    return np.result_type(dtype, np.int64)
+
+
+def _group_moments_csr_parallel(
+    block: scipy.sparse.csr_matrix,
+    codes: np.ndarray,
+    partials: Sequence[Dict[str, np.ndarray]],
+    dtypes: Mapping[str, np.dtype],
+    executor: ThreadPoolExecutor,
+):
+    """Add the moments of a CSR block into per-thread partial results (see `_group_moments`)"""
+    indptr = block.indptr.astype(np.int64, copy=False)
+    # partition rows such that each partition has approximately the same number of non-zeros
+    bounds = np.searchsorted(
+        indptr, np.linspace(0, indptr[-1], len(partials) + 1), side="left"
+    )
+    bounds[0], bounds[-1] = 0, block.shape[0]
+    bounds = np.minimum(bounds, block.shape[0])
+    data_sum = block.data.astype(dtypes["sum"], copy=False)
+    empty = np.zeros((0, 0))
+
+    def _run(i):
+        tmp_partial = partials[i]
+        _csr_group_moments_kernel(
+            indptr,
+            block.indices,
+            block.data,
+            data_sum,
+            codes,
+            bounds[i],
+            bounds[i + 1],
+            tmp_partial.get("sum", empty.astype(dtypes["sum"])),
+            tmp_partial.get("sum_sq", empty),
+            tmp_partial.get("n_expressed", empty.astype(np.int64)),
+        )
+
+    # list() to propagate exceptions
+    list(executor.map(_run, range(len(partials))))
+
+
+@njit(nogil=True, cache=True)
+def _csr_group_moments_kernel(
+    indptr,
+    indices,
+    data,
+    data_sum,
+    codes,
+    row_start,
+    row_stop,
+    sum_,
+    sum_sq,
+    n_expressed,
+):
+    """
+    Add the moments of rows `row_start:row_stop` of a CSR matrix into the (groups x vars)
+    arrays `sum_`, `sum_sq` and `n_expressed`. Empty arrays are skipped.
+    """
+    do_sum = sum_.shape[0] > 0
+    do_sum_sq = sum_sq.shape[0] > 0
+    do_n_expressed = n_expressed.shape[0] > 0
+    for i in range(row_start, row_stop):
+        g = codes[i]
+        if g < 0:
             continue
-        expr_row = aggr_fun(adata.X[mask, :], axis=0)
-        obs_row = comb._asdict()
-        obs_row["n_obs"] = np.sum(mask)
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            if do_sum:
+                sum_[g, j] += data_sum[k]
+            if do_sum_sq:
+                sum_sq[g, j] += np.float64(data[k]) ** 2
+            if do_n_expressed and data[k] != 0:
+                n_expressed[g, j] += 1
+
+
+def _group_apply(X, codes: np.ndarray, *, n_groups: int, aggr_fun) -> np.ndarray:
+    """
+    Apply an arbitrary aggregation function to each group.
+
+    Rows are sorted by group once, such that each group is a contiguous slice of
+    row indices instead of a boolean mask over all cells.
+    """
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(n_groups + 1))
+    expr_agg = []
+    for i in range(n_groups):
+        expr_row = aggr_fun(X[order[bounds[i] : bounds[i + 1]], :], axis=0)
         # convert matrix to array if required (happens when aggregating spares matrix)
         try:
             expr_row = expr_row.A1
         except AttributeError:
-            pass
-        obs.append(obs_row)
+            expr_row = np.asarray(expr_row).ravel()
         expr_agg.append(expr_row)
-
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", ImplicitModificationWarning)
-        return AnnData(
-            X=np.vstack(expr_agg),
-            var=adata.var,
-            obs=pd.DataFrame.from_records(obs),
-        )
+    if not len(expr_agg):
+        return np.zeros((0, X.shape[1]))
+    return np.vstack(expr_agg)
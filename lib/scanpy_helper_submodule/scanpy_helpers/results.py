@@ -0,0 +1,326 @@
+"""Columnar storage for test results.
+
+Differential tests produce one row per variable and group (and cell-type, comparison, ...).
+Storing these as pandas data frames with object columns is expensive for millions of rows.
+A :class:`ResultTable` stores numeric columns as preallocated numpy arrays and
+string columns as integer codes into a shared set of categories, such that results of
+many tests can be appended without creating object columns. It converts to a data frame
+(with categorical columns), a numpy structured array or an Arrow table and can be
+written to parquet. :class:`ResultWriter` streams results of multiple tests to a single
+parquet file.
+"""
+
+from typing import Dict, Iterable, Optional, Union
+import numpy as np
+import pandas as pd
+from .util import _fdr_values, _log2_fc_values
+
+_INDEX_COL = "__index__"
+
+
+class ResultTable:
+    """
+    Columnar table of test results.
+
+    Numeric and boolean columns are stored as numpy arrays, all other columns (strings,
+    categoricals) are stored as categorical codes. Storage is preallocated and grows
+    geometrically. Data frames don't need to have the same columns (e.g. results of a
+    fallback implementation that doesn't provide all statistics): rows without a value
+    are NaN in numeric columns (integer and boolean columns are converted to float)
+    and missing in categorical columns.
+
+    Parameters
+    ----------
+    capacity
+        number of rows to preallocate
+    index
+        If True, the index of the appended data frames is stored (as categorical codes)
+        and restored by :meth:`to_df`.
+    """
+
+    def __init__(self, capacity: int = 1024, *, index: bool = True):
+        self._capacity = max(capacity, 1)
+        self._n_rows = 0
+        self._index = index
+        self._data: Dict[str, np.ndarray] = {}
+        self.categories: Dict[str, pd.Index] = {}
+        """Categories of the categorical columns. The stored codes index into these."""
+
+    def __len__(self):
+        return self._n_rows
+
+    @property
+    def columns(self):
+        return [c for c in self._data if c != _INDEX_COL]
+
+    def _add_column(self, col: str, values: pd.Series):
+        """Add a column. Existing rows are filled with missing values."""
+        if _is_numeric(values):
+            dtype = values.dtype
+            if self._n_rows and not np.issubdtype(dtype, np.floating):
+                dtype = np.float64
+            self._data[col] = np.empty(self._capacity, dtype=dtype)
+            if self._n_rows:
+                self._data[col][: self._n_rows] = np.nan
+        else:
+            self._data[col] = np.full(self._capacity, -1, dtype=np.int32)
+            self.categories[col] = pd.Index([], dtype=object)
+
+    def _grow(self, n_rows: int):
+        if n_rows <= self._capacity:
+            return
+        while self._capacity < n_rows:
+            self._capacity *= 2
+        for col, arr in self._data.items():
+            new_arr = np.empty(self._capacity, dtype=arr.dtype)
+            new_arr[: self._n_rows] = arr[: self._n_rows]
+            self._data[col] = new_arr
+
+    def _encode(self, col: str, values) -> np.ndarray:
+        """Get codes of values, extending the categories of the column if necessary"""
+        cat = pd.Categorical(values)
+        cat_idx = self.categories[col].get_indexer(cat.categories)
+        missing = cat_idx < 0
+        if np.any(missing):
+            n_existing = len(self.categories[col])
+            self.categories[col] = self.categories[col].append(
+                pd.Index(cat.categories[missing], dtype=object)
+            )
+            cat_idx[missing] = np.arange(n_existing, n_existing + np.sum(missing))
+        # missing values keep the code -1
+        return np.append(cat_idx, -1)[cat.codes].astype(np.int32)
+
+    def append(self, df: pd.DataFrame, **constants) -> "ResultTable":
+        """
+        Append rows from a data frame
+
+        Parameters
+        ----------
+        df
+            data frame with test results
+        **constants
+            Additional columns with the same value for all rows, e.g. `cell_type="T cell"`.
+        """
+        if not df.shape[0]:
+            return self
+        df = df.assign(**constants)
+        if self._index:
+            df = df.assign(**{_INDEX_COL: df.index.values})
+        for col, values in df.items():
+            if col not in self._data:
+                self._add_column(col, values)
+
+        n_new = df.shape[0]
+        self._grow(self._n_rows + n_new)
+        rows = slice(self._n_rows, self._n_rows + n_new)
+        for col, arr in self._data.items():
+            if col not in df.columns:
+                # e.g. results from a fallback implementation that doesn't provide all statistics
+                if col in self.categories:
+                    arr[rows] = -1
+                else:
+                    if not np.issubdtype(arr.dtype, np.floating):
+                        arr = self._data[col] = arr.astype(np.float64)
+                    arr[rows] = np.nan
+            elif col in self.categories:
+                arr[rows] = self._encode(col, df[col].values)
+            else:
+                # e.g. an integer column that is float in other results
+                dtype = np.result_type(arr.dtype, df[col].dtype)
+                if dtype != arr.dtype:
+                    arr = self._data[col] = arr.astype(dtype)
+                arr[rows] = df[col].values
+        self._n_rows += n_new
+        return self
+
+    def extend(self, dfs: Iterable[pd.DataFrame], **constants) -> "ResultTable":
+        """Append rows from multiple data frames"""
+        for df in dfs:
+            self.append(df, **constants)
+        return self
+
+    def column(self, col: str) -> Union[np.ndarray, pd.Categorical]:
+        """Get a column as numpy array (numeric columns) or categorical (all others)"""
+        values = self._data[col][: self._n_rows]
+        if col in self.categories:
+            return pd.Categorical.from_codes(values, categories=self.categories[col])
+        return values
+
+    def to_df(self) -> pd.DataFrame:
+        """Convert to a data frame. String columns are returned as categoricals."""
+        return pd.DataFrame(
+            {col: self.column(col) for col in self.columns},
+            index=(
+                pd.Index(np.asarray(self.column(_INDEX_COL)))
+                if _INDEX_COL in self._data
+                else None
+            ),
+        )
+
+    def to_numpy(self) -> np.ndarray:
+        """
+        Convert to a numpy structured array.
+
+        Categorical columns are represented by their codes, see :attr:`categories`.
+        """
+        arr = np.empty(
+            self._n_rows, dtype=[(col, a.dtype) for col, a in self._data.items()]
+        )
+        for col, a in self._data.items():
+            arr[col] = a[: self._n_rows]
+        return arr
+
+    def to_arrow(self):
+        """Convert to a `pyarrow.Table`. Categorical columns are dictionary-encoded."""
+        import pyarrow as pa
+
+        arrays = {}
+        for col in self._data:
+            values = self._data[col][: self._n_rows]
+            if col in self.categories:
+                arrays[col] = pa.DictionaryArray.from_arrays(
+                    pa.array(values, mask=values < 0),
+                    pa.array(self.categories[col].astype(str), type=pa.string()),
+                )
+            else:
+                arrays[col] = pa.array(values)
+        return pa.table(arrays)
+
+    def write_parquet(self, path, **kwargs):
+        """Write the table to a parquet file. Keyword arguments are passed to `pyarrow.parquet.write_table`."""
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), path, **kwargs)
+
+    def fdr_correction(
+        self,
+        pvalue_col: str = "pvalue",
+        *,
+        key_added: str = "fdr",
+        groupby: Optional[str] = None,
+    ) -> "ResultTable":
+        """
+        Add a column with FDR-adjusted pvalues.
+
+        See :func:`scanpy_helpers.util.fdr_correction`. Modifies the table inplace.
+        """
+        groups = None if groupby is None else self._data[groupby][: self._n_rows]
+        self._set_column(
+            key_added, _fdr_values(self._data[pvalue_col][: self._n_rows], groups)
+        )
+        return self
+
+    def log2_fc(
+        self,
+        mean_col: str = "intercept",
+        diff_col: str = "coef",
+        key_added: str = "log2_fc",
+        logfun=np.log2,
+    ) -> "ResultTable":
+        """
+        Add a column with log fold changes.
+
+        See :func:`scanpy_helpers.util.log2_fc`. Modifies the table inplace.
+        """
+        self._set_column(
+            key_added,
+            _log2_fc_values(
+                self._data[mean_col][: self._n_rows],
+                self._data[diff_col][: self._n_rows],
+                logfun,
+            ),
+        )
+        return self
+
+    def _set_column(self, col: str, values: np.ndarray):
+        arr = np.empty(self._capacity, dtype=values.dtype)
+        arr[: self._n_rows] = values
+        self._data[col] = arr
+
+
+class ResultWriter:
+    """
+    Stream test results to a parquet file.
+
+    Each call to :meth:`write` appends a row group. Categorical columns are
+    dictionary-encoded, such that the results never need to be held in memory as a
+    whole or as object columns.
+
+    Parameters
+    ----------
+    path
+        output parquet file
+    **kwargs
+        passed to `pyarrow.parquet.ParquetWriter`
+
+    Examples
+    --------
+    >>> with ResultWriter("results.parquet") as writer:
+    ...     for comparison in comparisons:
+    ...         writer.write(lm_test_all(..., as_table=True), comparison=comparison)
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self._kwargs = kwargs
+        self._writer = None
+        self._schema = None
+
+    def write(self, results: Union[ResultTable, pd.DataFrame], **constants):
+        """
+        Append results
+
+        Parameters
+        ----------
+        results
+            A :class:`ResultTable` or a data frame
+        **constants
+            Additional columns with the same value for all rows, e.g. `comparison="luad_lusc"`.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if isinstance(results, pd.DataFrame):
+            results = ResultTable(max(results.shape[0], 1)).append(results)
+        table = results.to_arrow()
+        for col, value in constants.items():
+            table = table.append_column(
+                col,
+                pa.DictionaryArray.from_arrays(
+                    pa.array(np.zeros(table.num_rows, dtype=np.int32)),
+                    pa.array([str(value)]),
+                ),
+            )
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(self.path, self._schema, **self._kwargs)
+        self._writer.write_table(table.select(self._schema.names).cast(self._schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def concat_results(dfs: Iterable[pd.DataFrame], **kwargs) -> pd.DataFrame:
+    """
+    Concatenate result data frames.
+
+    Unlike `pd.concat`, string columns are combined into categoricals with the union
+    of all categories instead of object columns.
+    """
+    dfs = list(dfs)
+    if not len(dfs):
+        return pd.DataFrame()
+    return ResultTable(sum(df.shape[0] for df in dfs), **kwargs).extend(dfs).to_df()
+
+
+def _is_numeric(values: pd.Series) -> bool:
+    return not isinstance(values.dtype, pd.CategoricalDtype) and (
+        np.issubdtype(values.dtype, np.number) or np.issubdtype(values.dtype, np.bool_)
+    )
@@ -9,18 +9,19 @@ The original cutoffs used in the MCP counter paper are
  * AUC ROC >= ``min_auc`` (default=0.97)
 """
 
-from typing import Callable, Dict, List, Mapping, Optional, Sequence
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple
 import numpy as np
-from sklearn.metrics import roc_auc_score
 import sklearn.model_selection
 from anndata import AnnData
 import itertools
 import scipy.stats
-from .pseudobulk import pseudobulk
+import scipy.sparse
+from .pseudobulk import pseudobulk, PseudobulkCube, _group_moments
 import scanpy as sc
 import altair as alt
 import pandas as pd
-from tqdm.contrib.concurrent import process_map
+from functools import partial
+from .parallel import parallel_map
 
 
 def fold_change(
@@ -122,14 +123,18 @@ def roc_auc(
     adata,
     *,
     obs_col,
-    positive_class,
+    positive_class=None,
     key_added="roc_auc",
     inplace=True,
 ):
     """
     Compute the Receiver Operator Characteristics Area under the Curve (ROC AUC) for a single gene `G`.
     This tells how well the gene discriminates between the two classes.
-    This is a wrapper for the scikit-learn `roc_auc_score`_ function.
+
+    The AUC is computed for all genes at once from the Mann-Whitney U statistic, which
+    gives the same results as the scikit-learn `roc_auc_score`_ function (including
+    the handling of ties). For sparse matrices, the ranks of the zero entries are
+    computed analytically.
 
     Parameters
     ----------
@@ -138,25 +143,40 @@ def roc_auc(
     obs_col
         Column in adata.obs with the annotation to compare
     positive_class
-        Value in `adata.obs[obs_col]` to be considered the positive class
+        Value in `adata.obs[obs_col]` to be considered the positive class.
+        If None, compute the AUC for each class against all other classes.
     key_added
-        Key under which the result will be stored in `adata.var`
+        Key under which the result will be stored in `adata.var`. If `positive_class` is None,
+        the results are stored as `{class}_{key_added}`.
     inplace
         If True, store the result in adata.var. Otherwise return result.
 
     Returns
     -------
-    roc auc score
+    roc auc score. If `positive_class` is None, a data frame genes x classes.
 
     .. _roc_auc_score:
         http://scikit-learn.org/stable/modules/generated/sklearn.metrics.roc_auc_score.html#sklearn.metrics.roc_auc_score
     """
+    if positive_class is None:
+        labels = pd.Categorical(adata.obs[obs_col]).remove_unused_categories()
+        n_classes = len(labels.categories)
+        # cells with a missing label are part of the negative class of all classes
+        codes = np.where(labels.codes < 0, n_classes, labels.codes)
+        auc = _roc_auc(adata.X, codes, n_classes + 1)[:n_classes]
+        roc_auc = pd.DataFrame(auc.T, index=adata.var_names, columns=labels.categories)
+        if inplace:
+            for cls in roc_auc.columns:
+                adata.var[f"{cls}_{key_added}"] = roc_auc[cls].values
+            return
+        return roc_auc
 
-    def _roc_auc(arr, mask):
-        return roc_auc_score(mask, arr)
-
-    positive_mask = adata.obs[obs_col] == positive_class
-    roc_auc = np.apply_along_axis(_roc_auc, 0, adata.X, positive_mask)
+    positive_mask = (adata.obs[obs_col] == positive_class).values
+    if np.all(positive_mask) or not np.any(positive_mask):
+        raise ValueError(
+            "Only one class present in y_true. ROC AUC score is not defined in that case."
+        )
+    roc_auc = _roc_auc(adata.X, positive_mask.astype(np.int64), 2)[1]
 
     if inplace:
         adata.var[key_added] = roc_auc
@@ -164,6 +184,178 @@ def roc_auc(
         return roc_auc
 
 
+def _roc_auc(X, codes: np.ndarray, n_classes: int) -> np.ndarray:
+    """
+    One-vs-rest ROC AUC of each column of `X` for each class.
+
+    Based on the Mann-Whitney U statistic, :math:`AUC = (R_+ - n_+(n_+ + 1)/2) / (n_+ n_-)`,
+    where :math:`R_+` is the sum of the ranks of the positive samples. Ties get their
+    average rank, which is equivalent to the trapezoidal rule used by scikit-learn.
+
+    Parameters
+    ----------
+    X
+        samples x genes matrix (dense or sparse)
+    codes
+        class of each sample as integer in `[0, n_classes)`. Samples with negative codes
+        are ignored.
+    n_classes
+        number of classes
+
+    Returns
+    -------
+    classes x genes array. NaN for classes without positive or negative samples.
+    """
+    mask = codes >= 0
+    if not np.all(mask):
+        X, codes = X[mask, :], codes[mask]
+    n_obs = X.shape[0]
+    if scipy.sparse.issparse(X):
+        rank_sum = _rank_sum_sparse(scipy.sparse.csc_matrix(X), codes, n_classes)
+    else:
+        ranks = scipy.stats.rankdata(np.asarray(X), axis=0)
+        onehot = scipy.sparse.csr_matrix(
+            (np.ones(n_obs), (codes, np.arange(n_obs))), shape=(n_classes, n_obs)
+        )
+        rank_sum = np.asarray(onehot @ ranks)
+
+    n_pos = np.bincount(codes, minlength=n_classes)[:, np.newaxis].astype(float)
+    n_neg = n_obs - n_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def _rank_sum_sparse(X, codes: np.ndarray, n_classes: int) -> np.ndarray:
+    """
+    Sum of the (average) ranks per class and column of a sparse matrix in CSC format.
+
+    Only the stored entries are sorted. All zeros of a column share the same average rank,
+    which is added for the zeros of each class analytically.
+    """
+    n_obs, n_vars = X.shape
+    col = np.repeat(np.arange(n_vars), np.diff(X.indptr))
+    data = X.data.astype(np.float64)
+    row = X.indices
+    # treat explicitly stored zeros like implicit zeros
+    nz = data != 0
+    col, data, row = col[nz], data[nz], row[nz]
+
+    # rank the non-zero values within each column
+    order = np.lexsort((data, col))
+    col, data, row = col[order], data[order], row[order]
+    col_start = np.searchsorted(col, np.arange(n_vars))
+    pos = np.arange(len(data)) - col_start[col] + 1
+    # average rank of ties
+    new_tie = np.ones(len(data), dtype=bool)
+    new_tie[1:] = (col[1:] != col[:-1]) | (data[1:] != data[:-1])
+    tie_id = np.cumsum(new_tie) - 1
+    tie_start = np.flatnonzero(new_tie)
+    tie_len = np.diff(np.append(tie_start, len(data)))
+    ranks = (pos[tie_start] + (tie_len - 1) / 2)[tie_id]
+
+    # positive values rank above all zeros of the column
+    n_negative = np.bincount(col[data < 0], minlength=n_vars)
+    n_zero = n_obs - np.bincount(col, minlength=n_vars)
+    ranks[data > 0] += n_zero[col[data > 0]]
+    zero_rank = n_negative + (n_zero + 1) / 2
+
+    rank_sum = scipy.sparse.coo_matrix(
+        (ranks, (codes[row], col)), shape=(n_classes, n_vars)
+    ).toarray()
+    n_nonzero = scipy.sparse.coo_matrix(
+        (np.ones(len(row)), (codes[row], col)), shape=(n_classes, n_vars)
+    ).toarray()
+    n_pos = np.bincount(codes, minlength=n_classes)[:, np.newaxis]
+    return rank_sum + (n_pos - n_nonzero) * zero_rank
+
+
+def marker_statistics(
+    adata,
+    *,
+    obs_col,
+    inplace=False,
+    keys_added: Optional[Mapping[str, str]] = None,
+):
+    """
+    Compute :func:`fold_change`, :func:`specific_fold_change` and :func:`roc_auc`
+    of each class against all other classes.
+
+    The mean of each class is computed once with a single pass over the data.
+    Fold changes and specific fold changes of all classes are derived from the
+    class-mean matrix and the AUC of all classes is computed with a single ranking
+    of each gene.
+
+    Parameters
+    ----------
+    adata
+        annotated data matrix. Values in X are expected to be log-transformed and normalized
+    obs_col
+        Column in adata.obs with the annotation to compare
+    inplace
+        If True, store the results in `adata.var` as `{class}_{key}`. Otherwise
+        return a tidy data frame.
+    keys_added
+        Mapping of the statistics (`fold_change`, `specific_fold_change`, `roc_auc`)
+        to the keys used in `adata.var`. Defaults to the names of the statistics.
+
+    Returns
+    -------
+    Data frame with the columns `gene`, `group`, `fold_change`, `specific_fold_change`
+    and `roc_auc` (if not `inplace`).
+    """
+    labels = pd.Categorical(adata.obs[obs_col]).remove_unused_categories()
+    classes = labels.categories
+    n_classes = len(classes)
+    # samples without a label are part of the negative samples of all classes
+    codes = np.where(labels.codes < 0, n_classes, labels.codes)
+
+    sums = _group_moments(adata.X, codes, n_groups=n_classes + 1, acc_dtype=np.float64)[
+        "sum"
+    ]
+    n_obs = np.bincount(codes, minlength=n_classes + 1)[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums[:n_classes] / n_obs[:n_classes]
+        mean_neg = (np.sum(sums, axis=0) - sums[:n_classes]) / (
+            adata.n_obs - n_obs[:n_classes]
+        )
+    fold_change = means - mean_neg
+
+    # minimum and maximum over all other classes: the first or second-lowest/highest mean
+    order = np.argsort(means, axis=0)
+    sorted_means = np.take_along_axis(means, order, axis=0)
+    is_min = order[0] == np.arange(n_classes)[:, np.newaxis]
+    is_max = order[-1] == np.arange(n_classes)[:, np.newaxis]
+    x_min = np.where(is_min, sorted_means[min(1, n_classes - 1)], sorted_means[0])
+    x_max = np.where(is_max, sorted_means[max(n_classes - 2, 0)], sorted_means[-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        specific_fold_change = (means - x_min) / (x_max - x_min)
+
+    auc = _roc_auc(adata.X, codes, n_classes + 1)[:n_classes]
+
+    stats = {
+        "fold_change": fold_change,
+        "specific_fold_change": specific_fold_change,
+        "roc_auc": auc,
+    }
+    if inplace:
+        keys_added = {k: k for k in stats} if keys_added is None else keys_added
+        adata.var = adata.var.assign(
+            **{
+                f"{cls}_{keys_added[stat]}": values[i]
+                for stat, values in stats.items()
+                for i, cls in enumerate(classes)
+            }
+        )
+    else:
+        return pd.DataFrame(
+            {
+                "gene": np.tile(adata.var_names.values, n_classes),
+                "group": np.repeat(classes.values, adata.n_vars),
+                **{stat: values.ravel() for stat, values in stats.items()},
+            }
+        )
+
+
 class MCPSignatureRegressor:
     def __init__(
         self,
@@ -311,17 +503,25 @@ def _get_grid(param_grid):
 
 
 def _grid_search_cv_execute_fold(
-    i,
-    reps_train_labels,
-    reps_test_labels,
-    pb_train,
-    pb_test,
+    pbs,
+    fold,
+    *,
     replicate_col,
     label_col,
     positive_class,
     grid,
+    incremental=True,
 ):
-    """Execute a single fold for the grid search. Used for parallelization"""
+    """Execute a single fold for the grid search. Used for parallelization
+
+    `pbs` is the tuple `(pb_train, pb_test)` that is shared between all folds,
+    `fold` the tuple `(i, reps_train_labels, reps_test_labels)`.
+    If `incremental` is True and the grid only contains thresholds, the grid is
+    evaluated with :func:`_threshold_sweep` instead of fitting a model for each
+    grid point.
+    """
+    pb_train, pb_test = pbs
+    i, reps_train_labels, reps_test_labels = fold
     results = []  # tuples (fold, params, score, n_genes)
 
     pb_train = pb_train[pb_train.obs[replicate_col].isin(reps_train_labels), :]
@@ -335,6 +535,19 @@ def _grid_search_cv_execute_fold(
     )
 
     print("Evaluating grid")
+    if incremental and all(set(params) <= set(_THRESHOLDS) for params in grid):
+        X_test = pb_test[:, pb_train.var_names].X
+        scores = _threshold_sweep(
+            pb_train.var,
+            np.asarray(X_test.toarray() if scipy.sparse.issparse(X_test) else X_test),
+            pb_test.obs["true_frac"].values,
+            grid,
+        )
+        return [
+            {"fold": i, **params, "score_pearson": score_pearson, "n_genes": n_genes}
+            for params, (score_pearson, n_genes) in zip(grid, scores)
+        ]
+
     for params in grid:
         mcpr = MCPSignatureRegressor(**params)
         mcpr.fit(pb_train)
@@ -357,6 +570,100 @@ def _grid_search_cv_execute_fold(
     return results
 
 
+#: parameters of :class:`MCPSignatureRegressor` -> the metric they are a threshold for
+_THRESHOLDS = {
+    "min_auroc": "roc_auc",
+    "min_fc": "fold_change",
+    "min_sfc": "specific_fold_change",
+}
+
+
+def _threshold_sweep(
+    var: pd.DataFrame, X_test: np.ndarray, true_frac: np.ndarray, grid: List[Dict]
+) -> List[Tuple[float, int]]:
+    """
+    Evaluate :class:`MCPSignatureRegressor` for a grid of thresholds at once.
+
+    Equivalent to fitting a model on `var` and computing the pearson correlation of
+    the predictions on `X_test` with `true_frac` for each grid point, but much faster
+    for large grids:
+
+     * The z-score of a gene in the test data does not depend on the signature.
+       The prediction is the mean z-score of the signature genes, i.e.
+       a sum of z-scores divided by the number of genes.
+     * Signatures are monotone in the thresholds: each gene passes a threshold
+       if it passes all higher ones. For each metric, genes are assigned the index of the
+       highest threshold in the grid they pass. The z-scores are summed into a
+       (thresholds x thresholds x thresholds) array at these indices.
+       Reverse cumulative sums along each axis then give the sum over the
+       signature for every combination of thresholds.
+
+    Parameters
+    ----------
+    var
+        `.var` of the training data prepared with :meth:`MCPSignatureRegressor.prepare_anndata`
+    X_test
+        samples x genes test data (genes in the same order as `var`)
+    true_frac
+        true fractions of the test samples
+    grid
+        list of dictionaries with the parameters `min_auroc`, `min_fc` and/or `min_sfc`.
+        Missing parameters take the defaults of :class:`MCPSignatureRegressor`.
+
+    Returns
+    -------
+    list of tuples (score_pearson, n_genes) for each grid point
+    """
+    defaults = MCPSignatureRegressor()
+    grid_values = {
+        p: np.array([params.get(p, getattr(defaults, p)) for params in grid])
+        for p in _THRESHOLDS
+    }
+    thresholds = {p: np.unique(values) for p, values in grid_values.items()}
+    shape = tuple(len(thr) for thr in thresholds.values())
+
+    # index of the highest threshold each gene passes (-1: none)
+    levels = []
+    for p, metric in _THRESHOLDS.items():
+        values = var[metric].values
+        tmp_levels = np.searchsorted(thresholds[p], values, side="right") - 1
+        tmp_levels[np.isnan(values)] = -1
+        levels.append(tmp_levels)
+    in_any = np.all(np.stack(levels) >= 0, axis=0)
+    cell = np.ravel_multi_index([lv[in_any] for lv in levels], shape)
+
+    # genes without a z-score (e.g. all zero across all patients) are not used for the score
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Z = scipy.stats.zscore(X_test[:, in_any], axis=0)
+    valid = ~np.any(np.isnan(Z), axis=0)
+    Z[:, ~valid] = 0
+
+    n_cells = int(np.prod(shape))
+    indicator = scipy.sparse.csr_matrix(
+        (np.ones(len(cell)), (cell, np.arange(len(cell)))),
+        shape=(n_cells, len(cell)),
+    )
+    z_sum = np.asarray(indicator @ Z.T).reshape(shape + (X_test.shape[0],))
+    n_genes = np.bincount(cell, minlength=n_cells).reshape(shape)
+    n_valid = np.bincount(cell, weights=valid, minlength=n_cells).reshape(shape)
+    for axis in range(len(shape)):
+        z_sum, n_genes, n_valid = (
+            np.flip(np.cumsum(np.flip(x, axis), axis), axis)
+            for x in (z_sum, n_genes, n_valid)
+        )
+
+    idx = tuple(np.searchsorted(thresholds[p], grid_values[p]) for p in _THRESHOLDS)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y_pred = z_sum[idx] / n_valid[idx][:, np.newaxis]
+        # pearson correlation of each prediction with the true fractions
+        y_c = y_pred - np.mean(y_pred, axis=1, keepdims=True)
+        x_c = true_frac - np.mean(true_frac)
+        r = (y_c @ x_c) / np.sqrt(np.sum(y_c**2, axis=1) * np.sum(x_c**2))
+    r = np.clip(r, -1, 1)
+    r[n_genes[idx] == 0] = np.nan
+    return [(float(x), int(n)) for x, n in zip(r, n_genes[idx])]
+
+
 def grid_search_cv(
     adata: AnnData,
     *,
@@ -367,6 +674,7 @@ def grid_search_cv(
     param_grid: dict,
     raw_results: bool = False,
     n_jobs=None,
+    incremental: bool = True,
 ):
     """Perform a cross-validation grid search with an MCPSignature regressor.
 
@@ -398,6 +706,12 @@ def grid_search_cv(
         If True, return a dictionary with the results of each fold. Otherwise aggregate the results into a dataframe
         with one row per parameter. The dataframe will contain this function's parameters in `attrs`
         which is useful for posteriority and for downstream functions.
+    n_jobs
+        Number of worker processes. Folds are processed in parallel.
+    incremental
+        If True and `param_grid` only contains the thresholds `min_fc`, `min_sfc` and `min_auroc`,
+        evaluate all grid points of a fold at once by sweeping the thresholds
+        (see :func:`_threshold_sweep`). The cost is almost independent of the size of the grid.
     """
     replicates = np.unique(adata.obs[replicate_col])
     skf = sklearn.model_selection.KFold(n_splits=n_splits, shuffle=True, random_state=0)
@@ -413,15 +727,14 @@ def grid_search_cv(
     # pb train, test are both grouped by patient (they will be split in test/train patients later)
     # The train pseudobulk is additionally split into the cell types, while the test pseudobulk
     # has all cell-types mixed bet has the original cell-type fractions annotated for validation.
+    # The test pseudobulk is rolled up from the train pseudobulk instead of aggregating the cells again.
     print("Generating Pseudobulk")
-    pb_train = pseudobulk(
-        adata,
-        groupby=[replicate_col, label_col],
-    )
-    pb_test = pseudobulk(
-        adata,
-        groupby=[replicate_col],  # do not include label column here
+    pb_cube = PseudobulkCube.from_adata(
+        adata, groupby=[replicate_col, label_col], stats=["sum"]
     )
+    pb_train = pb_cube.to_adata()
+    # do not include label column here
+    pb_test = pb_cube.rollup([replicate_col]).to_adata()
     pb_test.obs.set_index(replicate_col, inplace=True)
     pb_test.obs["true_frac"] = (
         adata.obs.groupby(replicate_col, observed=True)
@@ -435,18 +748,18 @@ def grid_search_cv(
         sc.pp.normalize_total(ad, target_sum=1e6)
         sc.pp.log1p(ad, base=2)
 
-    all_results = process_map(
-        _grid_search_cv_execute_fold,
-        list(enumerate(reps_train_labels)),
-        reps_train_labels,
-        reps_test_labels,
-        itertools.repeat(pb_train),
-        itertools.repeat(pb_test),
-        itertools.repeat(replicate_col),
-        itertools.repeat(label_col),
-        itertools.repeat(positive_class),
-        itertools.repeat(grid),
-        max_workers=n_jobs,
+    all_results = parallel_map(
+        partial(
+            _grid_search_cv_execute_fold,
+            replicate_col=replicate_col,
+            label_col=label_col,
+            positive_class=positive_class,
+            grid=grid,
+            incremental=incremental,
+        ),
+        list(zip(itertools.count(), reps_train_labels, reps_test_labels)),
+        shared=(pb_train, pb_test),
+        n_jobs=n_jobs,
     )
     all_results = list(itertools.chain.from_iterable(all_results))
 
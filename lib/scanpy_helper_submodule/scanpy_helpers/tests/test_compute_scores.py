@@ -0,0 +1,214 @@
+from scanpy_helpers.compare_groups.compute_scores import (
+    score_network,
+    score_networks_by_group,
+    run_progeny,
+    NetworkStore,
+    load_network_store,
+)
+from scanpy_helpers.compare_groups import prepare_dataset, compute_scores, TOOLS
+from functools import partial
+from anndata import AnnData
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import scipy.sparse as sp
+import pytest
+import pickle
+
+
+def _score_dense(X, var_names, network, min_size=5):
+    """Reference implementation on the dense matrix, following `progeny.run`"""
+    network = network[network.index.isin(var_names)]
+    network = network.loc[:, np.sum(network.values != 0, axis=0) >= min_size]
+    X = X[:, var_names.get_indexer(network.index)]
+    X = X - np.mean(X, axis=1, keepdims=True)
+    estimate = X @ network.values
+    estimate = estimate / np.sum(np.abs(network.values), axis=0)
+    estimate = (estimate - np.mean(estimate, axis=0)) / np.std(estimate, axis=0, ddof=1)
+    return pd.DataFrame(estimate, columns=network.columns)
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_score_network(sparse):
+    rng = np.random.default_rng(0)
+    n_obs, n_vars = 50, 200
+    X = sp.random(n_obs, n_vars, density=0.2, format="csr", random_state=0)
+    X.data = np.log1p(X.data * 10)
+    var_names = pd.Index([f"g{i}" for i in range(n_vars)])
+    # network contains genes that are not in the dataset and a source with only few targets
+    network = pd.DataFrame(
+        rng.choice([0, 0, 0, -1, 1, 0.5], size=(150, 4)),
+        index=[f"g{i}" for i in range(100, 250)],
+        columns=["A", "B", "C", "small"],
+    )
+    network.loc[:, "small"] = 0
+    network.iloc[:3, 3] = 1
+
+    adata = AnnData(
+        X=sp.csr_matrix((n_obs, 10)),
+        obs=pd.DataFrame(index=[f"c{i}" for i in range(n_obs)]),
+    )
+    adata.raw = AnnData(
+        X=X if sparse else X.toarray(), var=pd.DataFrame(index=var_names)
+    )
+    res = score_network(adata, network, obsm_key="progeny")
+    expected = _score_dense(X.toarray(), var_names, network)
+
+    assert res.var_names.tolist() == ["A", "B", "C"]
+    assert res.obs_names.tolist() == adata.obs_names.tolist()
+    npt.assert_allclose(res.X, expected.values, atol=1e-10)
+    npt.assert_allclose(res.obsm["progeny"].values, res.X)
+
+
+def test_score_networks_by_group():
+    rng = np.random.default_rng(1)
+    n_obs, n_vars = 120, 100
+    var_names = pd.Index([f"g{i}" for i in range(n_vars)])
+    adata = AnnData(
+        X=sp.random(n_obs, n_vars, density=0.3, format="csr", random_state=1),
+        obs=pd.DataFrame(
+            # includes a group with a single cell
+            {"cell_type": rng.choice(["T", "B", "NK"], n_obs)},
+            index=[f"c{i}" for i in range(n_obs)],
+        ),
+        var=pd.DataFrame(index=var_names),
+        obsm={"X_umap": rng.normal(size=(n_obs, 2))},
+    )
+    adata.obs.iloc[5, 0] = "Mast"
+    networks = {
+        key: pd.DataFrame(
+            rng.choice([0, 0, 1, -1], size=(n_vars, n_sources)),
+            index=var_names,
+            columns=[f"{key}{i}" for i in range(n_sources)],
+        )
+        for key, n_sources in [("progeny", 3), ("cytosig", 5)]
+    }
+
+    res = score_networks_by_group(adata, networks, "cell_type", use_raw=False)
+    assert list(res) == ["progeny", "cytosig"]
+    for key, network in networks.items():
+        assert list(res[key]) == adata.obs["cell_type"].unique().tolist()
+        for ct, tmp_res in res[key].items():
+            expected = score_network(
+                adata[adata.obs["cell_type"] == ct, :], network, use_raw=False
+            )
+            assert tmp_res.obs_names.tolist() == expected.obs_names.tolist()
+            npt.assert_allclose(tmp_res.X, expected.X, atol=1e-10)
+            npt.assert_allclose(tmp_res.obsm[key].values, expected.X, atol=1e-10)
+            npt.assert_equal(tmp_res.obsm["X_umap"], expected.obsm["X_umap"])
+
+
+def test_prepare_dataset_single_pass(monkeypatch):
+    rng = np.random.default_rng(2)
+    n_obs = 80
+    var_names = pd.Index([f"g{i}" for i in range(500)])
+    network = pd.DataFrame(
+        rng.normal(size=(500, 10)) * (rng.uniform(size=(500, 10)) < 0.2),
+        index=var_names,
+        columns=[f"cytokine{i}" for i in range(10)],
+    )
+    monkeypatch.setitem(compute_scores.NETWORKS, "cytosig", lambda: network)
+    monkeypatch.setitem(
+        TOOLS, "cytosig", partial(compute_scores.run_cytosig, engine="sparse")
+    )
+    adata = AnnData(
+        X=sp.random(n_obs, len(var_names), density=0.3, format="csr", random_state=2),
+        obs=pd.DataFrame(
+            {
+                "cell_type": rng.choice(["T", "B", "other"], n_obs),
+                "condition": rng.choice(["A", "B"], n_obs),
+            },
+            index=[f"c{i}" for i in range(n_obs)],
+        ),
+        var=pd.DataFrame(index=var_names),
+    )
+    adata.raw = adata
+    kwargs = dict(
+        dataset=adata,
+        cell_type_column="cell_type",
+        tools=["cytosig"],
+        column_to_test="condition",
+        n_jobs=1,
+    )
+    res = prepare_dataset("test", single_pass=True, **kwargs)
+    expected = prepare_dataset("test", single_pass=False, **kwargs)
+    assert list(res["cytosig"]) == list(expected["cytosig"])
+    for ct in expected["cytosig"]:
+        assert res["cytosig"][ct].obs_names.tolist() == (
+            expected["cytosig"][ct].obs_names.tolist()
+        )
+        npt.assert_allclose(res["cytosig"][ct].X, expected["cytosig"][ct].X)
+
+
+def test_network_store(tmp_path):
+    rng = np.random.default_rng(3)
+    var_names = pd.Index([f"g{i}" for i in range(300)])
+    networks = {
+        key: pd.DataFrame(
+            rng.normal(size=(200, 6)) * (rng.uniform(size=(200, 6)) < 0.2),
+            index=[f"g{i}" for i in range(100, 300)],
+            columns=[f"{key}{i}" for i in range(6)],
+        )
+        for key in ["progeny", "dorothea"]
+    }
+    store = NetworkStore.compile(var_names, networks)
+    store.save(tmp_path / "networks.npz")
+    loaded = NetworkStore.load(tmp_path / "networks.npz")
+
+    for key, network in networks.items():
+        weights, in_network, sources = loaded.get(key, var_names)
+        # the weights are read-only views of the memory-mapped file
+        assert not weights.data.flags.writeable and not weights.data.flags.owndata
+        expected = store.get(key, var_names)
+        npt.assert_equal(weights.toarray(), expected.weights.toarray())
+        npt.assert_equal(in_network, expected.in_network)
+        assert sources.tolist() == expected.sources.tolist()
+
+    with pytest.raises(ValueError):
+        loaded.get("progeny", var_names[::-1])
+
+    # stores that have been loaded from a file are pickled by path
+    assert len(pickle.dumps(loaded)) < 1000
+    assert pickle.loads(pickle.dumps(loaded)) is load_network_store(
+        tmp_path / "networks.npz"
+    )
+
+    adata = AnnData(
+        X=sp.random(30, len(var_names), density=0.3, format="csr", random_state=3),
+        var=pd.DataFrame(index=var_names),
+    )
+    adata.raw = adata
+    npt.assert_allclose(
+        run_progeny(adata, network_store=str(tmp_path / "networks.npz")).X,
+        score_network(adata, networks["progeny"]).X,
+    )
+
+
+def test_run_engine(monkeypatch):
+    """The sparse engine is used with a network store or when requested explicitly"""
+    rng = np.random.default_rng(4)
+    var_names = pd.Index([f"g{i}" for i in range(100)])
+    network = pd.DataFrame(
+        rng.normal(size=(100, 4)) * (rng.uniform(size=(100, 4)) < 0.3),
+        index=var_names,
+        columns=[f"pathway{i}" for i in range(4)],
+    )
+    monkeypatch.setitem(compute_scores.NETWORKS, "progeny", lambda: network)
+    monkeypatch.setattr(
+        compute_scores, "_run_progeny_external", lambda adata: "external"
+    )
+    adata = AnnData(
+        X=sp.random(20, len(var_names), density=0.3, format="csr", random_state=4),
+        var=pd.DataFrame(index=var_names),
+        uns={"log1p": {"base": None}},
+    )
+    adata.raw = adata
+
+    assert run_progeny(adata) == "external"
+    res = run_progeny(adata, engine="sparse")
+    assert res.uns["log1p"] == {"base": None}
+    npt.assert_allclose(res.X, score_network(adata, network).X)
+    with pytest.raises(ValueError):
+        run_progeny(adata, engine="external", network_store="networks.npz")
+    with pytest.raises(ValueError):
+        run_progeny(adata, engine="dense")
@@ -0,0 +1,459 @@
+from scanpy_helpers.compare_groups.lm import (
+    test_lm as _test_lm_fn,
+    lm_test_all,
+    DesignCache,
+    _permutations,
+    _trigamma_inverse,
+    _fit_f_dist,
+)
+from scanpy_helpers.pseudobulk import pseudobulk
+from scanpy_helpers.results import concat_results
+from anndata import AnnData
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+import pickle
+import warnings
+import scipy.stats
+import scipy.special
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+
+
+@pytest.fixture
+def adata_pseudobulk():
+    rng = np.random.default_rng(42)
+    n_obs, n_vars = 40, 30
+    obs = pd.DataFrame(
+        {
+            "condition": rng.choice(["A", "B", "C"], n_obs),
+            "dataset": rng.choice(["d1", "d2", "d3", "d4"], n_obs),
+            "age": rng.normal(60, 10, n_obs),
+        },
+        index=[f"s{i}" for i in range(n_obs)],
+    )
+    # heteroskedastic noise and a condition effect in some of the genes
+    effect = (obs["condition"] == "B").values[:, None] * rng.normal(0, 2, n_vars)
+    noise = (
+        rng.normal(0, 1, (n_obs, n_vars))
+        * (1 + (obs["dataset"] == "d1").values)[:, None]
+    )
+    return AnnData(
+        X=(5 + effect + noise).astype(np.float32),
+        obs=obs,
+        var=pd.DataFrame(index=[f"g{i}" for i in range(n_vars)]),
+    )
+
+
+@pytest.mark.parametrize(
+    "formula,contrasts",
+    [
+        ("~ C(condition, Sum) + dataset", "Sum"),
+        ("~ C(condition, Sum) + age", "Sum"),
+        ("~ C(condition, Treatment('A')) + dataset", "Treatment('A')"),
+    ],
+)
+@pytest.mark.parametrize("robust", [False, True])
+def test_lm_batched_engine(adata_pseudobulk, formula, contrasts, robust):
+    kwargs = dict(contrasts=contrasts, robust=robust, progress=False, n_jobs=1)
+    res_batched = _test_lm_fn(
+        adata_pseudobulk, formula, "condition", engine="batched", **kwargs
+    )
+    res_sm = _test_lm_fn(
+        adata_pseudobulk, formula, "condition", engine="statsmodels", **kwargs
+    )
+    assert res_batched.shape[0] == adata_pseudobulk.n_vars * (
+        3 if contrasts == "Sum" else 2
+    )
+    pdt.assert_frame_equal(res_batched, res_sm, check_dtype=False, rtol=1e-5)
+
+
+def test_lm_batched_engine_nonfinite(adata_pseudobulk):
+    adata_pseudobulk.X[3, 5] = np.nan
+    kwargs = dict(contrasts="Sum", progress=False, n_jobs=1)
+    formula = "~ C(condition, Sum) + dataset"
+    res_batched = _test_lm_fn(
+        adata_pseudobulk, formula, "condition", engine="batched", **kwargs
+    )
+    res_sm = _test_lm_fn(
+        adata_pseudobulk, formula, "condition", engine="statsmodels", **kwargs
+    )
+    pdt.assert_frame_equal(res_batched, res_sm, check_dtype=False, rtol=1e-5)
+
+
+def test_lm_batched_engine_parameters(adata_pseudobulk, monkeypatch):
+    """`n_jobs` limits the BLAS threads, `chunksize` is not supported by the batched engine"""
+    import scanpy_helpers.compare_groups.lm as lm
+
+    limits = []
+    threadpool_limits = lm.threadpool_limits
+
+    def _threadpool_limits(n):
+        limits.append(n)
+        return threadpool_limits(n)
+
+    monkeypatch.setattr(lm, "threadpool_limits", _threadpool_limits)
+    formula = "~ C(condition, Sum) + dataset"
+    expected = _test_lm_fn(adata_pseudobulk, formula, "condition", progress=False)
+    res = _test_lm_fn(adata_pseudobulk, formula, "condition", n_jobs=2, progress=False)
+    assert limits == [None, 2]
+    pdt.assert_frame_equal(res, expected)
+
+    with pytest.warns(UserWarning, match="chunksize"):
+        _test_lm_fn(adata_pseudobulk, formula, "condition", chunksize=10)
+
+
+def test_lm_batched_engine_nonfinite_duplicated_names(adata_pseudobulk):
+    """Results are in the order of the variables, even with duplicated names"""
+    adata_pseudobulk.X[3, 5] = np.nan
+    kwargs = dict(contrasts="Sum", progress=False, n_jobs=1, engine="batched")
+    formula = "~ C(condition, Sum) + dataset"
+    expected = _test_lm_fn(adata_pseudobulk, formula, "condition", **kwargs)
+    var_names = [f"g{i % 10}" for i in range(adata_pseudobulk.n_vars)]
+    adata_pseudobulk.var_names = var_names
+    res = _test_lm_fn(adata_pseudobulk, formula, "condition", **kwargs)
+    assert res["variable"].tolist() == np.repeat(var_names, 3).tolist()
+    pdt.assert_frame_equal(
+        res.drop(columns="variable"), expected.drop(columns="variable")
+    )
+
+
+def test_lm_mixed_model_nonfinite(adata_pseudobulk):
+    """Variables with non-finite values get NaN results in the mixed model"""
+    adata_pseudobulk.X[3, 5] = np.nan
+    with pytest.warns(UserWarning, match="non-finite"):
+        res = _test_lm_fn(
+            adata_pseudobulk,
+            "~ C(condition, Sum) + age",
+            "condition",
+            contrasts="Sum",
+            random_effect="dataset",
+        )
+    assert res.shape[0] == 3 * adata_pseudobulk.n_vars
+    assert res["variable"].tolist() == np.repeat(adata_pseudobulk.var_names, 3).tolist()
+    nonfinite = (res["variable"] == "g5").values
+    assert np.all(np.isnan(res.loc[nonfinite, "pvalue"]))
+    assert not np.any(np.isnan(res.loc[~nonfinite, "pvalue"]))
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_lm_test_all(n_jobs):
+    rng = np.random.default_rng(0)
+    adatas = {}
+    for ct, n_vars in [("T cell", 7), ("B cell", 23), ("Macrophage", 3)]:
+        n_obs = 300
+        adatas[ct] = AnnData(
+            X=rng.poisson(2, (n_obs, n_vars)).astype(np.float32),
+            obs=pd.DataFrame(
+                {
+                    "patient": rng.choice([f"p{i}" for i in range(12)], n_obs),
+                },
+                index=[f"{ct}_{i}" for i in range(n_obs)],
+            ).assign(
+                condition=lambda x: np.where(
+                    x["patient"].str[1:].astype(int) % 2, "LUAD", "LSCC"
+                )
+            ),
+            var=pd.DataFrame(index=[f"g{i}" for i in range(n_vars)]),
+        )
+
+    res = lm_test_all(
+        adatas,
+        groupby=["patient"],
+        column_to_test="condition",
+        n_jobs=n_jobs,
+        chunksize=5,
+    )
+    assert res.shape[0] == 2 * (7 + 23 + 3)
+
+    # same result as testing each cell-type separately
+    for ct, tmp_adata in adatas.items():
+        tmp_pb = pseudobulk(
+            tmp_adata, groupby=["patient", "condition"], aggr_fun=np.mean
+        )
+        expected = _test_lm_fn(
+            tmp_pb, "~ C(condition, Sum) ", "condition", contrasts="Sum"
+        )
+        pdt.assert_frame_equal(
+            res.loc[res["cell_type"] == ct]
+            .sort_values(["variable", "group"])
+            .drop(columns=["cell_type", "fdr"]),
+            expected.sort_values(["variable", "group"]),
+            check_dtype=False,
+            # the categories of the combined result include all cell-types
+            check_categorical=False,
+        )
+
+
+@pytest.fixture
+def adatas_nonfinite():
+    """Single cell data of two cell-types. The first chunk of variables of the first
+    cell-type is entirely non-finite, the third variable of the second cell-type partly.
+    """
+    rng = np.random.default_rng(0)
+    adatas = {}
+    for ct, n_vars, nonfinite in [("T cell", 7, [0, 1]), ("B cell", 5, [2])]:
+        n_obs = 200
+        obs = pd.DataFrame(
+            {"patient": rng.choice([f"p{i}" for i in range(12)], n_obs)},
+            index=[f"{ct}_{i}" for i in range(n_obs)],
+        ).assign(
+            condition=lambda x: np.where(
+                x["patient"].str[1:].astype(int) % 2, "LUAD", "LSCC"
+            )
+        )
+        X = rng.poisson(2, (n_obs, n_vars)).astype(np.float32)
+        X[np.ix_((obs["patient"] == "p0").values, nonfinite)] = np.nan
+        adatas[ct] = AnnData(
+            X=X, obs=obs, var=pd.DataFrame(index=[f"g{i}" for i in range(n_vars)])
+        )
+    return adatas
+
+
+def test_lm_test_all_nonfinite_chunks(adatas_nonfinite):
+    """Chunks that are (partly) fitted by the fallback are combined into one result"""
+    kwargs = dict(groupby=["patient"], column_to_test="condition", n_jobs=1)
+    res = lm_test_all(adatas_nonfinite, chunksize=2, **kwargs)
+    expected = lm_test_all(adatas_nonfinite, chunksize=100, **kwargs)
+    assert res.shape[0] == 2 * (7 + 5)
+    pdt.assert_frame_equal(
+        res.sort_values(["cell_type", "variable", "group"]),
+        expected.sort_values(["cell_type", "variable", "group"]),
+        check_categorical=False,
+    )
+
+
+def test_lm_test_all_permutations(adatas_nonfinite):
+    """Permutation pvalues of chunks don't depend on the chunking. Variables fitted
+    by the fallback don't have permutation pvalues."""
+    kwargs = dict(
+        groupby=["patient"], column_to_test="condition", n_jobs=1, n_permutations=20
+    )
+    res = lm_test_all(adatas_nonfinite, chunksize=2, **kwargs)
+    expected = lm_test_all(adatas_nonfinite, chunksize=100, **kwargs)
+    pdt.assert_frame_equal(
+        res.loc[:, expected.columns].sort_values(["cell_type", "variable", "group"]),
+        expected.sort_values(["cell_type", "variable", "group"]),
+        check_categorical=False,
+    )
+    nonfinite = (
+        (res["cell_type"] == "T cell") & res["variable"].isin(["g0", "g1"])
+    ) | ((res["cell_type"] == "B cell") & (res["variable"] == "g2"))
+    assert np.all(np.isnan(res.loc[nonfinite, "pvalue_perm"]))
+    assert np.all(
+        (res.loc[~nonfinite, "pvalue_perm"] > 0)
+        & (res.loc[~nonfinite, "pvalue_perm"] <= 1)
+    )
+
+
+def test_design_cache(adata_pseudobulk):
+    cache = DesignCache()
+    formula = "~ C(condition, Sum) + dataset"
+    kwargs = dict(contrasts="Sum", progress=False, design_cache=cache)
+    res1 = _test_lm_fn(adata_pseudobulk[:, :10].copy(), formula, "condition", **kwargs)
+    res2 = _test_lm_fn(adata_pseudobulk[:, 10:].copy(), formula, "condition", **kwargs)
+    assert len(cache) == 1
+    res = _test_lm_fn(adata_pseudobulk, formula, "condition", contrasts="Sum")
+    pdt.assert_frame_equal(concat_results([res1, res2]), res)
+
+    # the key survives pickling (the cache is shared with worker processes)
+    obs = pickle.loads(pickle.dumps(adata_pseudobulk.obs))
+    assert cache.get(
+        obs, formula=formula, groupby="condition", contrasts="Sum"
+    ) is cache.get(
+        adata_pseudobulk.obs, formula=formula, groupby="condition", contrasts="Sum"
+    )
+    assert len(cache) == 1
+
+    # a different formula or different samples result in a new design
+    _test_lm_fn(adata_pseudobulk, "~ C(condition, Sum)", "condition", **kwargs)
+    _test_lm_fn(adata_pseudobulk[:20, :].copy(), formula, "condition", **kwargs)
+    assert len(cache) == 3
+
+
+def test_permutations():
+    strata = np.array(list("aabbbcaab"))
+    perms = _permutations(len(strata), 100, strata=strata)
+    assert perms.shape == (100, 9)
+    for perm in perms:
+        assert sorted(perm) == list(range(9))
+        npt.assert_equal(strata[perm], strata)
+    # not all permutations are the identity
+    assert np.any(perms != np.arange(9))
+
+
+def test_lm_permutation_test(adata_pseudobulk):
+    formula = "~ C(condition, Sum) + dataset"
+    n_permutations = 50
+    res = _test_lm_fn(
+        adata_pseudobulk,
+        formula,
+        "condition",
+        contrasts="Sum",
+        n_permutations=n_permutations,
+        permutation_strata="dataset",
+    )
+    assert np.all((res["pvalue_perm"] > 0) & (res["pvalue_perm"] <= 1))
+
+    # The covariate is constant within strata. Permuting the residuals is equivalent to
+    # permuting the group labels within strata and refitting the model.
+    perms = _permutations(
+        adata_pseudobulk.n_obs,
+        n_permutations,
+        strata=adata_pseudobulk.obs["dataset"].values,
+    )
+    n_extreme = np.zeros(res.shape[0])
+    for perm in perms:
+        tmp_adata = adata_pseudobulk.copy()
+        tmp_adata.obs["condition"] = adata_pseudobulk.obs["condition"].values[
+            np.argsort(perm)
+        ]
+        tmp_res = _test_lm_fn(tmp_adata, formula, "condition", contrasts="Sum")
+        n_extreme += tmp_res["pvalue"].values <= res["pvalue"].values * (1 + 1e-8)
+    npt.assert_allclose(
+        res["pvalue_perm"].values, (1 + n_extreme) / (1 + n_permutations)
+    )
+
+
+def test_lm_permutation_test_batches(adata_pseudobulk, monkeypatch):
+    """The batch size only depends on the memory limit, not the results"""
+    import scanpy_helpers.compare_groups.lm as lm
+
+    kwargs = dict(contrasts="Sum", n_permutations=20, permutation_strata="dataset")
+    formula = "~ C(condition, Sum) + dataset"
+    expected = _test_lm_fn(adata_pseudobulk, formula, "condition", **kwargs)
+    permutation_test = lm._permutation_test
+    monkeypatch.setattr(
+        lm,
+        "_permutation_test",
+        lambda *args, **kw: permutation_test(*args, **kw, max_memory=1),
+    )
+    res = _test_lm_fn(adata_pseudobulk, formula, "condition", **kwargs)
+    npt.assert_allclose(res["pvalue_perm"], expected["pvalue_perm"])
+
+
+def test_lm_mixed_model():
+    rng = np.random.default_rng(1)
+    n_obs, n_vars, n_datasets = 40, 10, 8
+    obs = pd.DataFrame(
+        {
+            "condition": rng.choice(["A", "B", "C"], n_obs),
+            "dataset": rng.choice([f"d{i}" for i in range(n_datasets)], n_obs),
+            "age": rng.normal(size=n_obs),
+        },
+        index=[f"s{i}" for i in range(n_obs)],
+    )
+    dataset_codes = pd.factorize(obs["dataset"])[0]
+    Y = (
+        rng.normal(size=(n_obs, n_vars))
+        + rng.normal(size=(n_datasets, n_vars))[dataset_codes]
+        * rng.uniform(0, 2, n_vars)
+        + (obs["condition"] == "B").values[:, np.newaxis]
+    )
+    res = _test_lm_fn(
+        AnnData(X=Y, obs=obs),
+        "~ C(condition, Sum) + age",
+        "condition",
+        contrasts="Sum",
+        random_effect="dataset",
+    )
+    assert res.shape[0] == 3 * n_vars
+
+    key = "C(condition, Sum)[S.A]"
+    Z = (dataset_codes[:, np.newaxis] == np.arange(n_datasets)).astype(float)
+    for i in range(n_vars):
+        tmp_res = res.loc[res["variable"] == str(i)]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            mdf = smf.mixedlm(
+                "y ~ C(condition, Sum) + age",
+                obs.assign(y=Y[:, i]),
+                groups=obs["dataset"],
+            ).fit(reml=True)
+        npt.assert_allclose(tmp_res.loc[key, "coef"], mdf.params[key], atol=1e-4)
+        npt.assert_allclose(tmp_res["intercept"], mdf.params["Intercept"], atol=1e-4)
+        # Wald test with the GLS covariance of the fixed effects, given the variance components
+        lam = mdf.cov_re.iloc[0, 0] / mdf.scale
+        gls = sm.GLS(
+            mdf.model.endog, mdf.model.exog, sigma=np.eye(n_obs) + lam * Z @ Z.T
+        ).fit()
+        key_idx = mdf.model.exog_names.index(key)
+        npt.assert_allclose(
+            tmp_res.loc[key, "pvalue"],
+            2 * scipy.stats.norm.sf(np.abs(gls.tvalues[key_idx])),
+            rtol=1e-3,
+        )
+
+
+def test_trigamma_inverse():
+    for x in [1e-3, 0.1, 1, 10, 1e3]:
+        npt.assert_allclose(
+            scipy.special.polygamma(1, _trigamma_inverse(x)), x, rtol=1e-6
+        )
+
+
+def test_lm_ebayes(adata_pseudobulk):
+    formula = "~ C(condition, Sum) + dataset"
+    res = _test_lm_fn(adata_pseudobulk, formula, "condition", ebayes=True)
+    res_plain = _test_lm_fn(adata_pseudobulk, formula, "condition")
+    pdt.assert_frame_equal(res[res_plain.columns], res_plain)
+
+    # the noise has the same distribution for all genes, so the prior is informative
+    assert res.attrs["df_prior"] > 10
+    # posterior variances are shrunk towards the prior
+    s2_prior = res.attrs["s2_prior"]
+    assert np.all(
+        np.abs(res["s2_post"] - s2_prior) <= np.abs(res["sigma2"] - s2_prior) + 1e-12
+    )
+    # the moderated t-statistic has the same sign as the coefficient
+    assert np.all(np.sign(res["t_moderated"]) == np.sign(res["coef"]))
+    # the ordinary t-statistic can be recovered from the unscaled standard deviation
+    t = res["coef"] / (res["stdev_unscaled"] * np.sqrt(res["sigma2"]))
+    npt.assert_allclose(
+        2 * scipy.stats.t.sf(np.abs(t), res["df_resid"]), res["pvalue"], rtol=1e-6
+    )
+
+
+def test_lm_ebayes_nonfinite_duplicated_names(adata_pseudobulk):
+    formula = "~ C(condition, Sum) + dataset"
+    adata = adata_pseudobulk.copy()
+    adata.X[3, 5] = np.nan
+    res = _test_lm_fn(adata, formula, "condition", ebayes=True)
+    assert res["df_resid"].dtype == float
+    nonfinite = res["variable"] == adata.var_names[5]
+    assert np.all(np.isnan(res.loc[nonfinite, "pvalue_moderated"]))
+    assert np.all(np.isfinite(res.loc[~nonfinite, "pvalue_moderated"]))
+
+    # variables are identified by position, not by name
+    adata_dup = adata.copy()
+    adata_dup.var_names = ["gene"] * adata.n_vars
+    res_dup = _test_lm_fn(adata_dup, formula, "condition", ebayes=True)
+    for col in ["s2_post", "t_moderated", "pvalue_moderated"]:
+        npt.assert_array_equal(res_dup[col].values, res[col].values)
+    assert res_dup.attrs["df_prior"] == res.attrs["df_prior"]
+
+
+def test_fit_f_dist():
+    rng = np.random.default_rng(0)
+    df = np.full(20000, 8.0)
+    # s2 / s2_prior ~ F(df, df_prior)
+    s2 = 0.5 * rng.f(df, 12)
+    s2_prior, df_prior = _fit_f_dist(s2, df)
+    npt.assert_allclose(s2_prior, 0.5, rtol=0.05)
+    npt.assert_allclose(df_prior, 12, rtol=0.15)
+
+    # without additional variability between genes, the prior has (almost) infinite degrees of freedom
+    s2_prior, df_prior = _fit_f_dist(0.5 * rng.chisquare(df) / df, df)
+    assert df_prior > 100
+    npt.assert_allclose(s2_prior, 0.5, rtol=0.05)
+
+    # zero variances are offset away from zero
+    s2 = 0.5 * rng.f(df, 12)
+    s2[:10] = 0
+    with pytest.warns(UserWarning, match="offset"):
+        assert np.all(np.isfinite(_fit_f_dist(s2, df)))
+    s2[: len(s2) // 2 + 1] = 0
+    with pytest.warns(UserWarning, match="unreliable"):
+        assert np.all(~np.isnan(_fit_f_dist(s2, df)))
@@ -0,0 +1,87 @@
+from scanpy_helpers.parallel import parallel_map, get_executor, SharedObject
+from scanpy_helpers.compare_groups.lm import test_lm as _test_lm_fn
+from multiprocessing import shared_memory
+from anndata import AnnData
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import scipy.sparse as sp
+import pytest
+
+
+def _sum_rows(adata, obs_range):
+    X = adata[slice(*obs_range), :].X
+    return np.asarray(X.sum(axis=0)).ravel(), adata.X.data.flags.writeable
+
+
+@pytest.fixture
+def adata():
+    return AnnData(
+        X=sp.random(100, 20, density=0.3, format="csr", random_state=0),
+        obs=pd.DataFrame(
+            {"group": pd.Categorical(np.repeat(["a", "b", "c", "d"], 25))},
+            index=[f"c{i}" for i in range(100)],
+        ),
+    )
+
+
+def test_parallel_map(adata):
+    ranges = [(i, i + 25) for i in range(0, 100, 25)]
+    res = parallel_map(_sum_rows, ranges, shared=adata, n_jobs=2, progress=False)
+    for (start, stop), (sums, writeable) in zip(ranges, res):
+        npt.assert_allclose(sums, adata.X[start:stop].sum(axis=0).A1)
+        # the shared matrix is mapped read-only into the workers
+        assert not writeable
+
+    # the pool is reused across calls
+    executor = get_executor(2)
+    parallel_map(_sum_rows, ranges, shared=adata, n_jobs=2, progress=False)
+    assert get_executor(2) is executor
+
+
+def _cached_tokens(adata, item):
+    from scanpy_helpers import parallel
+
+    return list(parallel._WORKER_CACHE)
+
+
+def test_worker_cache_unlinked(adata):
+    """Workers drop the mappings of shared objects that have been unlinked by the parent"""
+    for _ in range(3):
+        res = parallel_map(
+            _cached_tokens, range(8), shared=adata, n_jobs=2, progress=False
+        )
+        # only the object of the current call is attached
+        assert all(len(tokens) == 1 for tokens in res)
+        assert len({tokens[0] for tokens in res}) == 1
+
+
+def test_shared_object_unlink(adata):
+    with SharedObject(adata) as shared:
+        names = [name for name, _ in [shared._meta] + shared._buffers]
+        tmp_adata = shared.get()
+        npt.assert_equal(tmp_adata.X.toarray(), adata.X.toarray())
+        del tmp_adata
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_lm_statsmodels_parallel():
+    rng = np.random.default_rng(0)
+    adata = AnnData(
+        X=rng.normal(size=(20, 30)),
+        obs=pd.DataFrame(
+            {"condition": rng.choice(["A", "B"], 20)},
+            index=[f"s{i}" for i in range(20)],
+        ),
+    )
+    kwargs = dict(contrasts="Sum", engine="statsmodels", progress=False, chunksize=5)
+    res_serial = _test_lm_fn(
+        adata, "~ C(condition, Sum)", "condition", n_jobs=1, **kwargs
+    )
+    res_parallel = _test_lm_fn(
+        adata, "~ C(condition, Sum)", "condition", n_jobs=2, **kwargs
+    )
+    pdt.assert_frame_equal(res_serial, res_parallel)
@@ -1,10 +1,18 @@
 from .fixtures import adata_hierarchical1
-from scanpy_helpers.pseudobulk import pseudobulk
+import scanpy_helpers.pseudobulk
+from scanpy_helpers.pseudobulk import (
+    pseudobulk,
+    pseudobulk_bootstrap,
+    PseudobulkCube,
+    PseudobulkCache,
+)
 import pytest
 import numpy.testing as npt
 import numpy as np
 import pandas as pd
 import pandas.testing as pdt
+import scipy.sparse as sp
+import anndata
 
 
 @pytest.mark.parametrize(
@@ -98,3 +106,416 @@ def test_pseudobulk1(
     )
     pdt.assert_frame_equal(adata_pb.obs, obs_expected)
     npt.assert_almost_equal(adata_pb.X, x_expected)
+
+
+def test_pseudobulk_custom_aggr_fun(adata_hierarchical1):
+    """Arbitrary callbacks fall back to a per-group aggregation"""
+    adata_pb = pseudobulk(
+        adata_hierarchical1,
+        groupby="dataset",
+        min_obs=0,
+        aggr_fun=lambda x, axis: np.sum(x > 0, axis=axis) / x.shape[axis],
+    )
+    npt.assert_equal(adata_pb.obs["dataset"].values, ["d1", "d2", "d3"])
+    npt.assert_almost_equal(adata_pb.X, [[1, 0], [1, 0], [1, 1]])
+
+
+def test_pseudobulk_missing_values(adata_hierarchical1):
+    """Observations with a missing value in one of the groupby columns are ignored"""
+    adata_hierarchical1.obs["patient"] = [
+        "p1",
+        None,
+        "p1",
+        "p1",
+        "p1",
+        "p1",
+        None,
+        "p2",
+    ]
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby=["dataset", "patient"], min_obs=0
+    )
+    npt.assert_equal(adata_pb.obs["n_obs"].values, [2, 2, 1, 1])
+    npt.assert_almost_equal(adata_pb.X, [[20, 0], [4, 0], [20, 1], [5, 0]])
+
+
+@pytest.mark.parametrize("chunksize", [None, 1, 3])
+@pytest.mark.parametrize("aggr_fun", [np.sum, np.mean])
+def test_pseudobulk_backed(adata_hierarchical1, tmp_path, chunksize, aggr_fun):
+    """Streaming the matrix from disk gives the same result as in-memory aggregation"""
+    adata_hierarchical1.X = adata_hierarchical1.X.astype(np.float32)
+    path = tmp_path / "adata.h5ad"
+    adata_hierarchical1.write_h5ad(path)
+    expected = pseudobulk(
+        adata_hierarchical1,
+        groupby=["dataset", "patient"],
+        min_obs=0,
+        aggr_fun=aggr_fun,
+    )
+
+    adata_backed = anndata.read_h5ad(path, backed="r")
+    for adata_in in [adata_backed, path]:
+        adata_pb = pseudobulk(
+            adata_in,
+            groupby=["dataset", "patient"],
+            min_obs=0,
+            aggr_fun=aggr_fun,
+            chunksize=chunksize,
+        )
+        pdt.assert_frame_equal(adata_pb.obs, expected.obs)
+        npt.assert_almost_equal(adata_pb.X, expected.X)
+
+
+def test_pseudobulk_stats(adata_hierarchical1):
+    """All statistics are computed in a single pass and match their numpy equivalents"""
+    adata_pb = pseudobulk(
+        adata_hierarchical1,
+        groupby="dataset",
+        min_obs=0,
+        stats=["sum", "mean", "n_expressed", "frac_expressed", "var"],
+    )
+    X = adata_hierarchical1.X
+    X = X.toarray() if hasattr(X, "toarray") else X
+    for i, dataset in enumerate(["d1", "d2", "d3"]):
+        tmp_x = X[adata_hierarchical1.obs["dataset"] == dataset, :]
+        npt.assert_almost_equal(adata_pb.layers["sum"][i, :], np.sum(tmp_x, axis=0))
+        npt.assert_almost_equal(adata_pb.layers["mean"][i, :], np.mean(tmp_x, axis=0))
+        npt.assert_equal(
+            adata_pb.layers["n_expressed"][i, :], np.sum(tmp_x > 0, axis=0)
+        )
+        npt.assert_almost_equal(
+            adata_pb.layers["frac_expressed"][i, :], np.mean(tmp_x > 0, axis=0)
+        )
+        npt.assert_almost_equal(adata_pb.layers["var"][i, :], np.var(tmp_x, axis=0))
+    npt.assert_almost_equal(adata_pb.X, adata_pb.layers["sum"])
+
+    with pytest.raises(ValueError):
+        pseudobulk(adata_hierarchical1, groupby="dataset", stats=["median"])
+
+
+@pytest.mark.parametrize("aggr_fun", [np.sum, np.mean])
+def test_pseudobulk_cube(adata_hierarchical1, aggr_fun):
+    """Rolling up a cube gives the same result as computing the pseudobulk from the cells"""
+    adata_hierarchical1.obs.loc["c2", "patient"] = None
+    cube = PseudobulkCube.from_adata(
+        adata_hierarchical1, groupby=["dataset", "patient"], stats=["sum", "var"]
+    )
+    for groupby, tmp_cube in [
+        (["dataset", "patient"], cube),
+        (["dataset"], cube.rollup("dataset")),
+        (["patient"], cube.rollup(["patient"])),
+    ]:
+        assert tmp_cube.groupby == groupby
+        expected = pseudobulk(
+            adata_hierarchical1,
+            groupby=groupby,
+            aggr_fun=aggr_fun,
+            min_obs=2,
+            stats=["var"],
+        )
+        adata_pb = tmp_cube.to_adata(aggr_fun, min_obs=2, stats=["var"])
+        pdt.assert_frame_equal(adata_pb.obs, expected.obs)
+        npt.assert_almost_equal(adata_pb.X, expected.X)
+        npt.assert_almost_equal(adata_pb.layers["var"], expected.layers["var"])
+
+    with pytest.raises(ValueError):
+        cube.rollup(["cell_type"])
+    with pytest.raises(ValueError):
+        cube.get_stat("frac_expressed")
+
+
+@pytest.mark.parametrize(
+    "obs_idx,var_idx",
+    [
+        ([True, False, True, True, False, True, True, True], slice(None)),
+        (slice(1, 7), ["B"]),
+        ([7, 2, 3, 0], ["B", "A"]),
+        ([1, 1, 2, 3], slice(None)),
+    ],
+)
+@pytest.mark.parametrize("aggr_fun", [np.sum, np.mean])
+def test_pseudobulk_view(adata_hierarchical1, obs_idx, var_idx, aggr_fun):
+    """Aggregating a view gives the same result as aggregating a copy"""
+    adata_view = adata_hierarchical1[obs_idx, var_idx]
+    assert adata_view.is_view
+    expected = pseudobulk(
+        adata_view.copy(), groupby=["dataset", "patient"], min_obs=0, aggr_fun=aggr_fun
+    )
+    adata_pb = pseudobulk(
+        adata_view,
+        groupby=["dataset", "patient"],
+        min_obs=0,
+        aggr_fun=aggr_fun,
+        stats=["var"],
+    )
+    pdt.assert_frame_equal(adata_pb.obs, expected.obs)
+    pdt.assert_frame_equal(adata_pb.var, expected.var)
+    npt.assert_almost_equal(adata_pb.X, expected.X)
+    assert adata_pb.layers["var"].shape == expected.X.shape
+
+
+@pytest.mark.parametrize("chunksize", [None, 2])
+def test_pseudobulk_view_reads_rows(adata_hierarchical1, monkeypatch, chunksize):
+    """Only the rows of a view are read from the parent matrix, in blocks"""
+    obs_idx = [7, 2, 3, 0]
+    adata_view = adata_hierarchical1[obs_idx, :]
+    expected = pseudobulk(adata_view.copy(), groupby="dataset", min_obs=0)
+
+    block_rows = []
+    iter_row_blocks = scanpy_helpers.pseudobulk._iter_row_blocks
+
+    def _iter_row_blocks(*args, **kwargs):
+        for start, stop, block in iter_row_blocks(*args, **kwargs):
+            block_rows.append(block.shape[0])
+            yield start, stop, block
+
+    monkeypatch.setattr(scanpy_helpers.pseudobulk, "_iter_row_blocks", _iter_row_blocks)
+    adata_pb = pseudobulk(adata_view, groupby="dataset", min_obs=0, chunksize=chunksize)
+    npt.assert_equal(adata_pb.X, expected.X)
+    assert sum(block_rows) == len(obs_idx)
+    assert max(block_rows) <= (chunksize or len(obs_idx))
+
+
+@pytest.mark.parametrize("view", [False, True])
+def test_pseudobulk_layer_raw(adata_hierarchical1, view):
+    """Aggregate layers and raw instead of X"""
+    adata_hierarchical1.layers["counts"] = adata_hierarchical1.X * 2
+    adata_hierarchical1.raw = adata_hierarchical1
+    adata_hierarchical1 = adata_hierarchical1[:, ["B"]]
+    if not view:
+        adata_hierarchical1 = adata_hierarchical1.copy()
+
+    adata_pb = pseudobulk(adata_hierarchical1, groupby="dataset", min_obs=0)
+    npt.assert_equal(adata_pb.X, [[0], [0], [1]])
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby="dataset", min_obs=0, layer="counts"
+    )
+    npt.assert_equal(adata_pb.X, [[0], [0], [2]])
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby="dataset", min_obs=0, use_raw=True
+    )
+    npt.assert_equal(adata_pb.var_names.values, ["A", "B"])
+    npt.assert_equal(adata_pb.X, [[45, 0], [9, 0], [20, 1]])
+
+    with pytest.raises(ValueError):
+        pseudobulk(adata_hierarchical1, groupby="dataset", use_raw=True, layer="counts")
+
+
+def test_pseudobulk_dtype_sparse(adata_hierarchical1):
+    adata_hierarchical1.X = adata_hierarchical1.X.astype(np.float32)
+    adata_pb = pseudobulk(
+        adata_hierarchical1,
+        groupby="dataset",
+        min_obs=0,
+        stats=["mean"],
+        acc_dtype=np.int64,
+        sparse=True,
+    )
+    assert isinstance(adata_pb.X, sp.csr_matrix)
+    assert isinstance(adata_pb.layers["mean"], sp.csr_matrix)
+    assert adata_pb.X.dtype == np.int64
+    npt.assert_equal(adata_pb.X.toarray(), [[45, 0], [9, 0], [20, 1]])
+
+    adata_pb = pseudobulk(
+        adata_hierarchical1,
+        groupby="dataset",
+        min_obs=0,
+        aggr_fun=np.mean,
+        dtype=np.float32,
+    )
+    assert adata_pb.X.dtype == np.float32
+    npt.assert_almost_equal(adata_pb.X, [[11.25, 0], [3, 0], [20, 1]])
+
+
+@pytest.mark.parametrize("acc_dtype", [None, np.float64])
+def test_pseudobulk_float32_acc_dtype(adata_hierarchical1, acc_dtype):
+    """float32 input is summed as float32 unless a different acc_dtype is requested"""
+    adata_hierarchical1.X = adata_hierarchical1.X.astype(np.float32)
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby="dataset", min_obs=0, acc_dtype=acc_dtype
+    )
+    assert adata_pb.X.dtype == (np.float32 if acc_dtype is None else np.float64)
+    npt.assert_equal(adata_pb.X, [[45, 0], [9, 0], [20, 1]])
+
+
+@pytest.mark.parametrize(
+    "dtype,expected_dtype",
+    [(np.float32, np.float32), (np.float64, np.float64), (np.int32, np.float64)],
+)
+def test_pseudobulk_mean_dtype(adata_hierarchical1, dtype, expected_dtype):
+    """The mean has the same dtype as `np.mean` of the input"""
+    adata_hierarchical1.X = adata_hierarchical1.X.astype(dtype)
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby="dataset", min_obs=0, aggr_fun=np.mean
+    )
+    assert adata_pb.X.dtype == expected_dtype
+    npt.assert_almost_equal(adata_pb.X, [[11.25, 0], [3, 0], [20, 1]])
+
+
+def test_transform_values_no_copy():
+    """Sums use the block as is, other moments share the index arrays of the block"""
+    from scanpy_helpers.pseudobulk import _transform_values, _MOMENTS
+
+    x = sp.random(20, 10, density=0.3, format="csr", random_state=0)
+    assert _transform_values(x, _MOMENTS["sum"], x.dtype) is x
+    x_sq = _transform_values(x, _MOMENTS["sum_sq"], np.float64)
+    assert np.shares_memory(x_sq.indices, x.indices)
+    assert np.shares_memory(x_sq.indptr, x.indptr)
+    npt.assert_almost_equal(x_sq.toarray(), x.toarray() ** 2)
+
+
+@pytest.mark.parametrize("chunksize", [None, 3])
+@pytest.mark.parametrize("n_jobs", [2, 3, None, -1])
+def test_pseudobulk_parallel(n_jobs, chunksize):
+    """The multi-threaded kernel gives the same results as the single-threaded version"""
+    rng = np.random.default_rng(42)
+    adata = anndata.AnnData(
+        X=sp.random(
+            200,
+            30,
+            density=0.2,
+            format="csr",
+            random_state=0,
+            data_rvs=lambda n: rng.integers(1, 100, n),
+        ).astype(np.int32),
+        obs=pd.DataFrame(
+            {"group": rng.choice(["a", "b", "c", "d"], 200)},
+            index=[f"c{i}" for i in range(200)],
+        ),
+    )
+    stats = ["sum", "n_expressed", "var"]
+    expected = pseudobulk(adata, groupby="group", stats=stats)
+    adata_pb = pseudobulk(
+        adata, groupby="group", stats=stats, n_jobs=n_jobs, chunksize=chunksize
+    )
+    assert adata_pb.X.dtype == np.int64
+    npt.assert_equal(adata_pb.X, expected.X)
+    npt.assert_equal(adata_pb.layers["n_expressed"], expected.layers["n_expressed"])
+    npt.assert_almost_equal(adata_pb.layers["var"], expected.layers["var"])
+
+
+def test_pseudobulk_n_jobs(adata_hierarchical1, monkeypatch):
+    def _fail(*args, **kwargs):
+        raise AssertionError("a thread pool was created")
+
+    # a single job runs inline
+    monkeypatch.setattr("scanpy_helpers.pseudobulk.ThreadPoolExecutor", _fail)
+    pseudobulk(adata_hierarchical1, groupby="patient", n_jobs=1)
+
+    with pytest.raises(ValueError, match="n_jobs"):
+        pseudobulk(adata_hierarchical1, groupby="patient", n_jobs=0)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_pseudobulk_cache(adata_hierarchical1, tmp_path, monkeypatch, sparse):
+    cache = PseudobulkCache(tmp_path)
+    kwargs = dict(
+        groupby=["dataset", "patient"], min_obs=0, stats=["var"], sparse=sparse
+    )
+    expected = pseudobulk(adata_hierarchical1, cache=cache, **kwargs)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    # results are loaded from the cache without computing them again
+    def _fail(*args, **kwargs):
+        raise AssertionError("pseudobulk was recomputed")
+
+    with monkeypatch.context() as m:
+        m.setattr(scanpy_helpers.pseudobulk, "_group_moments", _fail)
+        adata_pb = pseudobulk(adata_hierarchical1, cache=tmp_path, **kwargs)
+    pdt.assert_frame_equal(adata_pb.obs, expected.obs)
+    pdt.assert_frame_equal(adata_pb.var, expected.var)
+    for x, y in [
+        (adata_pb.X, expected.X),
+        (adata_pb.layers["var"], expected.layers["var"]),
+    ]:
+        assert sp.issparse(x) == sparse
+        npt.assert_almost_equal(
+            x.toarray() if sparse else x, y.toarray() if sparse else y
+        )
+
+    # changing the data, the groups or the parameters invalidates the cache
+    pseudobulk(adata_hierarchical1, cache=cache, **{**kwargs, "min_obs": 2})
+    pseudobulk(adata_hierarchical1[:4, :], cache=cache, **kwargs)
+    adata_hierarchical1.X = adata_hierarchical1.X * 2
+    pseudobulk(adata_hierarchical1, cache=cache, **kwargs)
+    assert len(list(tmp_path.glob("*.npz"))) == 4
+
+    # least recently used entries are evicted, files that are being written by other
+    # processes are left alone
+    in_flight = tmp_path / f".{'0' * 40}.12345.tmp"
+    in_flight.write_bytes(b"incomplete")
+    cache.max_size = 0
+    cache._evict()
+    assert len(list(tmp_path.glob("*.npz"))) == 0
+    cache.clear()
+    assert in_flight.exists()
+
+
+def test_pseudobulk_cache_no_pickle(adata_hierarchical1, tmp_path):
+    """Cached results only contain numeric and string arrays"""
+    adata_hierarchical1.obs["patient"] = adata_hierarchical1.obs["patient"].astype(
+        "category"
+    )
+    expected = pseudobulk(
+        adata_hierarchical1, groupby=["dataset", "patient"], min_obs=0, cache=tmp_path
+    )
+    (file,) = tmp_path.glob("*.npz")
+    with np.load(file, allow_pickle=False) as npz:
+        assert all(npz[k].dtype != object for k in npz.files)
+    adata_pb = PseudobulkCache(tmp_path).get(file.stem)
+    pdt.assert_frame_equal(adata_pb.obs, expected.obs)
+
+
+@pytest.mark.parametrize("view", [False, True])
+@pytest.mark.parametrize("aggr_fun", [np.sum, np.mean])
+def test_pseudobulk_bootstrap(adata_hierarchical1, view, aggr_fun):
+    if view:
+        adata_hierarchical1 = adata_hierarchical1[1:, :]
+    X = adata_hierarchical1.X
+    X = X.toarray() if hasattr(X, "toarray") else np.asarray(X)
+    adata_pb = pseudobulk_bootstrap(
+        adata_hierarchical1,
+        groupby="dataset",
+        n_replicates=50,
+        min_obs=2,
+        aggr_fun=aggr_fun,
+    )
+    assert adata_pb.shape == (100, 2)
+    npt.assert_equal(adata_pb.obs["dataset"].values[:4], ["d1", "d2", "d1", "d2"])
+    npt.assert_equal(adata_pb.obs["replicate"].values[:4], [0, 0, 1, 1])
+    for dataset, n_obs in [("d1", 3 if view else 4), ("d2", 3)]:
+        mask = adata_pb.obs["dataset"] == dataset
+        npt.assert_equal(adata_pb.obs.loc[mask, "n_obs"].values, n_obs)
+        x_group = X[(adata_hierarchical1.obs["dataset"] == dataset).values, 0]
+        x_boot = adata_pb.X[mask.values, 0]
+        if aggr_fun is np.mean:
+            x_boot = x_boot * n_obs
+        # each bootstrap sum is a sum of `n_obs` values drawn from the group
+        assert np.all(x_boot >= n_obs * np.min(x_group))
+        assert np.all(x_boot <= n_obs * np.max(x_group))
+        # replicates differ
+        assert len(np.unique(x_boot)) > 1
+
+
+def test_pseudobulk_subsample(adata_hierarchical1):
+    adata_pb = pseudobulk_bootstrap(
+        adata_hierarchical1,
+        groupby="dataset",
+        n_replicates=20,
+        sample_size=3,
+        replace=False,
+        min_obs=0,
+    )
+    # d3 has only one cell
+    npt.assert_equal(np.unique(adata_pb.obs["dataset"]), ["d1", "d2"])
+    npt.assert_equal(adata_pb.obs["n_obs"].values, 3)
+    # subsampling all cells of d2 without replacement always gives the total sum
+    npt.assert_equal(
+        adata_pb.X[(adata_pb.obs["dataset"] == "d2").values, :], [[9, 0]] * 20
+    )
+    # sums of three distinct cells out of [10, 12, 10, 13]
+    d1 = adata_pb.X[(adata_pb.obs["dataset"] == "d1").values, 0]
+    assert set(d1) <= {32, 33, 35}
+
+    with pytest.raises(ValueError):
+        pseudobulk_bootstrap(adata_hierarchical1, groupby="dataset", replace=False)
@@ -0,0 +1,177 @@
+from scanpy_helpers.results import ResultTable, ResultWriter, concat_results
+from scanpy_helpers.util import log2_fc, fdr_correction
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import statsmodels.stats.multitest
+import pytest
+
+
+def _make_res(variables, groups, rng):
+    return pd.DataFrame(
+        {
+            "coef": rng.normal(size=len(variables) * len(groups)),
+            "intercept": np.repeat(rng.uniform(-0.5, 2, len(variables)), len(groups)),
+            "pvalue": rng.uniform(size=len(variables) * len(groups)),
+            "variable": np.repeat(variables, len(groups)),
+            "group": np.tile(groups, len(variables)),
+        },
+        index=[f"key[{g}]" for g in np.tile(groups, len(variables))],
+    )
+
+
+def test_result_table():
+    rng = np.random.default_rng(0)
+    dfs = [
+        _make_res(["a", "b"], ["x", "y"], rng),
+        _make_res(["c", "a"], ["y", "z"], rng),
+        _make_res(["d"], ["x"], rng),
+    ]
+    # small capacity to test growing the table
+    table = ResultTable(capacity=2)
+    for i, df in enumerate(dfs):
+        table.append(df, cell_type=f"ct{i}")
+    assert len(table) == 9
+    assert table.columns == [
+        "coef",
+        "intercept",
+        "pvalue",
+        "variable",
+        "group",
+        "cell_type",
+    ]
+
+    res = table.to_df()
+    expected = pd.concat([df.assign(cell_type=f"ct{i}") for i, df in enumerate(dfs)])
+    for col in ["variable", "group", "cell_type"]:
+        assert isinstance(res[col].dtype, pd.CategoricalDtype)
+    pdt.assert_frame_equal(res, expected, check_dtype=False, check_categorical=False)
+    assert res["variable"].cat.categories.tolist() == ["a", "b", "c", "d"]
+
+    arr = table.to_numpy()
+    npt.assert_equal(arr["pvalue"], expected["pvalue"].values)
+    npt.assert_equal(table.categories["group"][arr["group"]], expected["group"].values)
+
+
+def test_concat_results_missing_columns():
+    rng = np.random.default_rng(0)
+    df1 = _make_res(["a"], ["x", "y"], rng).assign(pvalue_perm=0.5)
+    df2 = _make_res(["b"], ["x", "y"], rng)
+    res = concat_results([df1, pd.DataFrame(), df2])
+    assert res.shape == (4, 6)
+    assert np.all(np.isnan(res["pvalue_perm"].values[2:]))
+
+
+@pytest.mark.parametrize("extra_first", [False, True])
+def test_result_table_schema(extra_first):
+    """Columns can be added and omitted by later data frames"""
+    rng = np.random.default_rng(0)
+    df_extra = _make_res(["a"], ["x", "y"], rng).assign(
+        pvalue_perm=0.5, df_resid=7, significant=True, method="batched"
+    )
+    df_plain = _make_res(["b"], ["x", "y"], rng)
+    dfs = [df_extra, df_plain] if extra_first else [df_plain, df_extra]
+    res = ResultTable(capacity=1).extend(dfs).to_df()
+
+    assert res.shape == (4, 9)
+    extra = (res["variable"] == "a").values
+    for col in ["pvalue_perm", "df_resid", "significant"]:
+        assert np.issubdtype(res[col].dtype, np.floating)
+        npt.assert_equal(res.loc[extra, col].values, float(df_extra[col].iloc[0]))
+        assert np.all(np.isnan(res.loc[~extra, col].values))
+    assert res.loc[extra, "method"].tolist() == ["batched", "batched"]
+    assert res.loc[~extra, "method"].isnull().all()
+    pdt.assert_frame_equal(
+        res.loc[:, df_plain.columns],
+        pd.concat(dfs).loc[:, df_plain.columns],
+        check_dtype=False,
+        check_categorical=False,
+    )
+
+    # integer columns are kept as long as they are present in all data frames
+    res = concat_results([df_extra, df_extra])
+    assert res["df_resid"].dtype == np.int64
+
+
+def test_result_table_derived_columns():
+    rng = np.random.default_rng(0)
+    df = pd.concat(
+        [
+            _make_res(list("abcdef"), ["x", "y"], rng).assign(cell_type=ct)
+            for ct in ["ct1", "ct2", "ct3"]
+        ]
+    )
+    df.iloc[0, df.columns.get_loc("intercept")] = 0
+    table = ResultTable().append(df)
+
+    table.fdr_correction(groupby="cell_type")
+    res = table.to_df()
+    for ct in ["ct1", "ct2", "ct3"]:
+        mask = (res["cell_type"] == ct).values
+        npt.assert_allclose(
+            res.loc[mask, "fdr"],
+            statsmodels.stats.multitest.fdrcorrection(res.loc[mask, "pvalue"])[1],
+        )
+    npt.assert_allclose(
+        res["fdr"], fdr_correction(df, groupby="cell_type")["fdr"].values
+    )
+
+    table.log2_fc()
+    res = table.to_df()
+    npt.assert_equal(res["log2_fc"].values, log2_fc(df)["log2_fc"].values)
+
+
+@pytest.mark.parametrize("groupby", [None, "cell_type"])
+def test_fdr_correction_nan(groupby):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {"pvalue": rng.uniform(size=20), "cell_type": np.repeat(["ct1", "ct2"], 10)}
+    )
+    df.loc[3, "pvalue"] = np.nan
+    res = fdr_correction(df, groupby=groupby)
+    assert np.isnan(res.loc[3, "fdr"])
+    # the missing p-value is not counted as a test
+    expected = fdr_correction(df.drop(index=3), groupby=groupby)
+    npt.assert_allclose(res.drop(index=3)["fdr"], expected["fdr"])
+    table_res = ResultTable().append(df).fdr_correction(groupby=groupby).to_df()
+    npt.assert_allclose(table_res["fdr"].values, res["fdr"].values)
+
+
+def test_log2_fc():
+    df = pd.DataFrame(
+        {"intercept": [0, -1, 1, 2, 4, np.nan], "coef": [1, 0.5, -1, -3, 4, 1]}
+    )
+    npt.assert_equal(
+        log2_fc(df)["log2_fc"].values, [np.inf, np.inf, -np.inf, -np.inf, 1, np.nan]
+    )
+
+
+def test_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    rng = np.random.default_rng(0)
+    df1 = _make_res(["a", "b"], ["x", "y"], rng)
+    df2 = _make_res(["c", "a"], ["y", "z"], rng)
+
+    table = ResultTable().append(df1, cell_type="ct1").append(df2, cell_type="ct2")
+    table.write_parquet(tmp_path / "table.parquet")
+    res = pd.read_parquet(tmp_path / "table.parquet")
+    pdt.assert_frame_equal(
+        res.drop(columns="__index__"),
+        table.to_df().reset_index(drop=True),
+        check_categorical=False,
+    )
+
+    with ResultWriter(tmp_path / "stream.parquet") as writer:
+        writer.write(df1, comparison="c1")
+        writer.write(ResultTable().append(df2), comparison="c2")
+    res = pd.read_parquet(tmp_path / "stream.parquet")
+    assert isinstance(res["comparison"].dtype, pd.CategoricalDtype)
+    pdt.assert_frame_equal(
+        res.drop(columns="__index__").astype(
+            {"variable": str, "group": str, "comparison": str}
+        ),
+        pd.concat(
+            [df1.assign(comparison="c1"), df2.assign(comparison="c2")]
+        ).reset_index(drop=True),
+    )
@@ -0,0 +1,179 @@
+from scanpy_helpers.signatures import (
+    roc_auc,
+    fold_change,
+    specific_fold_change,
+    marker_statistics,
+    _get_grid,
+    _grid_search_cv_execute_fold,
+)
+from sklearn.metrics import roc_auc_score
+from anndata import AnnData
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import scipy.sparse as sp
+import pytest
+
+
+@pytest.fixture
+def adata():
+    rng = np.random.default_rng(0)
+    n_obs, n_vars = 60, 40
+    # integer values to get many ties, negative values and zeros
+    X = rng.integers(-2, 4, size=(n_obs, n_vars)).astype(float)
+    X[rng.uniform(size=X.shape) < 0.5] = 0
+    X[:, 0] = 0
+    return AnnData(
+        X=X,
+        obs=pd.DataFrame(
+            {"cell_type": rng.choice(["T", "B", "NK", "Mast"], n_obs)},
+            index=[f"s{i}" for i in range(n_obs)],
+        ),
+    )
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_roc_auc(adata, sparse):
+    if sparse:
+        X = sp.csr_matrix(adata.X)
+        # explicitly stored zeros are treated like implicit ones
+        X.data[:5] = 0
+        adata.X = X
+    X_dense = adata.X.toarray() if sparse else adata.X
+
+    res = roc_auc(adata, obs_col="cell_type", positive_class="B", inplace=False)
+    mask = adata.obs["cell_type"] == "B"
+    expected = [roc_auc_score(mask, X_dense[:, j]) for j in range(adata.n_vars)]
+    npt.assert_allclose(res, expected)
+
+    res_all = roc_auc(adata, obs_col="cell_type", inplace=False)
+    assert res_all.shape == (adata.n_vars, 4)
+    for ct in res_all.columns:
+        mask = adata.obs["cell_type"] == ct
+        npt.assert_allclose(
+            res_all[ct],
+            [roc_auc_score(mask, X_dense[:, j]) for j in range(adata.n_vars)],
+        )
+
+    roc_auc(adata, obs_col="cell_type", key_added="auroc")
+    npt.assert_allclose(adata.var["NK_auroc"], res_all["NK"])
+
+    with pytest.raises(ValueError):
+        roc_auc(adata, obs_col="cell_type", positive_class="foo")
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_roc_auc_nan_labels(adata, sparse):
+    """Cells with a missing label count as negatives for all classes"""
+    adata.obs["cell_type"] = adata.obs["cell_type"].where(
+        np.arange(adata.n_obs) % 7 != 0
+    )
+    if sparse:
+        adata.X = sp.csr_matrix(adata.X)
+    X_dense = adata.X.toarray() if sparse else adata.X
+
+    res_all = roc_auc(adata, obs_col="cell_type", inplace=False)
+    assert res_all.shape == (adata.n_vars, 4)
+    for ct in res_all.columns:
+        mask = adata.obs["cell_type"] == ct
+        npt.assert_allclose(
+            res_all[ct],
+            [roc_auc_score(mask, X_dense[:, j]) for j in range(adata.n_vars)],
+        )
+        npt.assert_allclose(
+            res_all[ct],
+            roc_auc(adata, obs_col="cell_type", positive_class=ct, inplace=False),
+        )
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_marker_statistics(adata, sparse):
+    if sparse:
+        adata.X = sp.csr_matrix(adata.X)
+    res = marker_statistics(adata, obs_col="cell_type")
+    assert res.shape == (4 * adata.n_vars, 5)
+    for ct in adata.obs["cell_type"].unique():
+        tmp_res = res.loc[res["group"] == ct]
+        assert tmp_res["gene"].tolist() == adata.var_names.tolist()
+        for stat, fun in [
+            ("fold_change", fold_change),
+            ("specific_fold_change", specific_fold_change),
+        ]:
+            expected = fun(
+                (
+                    adata.copy()
+                    if not sparse
+                    else AnnData(adata.X.toarray(), obs=adata.obs)
+                ),
+                obs_col="cell_type",
+                positive_class=ct,
+                inplace=False,
+            )
+            npt.assert_allclose(tmp_res[stat], np.ravel(expected))
+        npt.assert_allclose(
+            tmp_res["roc_auc"],
+            roc_auc(adata, obs_col="cell_type", positive_class=ct, inplace=False),
+        )
+
+    marker_statistics(
+        adata,
+        obs_col="cell_type",
+        inplace=True,
+        keys_added={
+            "fold_change": "fc",
+            "specific_fold_change": "sfc",
+            "roc_auc": "auroc",
+        },
+    )
+    npt.assert_allclose(
+        adata.var["T_sfc"], res.loc[res["group"] == "T", "specific_fold_change"]
+    )
+    npt.assert_allclose(adata.var["NK_auroc"], res.loc[res["group"] == "NK", "roc_auc"])
+
+
+def test_grid_search_threshold_sweep():
+    rng = np.random.default_rng(0)
+    n_patients, n_vars = 20, 200
+    patients = [f"p{i}" for i in range(n_patients)]
+    cell_types = ["T", "B", "NK"]
+    obs = pd.DataFrame(
+        [(p, ct) for p in patients for ct in cell_types], columns=["patient", "ct"]
+    )
+    obs.index = obs.index.astype(str)
+    X = rng.normal(size=(obs.shape[0], n_vars))
+    # marker genes of different strength for T cells
+    X[(obs["ct"] == "T").values, :40] += np.linspace(0.5, 4, 40)
+    X[:, -5:] = 0
+    pb_train = AnnData(X, obs=obs)
+    pb_test = AnnData(
+        rng.normal(size=(n_patients, n_vars)),
+        obs=pd.DataFrame({"true_frac": rng.uniform(size=n_patients)}, index=patients),
+        var=pb_train.var,
+    )
+    pb_test.X[:, :40] += pb_test.obs["true_frac"].values[:, np.newaxis]
+    pb_test.X[:, -3:] = 1
+
+    grid = list(
+        _get_grid(
+            {
+                "min_fc": [0, 0.5, 1, 2, 3, 10],
+                "min_sfc": [-np.inf, 0, 1],
+                "min_auroc": [0.5, 0.8, 0.97],
+            }
+        )
+    ) + [{"min_fc": 1}]
+    fold = (0, patients[:15], patients[15:])
+    kwargs = dict(
+        replicate_col="patient", label_col="ct", positive_class="T", grid=grid
+    )
+    res = _grid_search_cv_execute_fold(
+        (pb_train, pb_test), fold, incremental=True, **kwargs
+    )
+    expected = _grid_search_cv_execute_fold(
+        (pb_train, pb_test), fold, incremental=False, **kwargs
+    )
+    res, expected = pd.DataFrame(res), pd.DataFrame(expected)
+    # some signatures are empty or don't contain any gene with a valid z-score
+    assert np.any(res["n_genes"] == 0) and not np.all(np.isnan(res["score_pearson"]))
+    pdt.assert_frame_equal(res, expected, check_dtype=False)
@@ -3,6 +3,7 @@ import contextlib
 import os
 import statsmodels.stats.multitest
 import numpy as np
+import pandas as pd
 from anndata import AnnData
 import scipy.sparse
 
@@ -22,39 +23,74 @@ def log2_fc(
     if not inplace:
         df = df.copy()
 
-    def _logfc(mean, diff):
-        if mean <= 0 and diff > 0:
-            # the intercept may be negative when there is a categorical covariate.
-            # We treat it as 0.
-            # an increase from 0 -> infinite fold change
-            return np.inf
-        elif mean + diff <= 0:
-            # a decrease to 0 -> -infinite fold change
-            return -np.inf
-        else:
-            return logfun(diff + mean) - logfun(mean)
-
     # The intercept is the mean, the coef the deviation from the mean.
     # Thereby, fold-change = (intercept + coef) / intercept
-    df[key_added] = [
-        _logfc(mean, diff) for mean, diff in zip(df[mean_col], df[diff_col])
-    ]
+    df[key_added] = _log2_fc_values(
+        np.asarray(df[mean_col], dtype=float),
+        np.asarray(df[diff_col], dtype=float),
+        logfun,
+    )
 
     if not inplace:
         return df
 
 
-def fdr_correction(df, pvalue_col="pvalue", *, key_added="fdr", inplace=False):
-    """Adjust p-values in a data frame with test results using FDR correction."""
+def _log2_fc_values(mean, diff, logfun=np.log2):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(
+            # the intercept may be negative when there is a categorical covariate.
+            # We treat it as 0.
+            # an increase from 0 -> infinite fold change
+            (mean <= 0) & (diff > 0),
+            np.inf,
+            np.where(
+                # a decrease to 0 -> -infinite fold change
+                mean + diff <= 0,
+                -np.inf,
+                logfun(diff + mean) - logfun(mean),
+            ),
+        )
+
+
+def fdr_correction(
+    df, pvalue_col="pvalue", *, key_added="fdr", inplace=False, groupby=None
+):
+    """Adjust p-values in a data frame with test results using FDR correction.
+
+    If `groupby` is specified, p-values are adjusted separately within each group
+    (e.g. each cell-type). Missing p-values are ignored and get a missing FDR.
+    """
     if not inplace:
         df = df.copy()
 
-    df[key_added] = statsmodels.stats.multitest.fdrcorrection(df[pvalue_col].values)[1]
+    df[key_added] = _fdr_values(
+        df[pvalue_col].values,
+        None if groupby is None else pd.factorize(df[groupby])[0],
+    )
 
     if not inplace:
         return df
 
 
+def _fdr_values(pvalues, groups=None):
+    # missing p-values (e.g. variables that could not be tested) are not counted as tests
+    # and keep a missing FDR
+    pvalues = np.asarray(pvalues, dtype=float)
+    fdr = np.full(len(pvalues), np.nan)
+    tested = np.flatnonzero(~np.isnan(pvalues))
+    if not len(tested):
+        return fdr
+    if groups is None:
+        fdr[tested] = statsmodels.stats.multitest.fdrcorrection(pvalues[tested])[1]
+        return fdr
+    groups = np.asarray(groups)[tested]
+    order = np.argsort(groups, kind="stable")
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+    for idx in np.split(tested[order], bounds):
+        fdr[idx] = statsmodels.stats.multitest.fdrcorrection(pvalues[idx])[1]
+    return fdr
+
+
 def split_anndata(adata, groupby):
     """Split an anndata object into a dict of anndata objects based on a column in obs"""
     categories = adata.obs[groupby].unique()
@@ -93,6 +129,23 @@ def _choose_mtx_rep(adata, use_raw=False, layer=None):
         return adata.X
 
 
+def _factorize(values, *, dropna: bool = True):
+    """
+    Like `pd.factorize(values, sort=False)`. If `dropna` is False, missing values get
+    their own code after all other values instead of -1.
+
+    `pd.factorize(use_na_sentinel=...)` is only available from pandas 1.5.
+    """
+    codes, uniques = pd.factorize(values, sort=False)
+    uniques = np.asarray(uniques)
+    if not dropna and np.any(codes < 0):
+        codes = np.where(codes < 0, len(uniques), codes)
+        if not np.issubdtype(uniques.dtype, np.floating):
+            uniques = uniques.astype(object)
+        uniques = np.append(uniques, np.nan)
+    return codes, uniques
+
+
 def reindex_adata(adata, new_var_names):
     """
     Like pd.DataFrame.reindex, but for anndata.